@@ -1,16 +1,48 @@
 # app.py
 from flask import (
     Flask, render_template, request, redirect, url_for,
-    session, jsonify, flash, abort
+    session, jsonify, flash, abort, g, has_request_context, send_file, Response
 )
 from flask_bcrypt import Bcrypt
-from pymongo import MongoClient
-from datetime import datetime, date, timedelta
+from pymongo import DeleteOne, MongoClient, ReadPreference, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, ConnectionFailure, DuplicateKeyError, ExecutionTimeout
+from pymongo.read_concern import ReadConcern
+from pymongo.read_preferences import SecondaryPreferred
+from datetime import datetime, date, timedelta, timezone
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
 from bson.objectid import ObjectId
 from bson.errors import InvalidId
+from bson.timestamp import Timestamp
+from werkzeug.utils import secure_filename
 from dotenv import load_dotenv
+from contextlib import ExitStack, contextmanager
+from functools import wraps
+import atexit
+import base64
+import calendar
+import difflib
+import gridfs
+import itertools
+import json
 import os
+import random
+import re
+import socket
+import threading
+import time
 import traceback
+import uuid
+
+from analytics import forecast
+from loadshed import AdaptiveLimiter, CircuitBreaker, StaleCache
+from profiler import CommandTimeline, ProfileStore, RequestProfile, sign_token, verify_token
+from querybudget import QueryTracker, query_budget
+from receipts import HAVE_PILLOW, SNIFF_BYTES, ThumbnailPool, make_thumbnail, multipart_events, sniff_content_type
+from sketches import TDigest, summarize
+from subcalendar import CalendarCache, add_months, charges_before, expand_charges, group_charges, running_totals
+from txcache import ColumnarCache, KIND_EXPENSE, KIND_INCOME
+from warmup import Warmer
+from writebuffer import GroupCommitWriter, WriteTimeout, WriterBusy
 
 # -------------------- CONFIG --------------------
 load_dotenv()
@@ -29,9 +61,23 @@ if not MONGO_URI:
 # Clean MONGO_URI - remove any extra whitespace or quotes
 MONGO_URI = MONGO_URI.strip().strip('"').strip("'")
 
+# Records per-request Mongo commands while a request is being profiled
+command_timeline = CommandTimeline()
+# Counts per-request queries for route budgets (QUERY_BUDGET_MODE)
+query_tracker = QueryTracker()
+# Opens when too many recent Mongo commands fail or run slow (see LOAD SHEDDING)
+mongo_breaker = CircuitBreaker(
+    failure_rate=float(os.getenv("BREAKER_FAILURE_RATE", 0.5)),
+    slow_call_rate=float(os.getenv("BREAKER_SLOW_CALL_RATE", 0.5)),
+    min_calls=int(os.getenv("BREAKER_MIN_CALLS", 20)),
+    window_seconds=int(os.getenv("BREAKER_WINDOW_SECONDS", 10)),
+    reset_timeout=float(os.getenv("BREAKER_RESET_SECONDS", 10)),
+    slow_call_ms=float(os.getenv("BREAKER_SLOW_CALL_MS", 1000))
+)
+
 # Validate and connect to MongoDB
 try:
-    client = MongoClient(MONGO_URI, serverSelectionTimeoutMS=5000)
+    client = MongoClient(MONGO_URI, serverSelectionTimeoutMS=5000, event_listeners=[command_timeline, query_tracker, mongo_breaker])
     # Test connection
     client.admin.command('ping')
     print("✅ MongoDB connection successful")
@@ -56,6 +102,360 @@ transactions_col = db["transactions"]
 cards_col = db["cards"]
 subscriptions_col = db["subscriptions"]
 limits_col = db["limits"]
+locks_col = db["locks"]
+# Cold tier: one document per user per month holding that month's old transactions
+buckets_col = db["transaction_buckets"]
+# Per user x category t-digest of expense amounts (see SPENDING DISTRIBUTIONS)
+sketches_col = db["spending_sketches"]
+# Spend per limit scope and period, kept current with $inc (see LIMITS)
+limit_counters_col = db["limit_counters"]
+# Per-user change version counter and deletion tombstones (see DELTA SYNC)
+sync_col = db["sync_versions"]
+tombstones_col = db["sync_tombstones"]
+# Per-user category tree, one node per normalized path (see CATEGORIES & TAGS)
+categories_col = db["categories"]
+# Append-only transaction events and periodic balance snapshots (see LEDGER)
+ledger_col = db["ledger_events"]
+ledger_snapshots_col = db["ledger_snapshots"]
+# Groups of users sharing a combined budget view (see HOUSEHOLDS)
+households_col = db["households"]
+# GridFS bucket "receipts" (see RECEIPTS); chunk size is also the upload read size
+RECEIPT_CHUNK_BYTES = 255 * 1024
+receipt_files_col = db["receipts.files"]
+receipt_chunks_col = db["receipts.chunks"]
+
+
+INDEXES = [
+    # Unique keys turn duplicate checks into a single insert/upsert
+    (users_col, [("email", 1)], {"unique": True}),
+    (cards_col, [("user_id", 1), ("last4", 1), ("brand", 1)], {"unique": True}),
+    # Many limits per user: one per (category, period); category None = overall
+    (limits_col, [("user_id", 1), ("category", 1), ("period", 1)], {"unique": True}),
+    (subscriptions_col, [("next_payment_at", 1)], {}),
+    # One renewal expense per subscription cycle, whichever worker gets there first
+    (transactions_col, [("renewal_key", 1)], {"unique": True, "sparse": True}),
+    # A retried create with the same Idempotency-Key header finds the first write
+    (transactions_col, [("user_id", 1), ("idempotency_key", 1)],
+     {"unique": True, "partialFilterExpression": {"idempotency_key": {"$exists": True}}}),
+    # Multikey prefix index used by /api/transactions/search
+    (transactions_col, [("user_id", 1), ("search_terms", 1)], {}),
+    # Filtered listing: equality on user/type/category, then sort or range
+    (transactions_col, [("user_id", 1), ("created_at", -1)], {}),
+    (transactions_col, [("user_id", 1), ("type", 1), ("created_at", -1)], {}),
+    # Multikey: a category filter matches the whole subtree
+    (transactions_col, [("user_id", 1), ("category_ancestors", 1), ("created_at", -1)], {}),
+    (transactions_col, [("user_id", 1), ("tags", 1), ("created_at", -1)], {}),
+    (transactions_col, [("user_id", 1), ("date", -1)], {}),
+    (buckets_col, [("user_id", 1), ("month", -1)], {}),
+    (buckets_col, [("user_id", 1), ("transactions._id", 1)], {}),
+    (sketches_col, [("user_id", 1), ("category", 1)], {}),
+    (limit_counters_col, [("user_id", 1)], {}),
+    (limit_counters_col, [("expire_at", 1)], {"expireAfterSeconds": 0}),
+    # /api/sync: documents changed after a client's version
+    (transactions_col, [("user_id", 1), ("sync_version", 1)], {}),
+    (cards_col, [("user_id", 1), ("sync_version", 1)], {}),
+    (subscriptions_col, [("user_id", 1), ("sync_version", 1)], {}),
+    (buckets_col, [("user_id", 1), ("max_sync_version", 1)], {}),
+    (tombstones_col, [("user_id", 1), ("sync_version", 1)], {}),
+    (tombstones_col, [("deleted_at", 1)], {}),
+    (categories_col, [("user_id", 1), ("ancestors", 1)], {}),
+    (receipt_files_col, [("metadata.user_id", 1), ("metadata.transaction_id", 1)], {}),
+    (ledger_col, [("user_id", 1), ("at", -1), ("_id", -1)], {}),
+    (ledger_col, [("user_id", 1), ("tx_id", 1)], {}),
+    (ledger_snapshots_col, [("user_id", 1), ("at", -1)], {"unique": True}),
+    (households_col, [("members", 1)], {}),
+    (households_col, [("invited", 1)], {}),
+]
+
+# Indexes that newer ones replace: (collection, index name)
+OBSOLETE_INDEXES = [
+    (limits_col, "user_id_1"),  # single limit per user
+    (transactions_col, "user_id_1_category_1_created_at_-1"),  # exact-string category filter
+    (tombstones_col, "user_id_1_deleted_at_1"),  # per-user pruning on sync reads
+    (subscriptions_col, "next_payment_date_1"),  # free-form strings; renewals query next_payment_at
+]
+
+
+def ensure_indexes():
+    """Create the indexes the app's queries rely on (safe to call repeatedly)."""
+    for col, name in OBSOLETE_INDEXES:
+        try:
+            if name in col.index_information():
+                col.drop_index(name)
+        except Exception as e:
+            print(f"Index drop error on {col.name} {name}: {str(e)}")
+    for col, keys, options in INDEXES:
+        try:
+            col.create_index(keys, **options)
+        except Exception as e:
+            # e.g. existing duplicates block a unique index; keep creating the rest
+            print(f"Index creation error on {col.name} {keys}: {str(e)}")
+
+
+ensure_indexes()
+
+# -------------------- READ ROUTING --------------------
+# Heavy analytics/history reads may go to secondaries; everything else reads
+# the primary. Each request gets a causally consistent session that is
+# advanced to the user's last write, so secondary reads still see that
+# user's own writes (readConcern afterClusterTime).
+ANALYTICS_MAX_STALENESS_SECONDS = max(int(os.getenv("ANALYTICS_MAX_STALENESS_SECONDS", 120)), 90)
+
+READ_PROFILES = {
+    "primary": {
+        "read_preference": ReadPreference.PRIMARY,
+        "read_concern": ReadConcern("local"),
+    },
+    "analytics": {
+        "read_preference": SecondaryPreferred(max_staleness=ANALYTICS_MAX_STALENESS_SECONDS),
+        "read_concern": ReadConcern("majority"),
+    },
+}
+
+# endpoint -> read profile (anything not listed reads the primary)
+ROUTE_READ_PROFILES = {
+    "visualization_page": "analytics",
+    "api_visualization_summary": "analytics",
+    "api_analytics_forecast": "analytics",
+    "api_analytics_distribution": "analytics",
+    "api_analytics_categories": "analytics",
+    "profile_page": "analytics",
+    "transactions_page": "analytics",
+    "income_page": "analytics",
+    "expense_page": "analytics",
+    "api_get_all_transactions": "analytics",
+    "api_get_income": "analytics",
+    "api_get_expenses": "analytics",
+    "api_search_transactions": "analytics",
+}
+# e.g. MONGO_ROUTE_READ_PROFILES="profile_page=primary,api_get_cards=analytics"
+for pair in filter(None, os.getenv("MONGO_ROUTE_READ_PROFILES", "").split(",")):
+    endpoint, _, profile = pair.partition("=")
+    if profile.strip() in READ_PROFILES:
+        ROUTE_READ_PROFILES[endpoint.strip()] = profile.strip()
+
+_routed_collections = {}
+
+
+def reads(col):
+    """``col`` configured with the current route's read preference and read concern."""
+    profile = "primary"
+    if has_request_context():
+        profile = ROUTE_READ_PROFILES.get(request.endpoint, "primary")
+    key = (col.name, profile)
+    if key not in _routed_collections:
+        _routed_collections[key] = col.with_options(**READ_PROFILES[profile])
+    return _routed_collections[key]
+
+
+def db_session():
+    """This request's causally consistent Mongo session (None outside a request)."""
+    if not has_request_context():
+        return None
+    if "db_session" not in g:
+        s = client.start_session(causal_consistency=True)
+        last_write = session.get("mongo_op_time")
+        if last_write:
+            s.advance_operation_time(Timestamp(*last_write))
+        g.db_session = s
+    return g.db_session
+
+
+@app.after_request
+def remember_write_time(response):
+    # Carry the operation time of this request's writes to the user's next request
+    s = g.get("db_session")
+    if s is not None and request.method != "GET" and s.operation_time is not None:
+        session["mongo_op_time"] = [s.operation_time.time, s.operation_time.inc]
+    return response
+
+
+@app.teardown_request
+def end_db_session(exc):
+    s = g.pop("db_session", None)
+    if s is not None:
+        s.end_session()
+
+# -------------------- REQUEST PROFILING --------------------
+# A request is profiled (cProfile + Mongo command timeline) when it sends a
+# valid "X-Profile" token minted from PROFILING_SECRET, or when it is picked
+# by PROFILE_SAMPLE_RATE. Profiles land in PROFILE_DIR; the oldest are
+# deleted beyond PROFILE_MAX_FILES / PROFILE_MAX_BYTES.
+PROFILING_SECRET = os.getenv("PROFILING_SECRET", "")
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", 0))
+PROFILE_DIR = os.getenv("PROFILE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "profiles"))
+PROFILE_MAX_FILES = int(os.getenv("PROFILE_MAX_FILES", 200))
+PROFILE_MAX_BYTES = int(os.getenv("PROFILE_MAX_BYTES", 100 * 1024 * 1024))
+PROFILE_TOKEN_TTL_SECONDS = int(os.getenv("PROFILE_TOKEN_TTL_SECONDS", 600))
+ADMIN_EMAILS = {e.strip().lower() for e in os.getenv("ADMIN_EMAILS", "").split(",") if e.strip()}
+
+profile_store = ProfileStore(PROFILE_DIR, max_profiles=PROFILE_MAX_FILES, max_bytes=PROFILE_MAX_BYTES)
+
+
+@app.before_request
+def start_request_profile():
+    if request.endpoint == "static" or request.path.startswith("/api/admin/profiles"):
+        return
+    reason = None
+    if verify_token(PROFILING_SECRET, request.headers.get("X-Profile")):
+        reason = "signed"
+    elif PROFILE_SAMPLE_RATE and random.random() < PROFILE_SAMPLE_RATE:
+        reason = "sampled"
+    if reason:
+        g.request_profile = RequestProfile(request.method, request.full_path.rstrip("?"), reason,
+                                           session.get("user_id"))
+        g.request_profile.start()
+
+
+def save_request_profile(status):
+    profile = g.pop("request_profile", None)
+    if profile is None:
+        return None
+    profile.stop(status)
+    try:
+        return profile_store.save(profile)
+    except Exception as e:
+        print(f"Error saving request profile {profile.id}: {str(e)}")
+        return None
+
+
+@app.after_request
+def finish_request_profile(response):
+    profile_id = save_request_profile(response.status_code)
+    if profile_id:
+        response.headers["X-Profile-Id"] = profile_id
+    return response
+
+
+@app.teardown_request
+def abandon_request_profile(exc):
+    # Only still set when the request failed before after_request ran
+    if "request_profile" in g:
+        save_request_profile(500)
+
+
+def require_admin_json():
+    """Return a JSON error unless the logged-in user's email is in ADMIN_EMAILS."""
+    if "user_id" not in session:
+        return jsonify({"error": "auth required"}), 403
+    try:
+        user = users_col.find_one({"_id": ObjectId(session["user_id"])}, {"email": 1})
+    except InvalidId:
+        user = None
+    if not user or (user.get("email") or "").lower() not in ADMIN_EMAILS:
+        return jsonify({"error": "admin only"}), 403
+    return None
+
+
+# -------------------- QUERY BUDGETS --------------------
+# QUERY_BUDGET_MODE: "off" (default), "staging" (log over-budget requests) or
+# "test" (fail them with a 500 carrying the report). Budgets are declared per
+# route with @query_budget(max_queries=..., max_bytes=..., max_repeats=...).
+QUERY_BUDGET_MODE = os.getenv("QUERY_BUDGET_MODE", "off").lower()
+
+
+@app.before_request
+def start_query_tracking():
+    if QUERY_BUDGET_MODE == "off" or request.endpoint in (None, "static"):
+        return
+    view = app.view_functions.get(request.endpoint)
+    query_tracker.begin(request.endpoint, getattr(view, "_query_budget", None))
+
+
+@app.after_request
+def check_query_budget(response):
+    queries = query_tracker.end()
+    if queries is None:
+        return response
+    response.headers["X-Query-Count"] = str(queries.queries)
+    response.headers["X-Query-Bytes"] = str(queries.bytes)
+    if not queries.violations():
+        return response
+
+    report = queries.report()
+    print(f"Query budget exceeded on {request.method} {request.path}: {json.dumps(report, default=str)}")
+    if QUERY_BUDGET_MODE == "test":
+        return jsonify({"error": "query budget exceeded", "report": report}), 500
+    return response
+
+
+@app.teardown_request
+def stop_query_tracking(exc):
+    query_tracker.end()
+
+
+# -------------------- LOAD SHEDDING --------------------
+# Mongo-heavy API routes run under a per-class adaptive concurrency limit and
+# the Mongo circuit breaker. A request that is shed (breaker open, or no slot
+# within SHED_QUEUE_TIMEOUT_MS) gets the last good payload for the same user
+# and URL marked "stale" where the route allows it, otherwise a 503.
+LOAD_SHEDDING_ENABLED = os.getenv("LOAD_SHEDDING_ENABLED", "True").lower() == "true"
+SHED_QUEUE_TIMEOUT_MS = float(os.getenv("SHED_QUEUE_TIMEOUT_MS", 500))
+SHED_TARGET_LATENCY_MS = float(os.getenv("SHED_TARGET_LATENCY_MS", 250))
+SHED_MAX_CONCURRENCY = int(os.getenv("SHED_MAX_CONCURRENCY", 32))
+
+ROUTE_LIMITERS = {
+    name: AdaptiveLimiter(name, initial=max(SHED_MAX_CONCURRENCY // 2, 2), max_limit=SHED_MAX_CONCURRENCY,
+                          queue_timeout=SHED_QUEUE_TIMEOUT_MS / 1000, target_latency_ms=SHED_TARGET_LATENCY_MS)
+    for name in ("dashboard", "list", "analytics")
+}
+stale_payloads = StaleCache(max_entries=int(os.getenv("STALE_CACHE_MAX_ENTRIES", 10000)))
+
+
+def shed_response(key, allow_stale, reason):
+    if allow_stale:
+        payload, age = stale_payloads.get(key)
+        if payload is not None:
+            response = jsonify(dict(payload, stale=True, stale_age_seconds=round(age, 1)))
+            response.headers["Cache-Control"] = "no-store"
+            response.headers["Warning"] = '110 - "Response is Stale"'
+            return response
+    response = jsonify({"error": "service busy, please retry", "reason": reason})
+    response.status_code = 503
+    response.headers["Retry-After"] = str(max(int(mongo_breaker.reset_timeout), 1))
+    return response
+
+
+def shed_load(route_class, stale=False):
+    """Run the view under ``route_class``'s limiter and the Mongo breaker.
+
+    With ``stale=True`` each successful JSON response is remembered and served
+    (marked stale) when the request has to be shed. Apply below ``@app.route``.
+    """
+    limiter = ROUTE_LIMITERS[route_class]
+
+    def decorate(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if not LOAD_SHEDDING_ENABLED:
+                return view(*args, **kwargs)
+            key = (session.get("user_id"), request.full_path)
+            if not mongo_breaker.allow():
+                return shed_response(key, stale, "circuit open")
+            if not limiter.acquire():
+                mongo_breaker.finish_probe()
+                return shed_response(key, stale, "overloaded")
+
+            started = time.perf_counter()
+            ok = False
+            try:
+                response = app.make_response(view(*args, **kwargs))
+                ok = response.status_code < 500
+            except (ConnectionFailure, ExecutionTimeout) as e:
+                # Includes server selection timeouts, which never reach the listener
+                mongo_breaker.record_failure()
+                print(f"Mongo unavailable in {request.endpoint}: {str(e)}")
+                return shed_response(key, stale, "database unavailable")
+            finally:
+                limiter.release((time.perf_counter() - started) * 1000, ok)
+                mongo_breaker.finish_probe()
+
+            if stale and response.status_code == 200 and response.is_json:
+                stale_payloads.put(key, response.get_json())
+            return response
+        return wrapper
+    return decorate
+
 
 # -------------------- HELPERS --------------------
 def json_or_form(req):
@@ -66,6 +466,340 @@ def json_or_form(req):
     return {k: req.form.get(k) for k in req.form.keys()}
 
 
+def parse_date(value):
+    """Parse a stored date string (several legacy formats) into a date, or None."""
+    if not value:
+        return None
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    for fmt in ("%Y-%m-%d", "%Y/%m/%d", "%d-%m-%Y"):
+        try:
+            return datetime.strptime(value, fmt).date()
+        except Exception:
+            continue
+    try:
+        return datetime.fromisoformat(value).date()
+    except Exception:
+        return None
+
+
+def payment_date_fields(value):
+    """Stored form of a subscription's next payment date, or None if ``value`` is not a date.
+
+    ``next_payment_date`` keeps the ISO string the API and templates show;
+    ``next_payment_at`` is the same day as a BSON datetime (UTC midnight),
+    which is what due-date queries compare on.
+    """
+    if not value:
+        return {"next_payment_date": None, "next_payment_at": None}
+    d = parse_date(value)
+    if d is None:
+        return None
+    return {"next_payment_date": d.isoformat(), "next_payment_at": datetime(d.year, d.month, d.day)}
+
+
+# Transaction amounts are stored as integer paise in ``amount_minor`` and
+# transaction dates as BSON datetimes. Documents written before that keep a
+# float ``amount`` / string ``date`` until migrate_transactions() reaches them.
+MINOR_UNITS = 100
+
+
+def to_minor(value):
+    """Convert a user-entered amount ("12.34", 12.34, 12) to integer paise exactly."""
+    amount = Decimal(str(value).strip())
+    if not amount.is_finite():
+        raise ValueError("amount must be finite")
+    return int((amount * MINOR_UNITS).quantize(Decimal("1"), rounding=ROUND_HALF_UP))
+
+
+def to_major(minor):
+    """Integer paise -> rupees as a float, for display and JSON only."""
+    return (minor or 0) / MINOR_UNITS
+
+
+def tx_minor(tx):
+    """Amount of a transaction document in paise (handles unmigrated docs)."""
+    if tx.get("amount_minor") is not None:
+        return int(tx["amount_minor"])
+    try:
+        return to_minor(tx.get("amount") or 0)
+    except (InvalidOperation, ValueError, TypeError):
+        return 0
+
+
+# Aggregation counterpart of tx_minor()
+MINOR_AMOUNT_EXPR = {"$ifNull": ["$amount_minor", {"$toLong": {"$round": [
+    {"$multiply": [{"$convert": {"input": "$amount", "to": "double", "onError": 0, "onNull": 0}}, MINOR_UNITS]}, 0
+]}}]}
+
+
+def to_tx_date(value):
+    """Parse a submitted transaction date into a datetime (now if empty)."""
+    if not value:
+        return datetime.utcnow()
+    parsed = parse_date(value)
+    if not parsed:
+        raise ValueError("invalid date")
+    try:
+        return datetime.fromisoformat(value).replace(tzinfo=None)
+    except (TypeError, ValueError):
+        return datetime(parsed.year, parsed.month, parsed.day)
+
+
+def serialize_tx(tx):
+    """Shape a transaction document for templates/JSON (string id, rupee amount, ISO date)."""
+    if "_id" in tx and tx["_id"]:
+        tx["_id"] = str(tx["_id"])
+    if tx.get("amount_minor") is not None or "amount" in tx:
+        tx["amount"] = to_major(tx_minor(tx))
+    if isinstance(tx.get("date"), datetime):
+        tx["date"] = tx["date"].date().isoformat()
+    for field in SEARCH_PROJECTION:
+        tx.pop(field, None)
+    return tx
+
+
+def archived_pipeline(match):
+    """Stages over ``transaction_buckets`` that yield archived transactions matching
+    ``match`` (a transaction query scoped to one user), newest month first."""
+    bucket_match = {"user_id": match["user_id"]}
+    date_range = match.get("date")
+    if isinstance(date_range, dict):
+        # Prune whole buckets before unwinding them
+        months = {}
+        if isinstance(date_range.get("$gte"), datetime):
+            months["$gte"] = date_range["$gte"].strftime("%Y-%m")
+        if isinstance(date_range.get("$lt"), datetime):
+            months["$lte"] = date_range["$lt"].strftime("%Y-%m")
+        if months:
+            bucket_match["month"] = months
+    if isinstance(match.get("sync_version"), dict) and "$gt" in match["sync_version"]:
+        # Delta sync: skip buckets holding nothing newer than the client's version
+        bucket_match["max_sync_version"] = {"$gt": match["sync_version"]["$gt"]}
+    if isinstance(match.get("search_terms"), dict) and "$all" in match["search_terms"]:
+        # Search: skip buckets where no row has the term (rows are re-checked after unwinding)
+        bucket_match["transactions.search_terms"] = match["search_terms"]
+    return [
+        {"$match": bucket_match},
+        {"$sort": {"month": -1}},
+        {"$unwind": "$transactions"},
+        {"$replaceRoot": {"newRoot": {"$mergeObjects": ["$transactions", {"user_id": "$user_id"}]}}},
+        {"$match": match}
+    ]
+
+
+def merged_aggregate(match, stages):
+    """Run ``stages`` over hot and archived transactions matching ``match`` as one stream."""
+    return reads(transactions_col).aggregate([
+        {"$match": match},
+        {"$unionWith": {"coll": buckets_col.name, "pipeline": archived_pipeline(match)}}
+    ] + stages, session=db_session())
+
+
+def find_transactions(query, limit=0):
+    """Transactions matching ``query``, newest first: hot documents, then archived ones."""
+    cursor = reads(transactions_col).find(query, SEARCH_PROJECTION, session=db_session()).sort("created_at", -1)
+    txs = list(cursor.limit(limit))
+    if limit and len(txs) >= limit:
+        return txs
+    stages = archived_pipeline(query) + [{"$sort": {"created_at": -1}}, {"$project": SEARCH_PROJECTION}]
+    if limit:
+        stages.append({"$limit": limit - len(txs)})
+    # A document being archived can briefly exist in both tiers
+    seen = {t["_id"] for t in txs}
+    for t in reads(buckets_col).aggregate(stages, session=db_session()):
+        if t["_id"] not in seen:
+            txs.append(t)
+    return txs
+
+
+def transaction_totals(match):
+    """Exact income/expense totals (paise) and count for transactions matching ``match``."""
+    if set(match) == {"user_id"}:
+        # Unfiltered: read the precomputed bucket totals instead of unwinding buckets
+        archived = [
+            {"$match": match},
+            {"$project": {"rows": [
+                {"_id": "income", "total": "$income_minor", "count": "$income_count"},
+                {"_id": "expense", "total": "$expense_minor", "count": "$expense_count"},
+                {"_id": None, "total": 0,
+                 "count": {"$subtract": ["$count", {"$add": ["$income_count", "$expense_count"]}]}}
+            ]}},
+            {"$unwind": "$rows"},
+            {"$replaceRoot": {"newRoot": "$rows"}}
+        ]
+    else:
+        archived = archived_pipeline(match) + [
+            {"$group": {"_id": "$type", "total": {"$sum": MINOR_AMOUNT_EXPR}, "count": {"$sum": 1}}}
+        ]
+    totals = {"income": 0, "expense": 0, "count": 0}
+    for row in reads(transactions_col).aggregate([
+        {"$match": match},
+        {"$group": {"_id": "$type", "total": {"$sum": MINOR_AMOUNT_EXPR}, "count": {"$sum": 1}}},
+        {"$unionWith": {"coll": buckets_col.name, "pipeline": archived}},
+        {"$group": {"_id": "$_id", "total": {"$sum": "$total"}, "count": {"$sum": "$count"}}}
+    ], session=db_session()):
+        if row["_id"] in ("income", "expense"):
+            totals[row["_id"]] = row["total"]
+        totals["count"] += row["count"]
+    return totals
+
+
+# Per-process columnar cache of type/amount/date/label for read-heavy pages
+TX_CACHE_MAX_BYTES = int(os.getenv("TX_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+TX_CACHE_TTL_SECONDS = int(os.getenv("TX_CACHE_TTL_SECONDS", 60))
+TX_CACHE_PROJECTION = {"type": 1, "amount_minor": 1, "amount": 1, "date": 1,
+                       "created_at": 1, "category": 1, "source": 1}
+
+
+def fetch_cache_rows(user_id, since):
+    query = {"user_id": user_id}
+    if since is not None:
+        query["created_at"] = {"$gte": since}
+    rows = reads(transactions_col).find(query, TX_CACHE_PROJECTION, session=db_session()).sort("created_at", 1)
+    if since is not None:
+        # Only old transactions get archived, so refreshes never need the buckets
+        return rows
+    archived = reads(buckets_col).aggregate(
+        archived_pipeline(query) + [{"$project": TX_CACHE_PROJECTION}], session=db_session())
+    return itertools.chain(archived, rows)
+
+
+tx_cache = ColumnarCache(fetch_cache_rows, tx_minor, max_bytes=TX_CACHE_MAX_BYTES,
+                         ttl_seconds=TX_CACHE_TTL_SECONDS)
+
+
+# Optional group commit for transaction inserts (high-rate ingestion)
+TX_WRITE_COALESCING = os.getenv("TX_WRITE_COALESCING", "False").lower() == "true"
+tx_writer = None
+if TX_WRITE_COALESCING:
+    _w = os.getenv("TX_WRITE_CONCERN_W", "1")
+    tx_writer = GroupCommitWriter(
+        transactions_col,
+        max_batch=int(os.getenv("TX_WRITE_MAX_BATCH", 500)),
+        max_delay_ms=float(os.getenv("TX_WRITE_MAX_DELAY_MS", 5)),
+        max_pending=int(os.getenv("TX_WRITE_MAX_PENDING", 5000)),
+        write_concern={"w": int(_w) if _w.isdigit() else _w},
+        name="transaction-writer",
+        # Versions for a whole batch at once (see DELTA SYNC); ledger events
+        # commit in the batch's own transaction
+        before_flush=lambda docs: reserve_sync_versions(docs),
+        atomic_with=lambda docs, s: append_ledger(
+            [ledger_event(d["user_id"], "create", d, d["sync_version"]) for d in docs], session=s),
+        after_flush=lambda reserved, docs: release_sync_batch(reserved)
+    )
+    atexit.register(tx_writer.close)
+
+
+def insert_transaction(tx):
+    """Insert one transaction, through the group-commit writer when enabled.
+
+    The document and its ledger event commit in one Mongo transaction; the
+    writer does the same for its whole batch, and stamps the sync versions.
+    Raises WriterBusy when the write buffer is full, WriteTimeout when a
+    queued write was not acknowledged in time, and DuplicateKeyError when
+    the idempotency key was already used.
+    """
+    tx.setdefault("_id", ObjectId())
+    if tx_writer is not None:
+        try:
+            tx_writer.insert(tx)
+        except BulkWriteError as bwe:
+            errors = bwe.details.get("writeErrors", [])
+            if errors and errors[0].get("code") == 11000:
+                raise DuplicateKeyError(errors[0].get("errmsg", "duplicate key"), 11000, errors[0])
+            raise
+        return
+    with sync_change(tx["user_id"]) as version:
+        tx["sync_version"] = version
+        event = ledger_event(tx["user_id"], "create", tx, version)
+
+        def insert(s):
+            transactions_col.insert_one(tx, session=s)
+            append_ledger([event], session=s)
+        in_transaction(insert)
+
+
+IDEMPOTENCY_HEADER = "Idempotency-Key"
+
+
+def idempotency_fields(req):
+    """The transaction field for the request's Idempotency-Key header, if it sent one."""
+    key = (req.headers.get(IDEMPOTENCY_HEADER) or "").strip()
+    return {"idempotency_key": key[:128]} if key else {}
+
+
+def write_new_transaction(tx, on_late_write=None):
+    """insert_transaction() for the create routes: None once written, else the response to send.
+
+    A write still queued when the route stops waiting gets 202 (it may yet
+    land, so it must not be retried as new); ``on_late_write(tx)`` then runs
+    on the writer thread if it does. A repeated Idempotency-Key returns the
+    transaction the first request created.
+    """
+    try:
+        insert_transaction(tx)
+    except WriterBusy:
+        return jsonify({"error": "server busy, please retry"}), 503
+    except WriteTimeout as pending:
+        if on_late_write:
+            pending.future.add_done_callback(lambda f: f.exception() is None and on_late_write(tx))
+        # Serialize a copy: the queued document is still being written
+        return jsonify({"success": True, "pending": True, "transaction": serialize_tx(dict(tx))}), 202
+    except DuplicateKeyError:
+        existing = transactions_col.find_one(
+            {"user_id": tx["user_id"], "idempotency_key": tx.get("idempotency_key")}, SEARCH_PROJECTION
+        )
+        if not existing:
+            raise
+        return jsonify({"success": True, "duplicate": True, "transaction": serialize_tx(existing)}), 200
+    return None
+
+
+def monthly_trend(entry):
+    """Chart-ready monthly income/expense series from a cache entry."""
+    months, income, expense = entry.monthly()
+    return {
+        "labels": [datetime.strptime(m, "%Y-%m").strftime("%b %Y") for m in months],
+        "income": [to_major(v) for v in income],
+        "expense": [to_major(v) for v in expense]
+    }
+
+
+SEARCH_FIELDS = ("note", "payee", "source", "category")
+SEARCH_MIN_PREFIX = 2
+SEARCH_MAX_PREFIX = 20
+# Keep the search arrays out of API responses
+SEARCH_PROJECTION = {"search_terms": 0, "search_words": 0}
+
+
+def tokenize(text):
+    return re.findall(r"\w+", (text or "").lower())
+
+
+def search_index_fields(tx):
+    """Build the inverted-index arrays stored on a transaction.
+
+    ``search_words`` holds the whole words (used for relevance) and
+    ``search_terms`` every prefix of them, so prefix queries are plain
+    equality lookups on a multikey index.
+    """
+    words = set()
+    for field in SEARCH_FIELDS:
+        value = tx.get(field)
+        if isinstance(value, str):
+            words.update(tokenize(value))
+    terms = set()
+    for w in words:
+        for i in range(SEARCH_MIN_PREFIX, min(len(w), SEARCH_MAX_PREFIX) + 1):
+            terms.add(w[:i])
+        if len(w) < SEARCH_MIN_PREFIX:
+            terms.add(w)
+    return {"search_terms": sorted(terms), "search_words": sorted(words)}
+
+
 def require_login_json():
     """Return a JSON error if user not logged in (for API endpoints)."""
     if "user_id" not in session:
@@ -99,16 +833,19 @@ def register():
         if not name or not email or not password:
             return jsonify({"error": "All fields are required"}), 400
 
-        if db.users.find_one({"email": email}):
-            return jsonify({"error": "User already exists"}), 400
-
         hashed_pw = bcrypt.generate_password_hash(password).decode("utf-8")
-        db.users.insert_one({
-            "name": name,
-            "email": email,
-            "password": hashed_pw,
-            "created_at": datetime.utcnow()
-        })
+        try:
+            # Unique index on email rejects duplicates atomically
+            users_col.insert_one({
+                "name": name,
+                "email": email,
+                "password": hashed_pw,
+                "created_at": datetime.utcnow(),
+                # No history to backfill into the ledger
+                "ledger_since": datetime.utcnow()
+            })
+        except DuplicateKeyError:
+            return jsonify({"error": "User already exists"}), 400
 
         # ✅ Always return JSON if the request is from JS
         if request.is_json:
@@ -136,6 +873,7 @@ def login():
         if user and bcrypt.check_password_hash(user["password"], password):
             session["user_id"] = str(user["_id"])
             session["user_name"] = user.get("name", "")
+            warm_dashboard(session["user_id"])
 
             if request.is_json:
                 return jsonify({"message": "Login successful!"}), 200
@@ -173,6 +911,7 @@ def logout():
 
 # -------------------- DASHBOARD (page + API) --------------------
 @app.route("/dashboard", methods=["GET"])
+@query_budget(max_queries=10)
 def dashboard():
     try:
         if "user_id" not in session:
@@ -183,105 +922,27 @@ def dashboard():
 
         user_id = session["user_id"]
 
-        # Query user-specific data with error handling
-        try:
-            cards = list(cards_col.find({"user_id": user_id}))
-            recent_transactions = list(transactions_col.find({"user_id": user_id}).sort("created_at", -1).limit(6))
-            subs = list(subscriptions_col.find({"user_id": user_id}).sort("next_payment_date", 1).limit(6))
-            user_limit = limits_col.find_one({"user_id": user_id})
-        except Exception as e:
-            print(f"Database query error in dashboard: {str(e)}")
-            print(traceback.format_exc())
-            cards = []
-            recent_transactions = []
-            subs = []
-            user_limit = None
-
-        # Compute totals with error handling
-        try:
-            all_tx = list(transactions_col.find({"user_id": user_id}))
-            total_income = sum(float(t.get("amount", 0)) for t in all_tx if t.get("type") == "income")
-            total_expense = sum(float(t.get("amount", 0)) for t in all_tx if t.get("type") == "expense")
-            balance = total_income - total_expense
-            
-            # Calculate category spending for expenses
-            category_spending = {}
-            for t in all_tx:
-                if t.get("type") == "expense":
-                    category = t.get("category") or "Other"
-                    try:
-                        amount = float(t.get("amount", 0))
-                        category_spending[category] = category_spending.get(category, 0) + amount
-                    except (ValueError, TypeError):
-                        continue
-        except Exception as e:
-            print(f"Error calculating totals in dashboard: {str(e)}")
-            print(traceback.format_exc())
-            total_income = 0.0
-            total_expense = 0.0
-            balance = 0.0
-            category_spending = {}
-
-        # Convert ObjectIds for JSON with error handling
-        try:
-            for c in cards:
-                if "_id" in c and c["_id"]:
-                    c["_id"] = str(c["_id"])
-            for t in recent_transactions:
-                if "_id" in t and t["_id"]:
-                    t["_id"] = str(t["_id"])
-            for s in subs:
-                if "_id" in s and s["_id"]:
-                    s["_id"] = str(s["_id"])
-        except Exception as e:
-            print(f"Error converting ObjectIds in dashboard: {str(e)}")
-            print(traceback.format_exc())
-
-        # 🔹 If JSON request (Postman)
+        # 🔹 If JSON request (Postman) → every widget in one response
         if request.is_json or request.headers.get("Accept") == "application/json":
+            data = {}
+            for name, (loader, _) in DASHBOARD_WIDGETS.items():
+                try:
+                    data.update(loader(user_id))
+                except Exception as e:
+                    print(f"Error loading dashboard widget {name}: {str(e)}")
+                    print(traceback.format_exc())
             return jsonify({
                 "message": "Dashboard data fetched successfully!",
-                "data": {
-                    "cards": cards,
-                    "recent_transactions": recent_transactions,
-                    "subscriptions": subs,
-                    "limit": user_limit,
-                    "total_income": total_income,
-                    "total_expense": total_expense,
-                    "balance": balance
-                }
+                "data": data
             }), 200
 
-        # 🔹 Otherwise (Browser) → render HTML
+        # 🔹 Otherwise (Browser) → render the shell; dashboard.js fetches each widget
         try:
-            # Ensure all variables have safe defaults
-            try:
-                total_income_val = float(total_income) if total_income is not None else 0.0
-            except (ValueError, TypeError):
-                total_income_val = 0.0
-            
-            try:
-                total_expense_val = float(total_expense) if total_expense is not None else 0.0
-            except (ValueError, TypeError):
-                total_expense_val = 0.0
-            
-            try:
-                balance_val = float(balance) if balance is not None else 0.0
-            except (ValueError, TypeError):
-                balance_val = 0.0
-            
-            template_vars = {
-                "cards": cards if cards else [],
-                "recent_transactions": recent_transactions if recent_transactions else [],
-                "subscriptions": subs if subs else [],
-                "user_limit": user_limit,
-                "total_income": total_income_val,
-                "total_expense": total_expense_val,
-                "balance": balance_val,
-                "category_spending": category_spending if category_spending else {},
-                "user_name": session.get("user_name", "User")
-            }
-            return render_template("dashboard.html", **template_vars)
+            return render_template(
+                "dashboard.html",
+                user_name=session.get("user_name", "User"),
+                widgets=list(DASHBOARD_WIDGETS)
+            )
         except Exception as template_error:
             print("=" * 50)
             print("TEMPLATE RENDERING ERROR IN DASHBOARD")
@@ -338,6 +999,120 @@ def dashboard():
         </body>
         </html>
         """, 500
+# -------------------- DASHBOARD WIDGETS (lazy-loaded) --------------------
+# The dashboard page is a static shell; each section is fetched separately
+# from /api/dashboard/widgets/<name> so one slow query no longer holds back
+# the whole page. Loaders return the JSON-ready fields for their section.
+def widget_summary(user_id):
+    entry = tx_cache.get(user_id)
+    totals = entry.totals()
+    return {
+        "total_income": to_major(totals["income"]),
+        "total_expense": to_major(totals["expense"]),
+        "balance": to_major(totals["income"] - totals["expense"]),
+        "transactions_count": totals["count"],
+        "category_spending": {
+            category: to_major(total)
+            for category, total in entry.by_label(KIND_EXPENSE).items()
+        }
+    }
+
+
+def widget_cards(user_id):
+    cards = list(cards_col.find({"user_id": user_id}))
+    for c in cards:
+        c["_id"] = str(c["_id"])
+    return {"cards": cards}
+
+
+def widget_transactions(user_id):
+    return {"recent_transactions": [serialize_tx(t) for t in find_transactions({"user_id": user_id}, limit=6)]}
+
+
+def widget_subscriptions(user_id):
+    subs = list(subscriptions_col.find({"user_id": user_id}).sort("next_payment_date", 1).limit(6))
+    for s in subs:
+        s["_id"] = str(s["_id"])
+    return {"subscriptions": subs}
+
+
+def widget_limit(user_id):
+    limits = limits_with_status(user_id)
+    return {"limit": overall_limit(limits), "limits": limits}
+
+
+# name -> (loader, browser max-age seconds; 0 = always revalidate via ETag)
+DASHBOARD_WIDGETS = {
+    "summary": (widget_summary, 0),
+    "cards": (widget_cards, 0),
+    "transactions": (widget_transactions, 0),
+    "subscriptions": (widget_subscriptions, 0),
+    "limit": (widget_limit, 0),
+}
+
+
+@app.route("/api/dashboard/widgets/<name>", methods=["GET"])
+@query_budget(max_queries=4)
+@shed_load("dashboard", stale=True)
+def api_dashboard_widget(name):
+    if "user_id" not in session:
+        return jsonify({"error": "auth required"}), 403
+    if name not in DASHBOARD_WIDGETS:
+        return jsonify({"error": "unknown widget"}), 404
+
+    loader, max_age = DASHBOARD_WIDGETS[name]
+    try:
+        data = dashboard_warmer.take(session["user_id"], name) if name in WARM_WIDGETS else None
+        if data is None:
+            data = loader(session["user_id"])
+    except Exception as e:
+        print(f"Error loading dashboard widget {name}: {str(e)}")
+        print(traceback.format_exc())
+        return jsonify({"error": f"Failed to load {name}"}), 500
+
+    # Each widget is cached on its own: unchanged sections come back as 304
+    response = jsonify({"success": True, "widget": data})
+    response.headers["Cache-Control"] = f"private, max-age={max_age}" if max_age else "private, no-cache"
+    response.vary.add("Cookie")
+    response.add_etag()
+    return response.make_conditional(request)
+
+
+# -------------------- DASHBOARD WARM-UP (after login) --------------------
+# A successful login computes the user's slowest widgets in the background
+# (this also loads their columnar cache), so the first dashboard view is warm.
+# Skipped, not queued, while the server is shedding load.
+WARMUP_ENABLED = os.getenv("WARMUP_ENABLED", "True").lower() == "true"
+WARM_WIDGETS = ("summary", "subscriptions")
+dashboard_warmer = Warmer(
+    max_workers=int(os.getenv("WARMUP_WORKERS", 2)),
+    max_pending=int(os.getenv("WARMUP_MAX_PENDING", 32)),
+    ttl_seconds=int(os.getenv("WARMUP_TTL_SECONDS", 60))
+)
+
+
+def server_busy():
+    """True while Mongo looks unhealthy or any route class is at its concurrency limit."""
+    if mongo_breaker.state != CircuitBreaker.CLOSED:
+        return True
+    return any(l.in_flight >= int(l.limit) for l in ROUTE_LIMITERS.values())
+
+
+def warm_dashboard(user_id):
+    if not WARMUP_ENABLED:
+        return False
+    loaders = {name: DASHBOARD_WIDGETS[name][0] for name in WARM_WIDGETS}
+    return dashboard_warmer.schedule(user_id, loaders, busy=server_busy())
+
+
+@app.after_request
+def discard_warm_payloads(response):
+    # Any write makes precomputed widgets suspect; login itself schedules them
+    if request.method != "GET" and request.endpoint != "login" and "user_id" in session:
+        dashboard_warmer.discard(session["user_id"])
+    return response
+
+
 # -------------------- CARDS --------------------
 @app.route("/cards")
 def cards_page():
@@ -401,16 +1176,7 @@ def api_create_card():
     last4 = number[-4:] if len(number) >= 4 else number
     masked_number = f"**** **** **** {last4}"
 
-    # Prevent duplicates
-    existing = cards_col.find_one({
-        "user_id": session["user_id"],
-        "last4": last4,
-        "brand": data.get("brand")
-    })
-    if existing:
-        return jsonify({"error": "This card already exists"}), 409
-
-    # Create and insert card document
+    # Create and insert card document (unique index on user_id/last4/brand prevents duplicates)
     card = {
         "user_id": session["user_id"],
         "cardholder": data.get("cardholder"),
@@ -422,7 +1188,12 @@ def api_create_card():
         "created_at": datetime.utcnow()
     }
 
-    res = cards_col.insert_one(card)
+    try:
+        with sync_change(card["user_id"]) as version:
+            card["sync_version"] = version
+            res = cards_col.insert_one(card)
+    except DuplicateKeyError:
+        return jsonify({"error": "This card already exists"}), 409
     card["_id"] = str(res.inserted_id)
 
     return jsonify({
@@ -466,10 +1237,13 @@ def api_delete_card(card_id):
     except Exception:
         return jsonify({"error": "Invalid card ID"}), 400
 
-    result = cards_col.delete_one({
-        "_id": obj_id,
-        "user_id": session["user_id"]
-    })
+    with sync_change(session["user_id"]) as version:
+        result = cards_col.delete_one({
+            "_id": obj_id,
+            "user_id": session["user_id"]
+        })
+        if result.deleted_count:
+            record_deletions(session["user_id"], "cards", [obj_id], version)
 
     if result.deleted_count == 0:
         return jsonify({"error": "Card not found or unauthorized"}), 404
@@ -478,6 +1252,7 @@ def api_delete_card(card_id):
 
 # -------------------- INCOME --------------------
 @app.route("/income")
+@query_budget(max_queries=4)
 def income_page():
     try:
         if "user_id" not in session:
@@ -487,7 +1262,7 @@ def income_page():
         
         # Fetch incomes with error handling
         try:
-            incomes = list(transactions_col.find({"user_id": user_id, "type": "income"}).sort("created_at", -1).limit(50))
+            incomes = find_transactions({"user_id": user_id, "type": "income"}, limit=50)
         except Exception as e:
             print(f"Database error in income_page: {str(e)}")
             print(traceback.format_exc())
@@ -496,8 +1271,7 @@ def income_page():
         # Convert ObjectIds to strings
         try:
             for i in incomes:
-                if "_id" in i and i["_id"]:
-                    i["_id"] = str(i["_id"])
+                serialize_tx(i)
         except Exception as e:
             print(f"Error converting ObjectIds in income_page: {str(e)}")
         
@@ -515,31 +1289,42 @@ def api_create_income():
         return jsonify({"error": "auth required"}), 403
     data = json_or_form(request)
     try:
-        amt = float(data.get("amount", 0))
+        amount_minor = to_minor(data.get("amount", 0))
     except Exception:
         return jsonify({"error": "invalid amount"}), 400
+    try:
+        tx_date = to_tx_date(data.get("date"))
+    except ValueError:
+        return jsonify({"error": "invalid date"}), 400
     tx = {
         "user_id": session["user_id"],
         "type": "income",
-        "amount": amt,
+        "amount_minor": amount_minor,
         "source": data.get("source"),
-        "date": data.get("date") or datetime.utcnow().isoformat(),
+        "tags": normalize_tags(data.get("tags")),
+        "date": tx_date,
         "note": data.get("note", ""),
-        "created_at": datetime.utcnow()
+        "created_at": datetime.utcnow(),
+        **idempotency_fields(request)
     }
-    res = transactions_col.insert_one(tx)
-    tx["_id"] = str(res.inserted_id)
-    return jsonify({"success": True, "transaction": tx}), 201
+    tx.update(search_index_fields(tx))
+    failed = write_new_transaction(tx)
+    if failed:
+        return failed
+    return jsonify({"success": True, "transaction": serialize_tx(tx)}), 201
 
 @app.route("/api/income", methods=["GET"])
+@shed_load("list")
 def api_get_income():
     if "user_id" not in session:
         return jsonify({"error": "auth required"}), 403
-    incomes = list(transactions_col.find(
-        {"user_id": session["user_id"], "type": "income"}
-    ).sort("created_at", -1))
+    query, _, error = build_transaction_filter(session["user_id"], request.args)
+    if error:
+        return jsonify({"error": error}), 400
+    query["type"] = "income"
+    incomes = find_transactions(query)
     for i in incomes:
-        i["_id"] = str(i["_id"])
+        serialize_tx(i)
     return jsonify(incomes), 200
 
 @app.route("/api/income/<income_id>", methods=["DELETE"])
@@ -551,20 +1336,18 @@ def api_delete_income(income_id):
     except Exception:
         return jsonify({"error": "invalid id"}), 400
     
-    result = transactions_col.delete_one({
-        "_id": obj_id,
-        "user_id": session["user_id"],
-        "type": "income"
-    })
+    deleted = delete_transaction(session["user_id"], obj_id, "income")
     
-    if result.deleted_count == 0:
+    if not deleted:
         return jsonify({"error": "not found or unauthorized"}), 404
     
+    tx_cache.invalidate(session["user_id"])
     return jsonify({"success": True, "message": "Income deleted successfully"}), 200
 
 
 # -------------------- EXPENSE --------------------
 @app.route("/expense")
+@query_budget(max_queries=4)
 def expense_page():
     try:
         if "user_id" not in session:
@@ -574,7 +1357,7 @@ def expense_page():
         
         # Fetch expenses with error handling
         try:
-            expenses = list(transactions_col.find({"user_id": user_id, "type": "expense"}).sort("created_at", -1).limit(50))
+            expenses = find_transactions({"user_id": user_id, "type": "expense"}, limit=50)
         except Exception as e:
             print(f"Database error in expense_page: {str(e)}")
             print(traceback.format_exc())
@@ -583,8 +1366,7 @@ def expense_page():
         # Convert ObjectIds to strings
         try:
             for e in expenses:
-                if "_id" in e and e["_id"]:
-                    e["_id"] = str(e["_id"])
+                serialize_tx(e)
         except Exception as e:
             print(f"Error converting ObjectIds in expense_page: {str(e)}")
         
@@ -602,35 +1384,62 @@ def api_create_expense():
         return jsonify({"error": "auth required"}), 403
     data = json_or_form(request)
     try:
-        amt = float(data.get("amount", 0))
+        amount_minor = to_minor(data.get("amount", 0))
     except Exception:
         return jsonify({"error": "invalid amount"}), 400
+    try:
+        tx_date = to_tx_date(data.get("date"))
+    except ValueError:
+        return jsonify({"error": "invalid date"}), 400
     tx = {
         "user_id": session["user_id"],
         "type": "expense",
-        "amount": amt,
-        "category": data.get("category"),
+        "amount_minor": amount_minor,
+        **resolve_category(session["user_id"], data.get("category")),
+        "tags": normalize_tags(data.get("tags")),
         "payee": data.get("payee", ""),
-        "date": data.get("date") or datetime.utcnow().isoformat(),
+        "date": tx_date,
         "note": data.get("note", ""),
-        "created_at": datetime.utcnow()
+        "created_at": datetime.utcnow(),
+        **idempotency_fields(request)
     }
-    res = transactions_col.insert_one(tx)
-    tx["_id"] = str(res.inserted_id)
-    return jsonify({"success": True, "transaction": tx}), 201
+    tx.update(search_index_fields(tx))
+    failed = write_new_transaction(tx, on_late_write=expense_written)
+    if failed:
+        return failed
+    alerts = expense_written(tx)
+    return jsonify({"success": True, "transaction": serialize_tx(tx), "alerts": alerts}), 201
+
+
+def expense_written(tx):
+    """Update the spending sketch and limit counters for a stored expense; returns limit alerts."""
+    try:
+        record_expense_amount(tx["user_id"], tx.get("category"), tx_minor(tx))
+    except Exception as e:
+        # The expense is saved; a missed sketch update only skews the hints slightly
+        print(f"Error updating spending sketch: {str(e)}")
+    try:
+        return charge_limits(tx)
+    except Exception as e:
+        # Drop the counters so the next read re-seeds them from history
+        print(f"Error updating limit counters: {str(e)}")
+        invalidate_limit_counters(tx["user_id"])
+        return []
 
 @app.route("/api/expense", methods=["GET"])
+@shed_load("list")
 def api_get_expenses():
     if "user_id" not in session:
         return jsonify({"error": "auth required"}), 403
     
-    expenses = list(transactions_col.find({
-        "user_id": session["user_id"],
-        "type": "expense"
-    }).sort("created_at", -1))
+    query, _, error = build_transaction_filter(session["user_id"], request.args)
+    if error:
+        return jsonify({"error": error}), 400
+    query["type"] = "expense"
+    expenses = find_transactions(query)
     
     for e in expenses:
-        e["_id"] = str(e["_id"])
+        serialize_tx(e)
     
     return jsonify({"success": True, "expenses": expenses}), 200
 
@@ -643,20 +1452,20 @@ def api_delete_expense(expense_id):
     except Exception:
         return jsonify({"error": "invalid id"}), 400
     
-    result = transactions_col.delete_one({
-        "_id": obj_id,
-        "user_id": session["user_id"],
-        "type": "expense"
-    })
+    deleted = delete_transaction(session["user_id"], obj_id, "expense")
     
-    if result.deleted_count == 0:
+    if not deleted:
         return jsonify({"error": "not found or unauthorized"}), 404
     
+    tx_cache.invalidate(session["user_id"])
+    invalidate_limit_counters(session["user_id"])
+    delete_transaction_receipts(session["user_id"], [obj_id])
     return jsonify({"success": True, "message": "Expense deleted successfully"}), 200
 
 
 # -------------------- TRANSACTIONS --------------------
 @app.route("/transactions")
+@query_budget(max_queries=6)
 def transactions_page():
     try:
         print("=" * 50)
@@ -669,11 +1478,14 @@ def transactions_page():
         user_id = session["user_id"]
         print(f"User ID: {user_id}")
         
+        query, filters, error = build_transaction_filter(user_id, request.args)
+        if error:
+            flash(error, "error")
+            query, filters = {"user_id": user_id}, {}
+        
         # Fetch transactions with error handling
         try:
-            txs = list(transactions_col.find({"user_id": user_id})
-                       .sort("created_at", -1)
-                       .limit(200))
+            txs = find_transactions(query, limit=200)
             print(f"Found {len(txs)} transactions")
         except Exception as e:
             print(f"Database error in transactions_page: {str(e)}")
@@ -683,16 +1495,16 @@ def transactions_page():
         # Convert ObjectIds to strings
         try:
             for t in txs:
-                if "_id" in t and t["_id"]:
-                    t["_id"] = str(t["_id"])
+                serialize_tx(t)
         except Exception as e:
             print(f"Error converting ObjectIds in transactions_page: {str(e)}")
         
-        # Calculate totals
+        # Calculate totals over everything matching the filters
         try:
-            total_income = sum(float(t.get("amount", 0)) for t in txs if t.get("type") == "income")
-            total_expense = sum(float(t.get("amount", 0)) for t in txs if t.get("type") == "expense")
-            net_balance = total_income - total_expense
+            totals = transaction_totals(query)
+            total_income = to_major(totals["income"])
+            total_expense = to_major(totals["expense"])
+            net_balance = to_major(totals["income"] - totals["expense"])
             print(f"Calculated totals - Income: {total_income}, Expense: {total_expense}, Balance: {net_balance}")
         except Exception as e:
             print(f"Error calculating totals in transactions_page: {str(e)}")
@@ -707,7 +1519,8 @@ def transactions_page():
                 transactions=txs if txs else [],
                 total_income=total_income,
                 total_expense=total_expense,
-                net_balance=net_balance
+                net_balance=net_balance,
+                filters=filters
             )
             print("Template rendered successfully")
             return result
@@ -746,18 +1559,101 @@ def transactions_page():
         return redirect(url_for("dashboard"))
 
 
+TRANSACTION_TYPES = ("income", "expense")
+
+
+def list_arg(args, name):
+    """Collect a set-valued filter given as ?x=a&x=b or ?x=a,b."""
+    values = []
+    for raw in args.getlist(name):
+        values.extend(v.strip() for v in raw.split(",") if v.strip())
+    return values
+
+
+def build_transaction_filter(user_id, args):
+    """Compile list filters (from/to, min_amount/max_amount, category, tag, source,
+    type) into a Mongo query scoped to ``user_id``. A category matches its subtree.
+
+    Returns (query, filters, error); ``error`` is a message when validation fails.
+    """
+    query = {"user_id": user_id}
+    filters = {}
+
+    tx_type = (args.get("type") or "").strip().lower()
+    if tx_type and tx_type != "all":
+        if tx_type not in TRANSACTION_TYPES:
+            return None, None, "type must be income or expense"
+        query["type"] = tx_type
+        filters["type"] = tx_type
+
+    date_range = {}
+    for name, op in (("from", "$gte"), ("to", "$lt")):
+        raw = (args.get(name) or "").strip()
+        if not raw:
+            continue
+        try:
+            d = datetime.strptime(raw, "%Y-%m-%d").date()
+        except ValueError:
+            return None, None, f"{name} must be a YYYY-MM-DD date"
+        # An inclusive "to" is "< start of next day"
+        d = d + timedelta(days=1) if name == "to" else d
+        date_range[op] = datetime(d.year, d.month, d.day)
+        filters[name] = raw
+    if date_range:
+        if "$gte" in date_range and "$lt" in date_range and date_range["$gte"] >= date_range["$lt"]:
+            return None, None, "from must not be after to"
+        query["date"] = date_range
+
+    amount_range = {}
+    for name, op in (("min_amount", "$gte"), ("max_amount", "$lte")):
+        raw = (args.get(name) or "").strip()
+        if not raw:
+            continue
+        try:
+            amount_range[op] = to_minor(raw)
+        except (InvalidOperation, ValueError):
+            return None, None, f"{name} must be a number"
+        filters[name] = raw
+    if amount_range:
+        if "$gte" in amount_range and "$lte" in amount_range and amount_range["$gte"] > amount_range["$lte"]:
+            return None, None, "min_amount must not exceed max_amount"
+        query["amount_minor"] = amount_range
+
+    values = list_arg(args, "source")
+    if values:
+        query["source"] = values[0] if len(values) == 1 else {"$in": values}
+        filters["source"] = ",".join(values)
+
+    values = list_arg(args, "category")
+    paths = [p for p in map(category_path, values) if p]
+    if paths:
+        query["category_ancestors"] = paths[0] if len(paths) == 1 else {"$in": paths}
+        filters["category"] = ",".join(values)
+
+    tags = normalize_tags(list_arg(args, "tag"))
+    if tags:
+        query["tags"] = {"$all": tags}
+        filters["tag"] = ",".join(tags)
+
+    return query, filters, None
+
+
 # ✅ Get all transactions (for Postman)
 @app.route("/api/transactions", methods=["GET"])
+@query_budget(max_queries=6)
+@shed_load("list")
 def api_get_all_transactions():
     try:
         if "user_id" not in session:
             return jsonify({"error": "auth required"}), 403
         
         user_id = session["user_id"]
-        txs = list(transactions_col.find({"user_id": user_id}).sort("created_at", -1))
+        query, _, error = build_transaction_filter(user_id, request.args)
+        if error:
+            return jsonify({"error": error}), 400
+        txs = find_transactions(query)
         for t in txs:
-            if "_id" in t and t["_id"]:
-                t["_id"] = str(t["_id"])
+            serialize_tx(t)
         return jsonify({"success": True, "transactions": txs}), 200
     except Exception as e:
         print(f"Error in api_get_all_transactions: {str(e)}")
@@ -765,6 +1661,142 @@ def api_get_all_transactions():
         return jsonify({"error": "Failed to fetch transactions"}), 500
 
 
+# -------------------- TRANSACTION SEARCH --------------------
+SEARCH_PAGE_SIZE = 50
+SEARCH_MAX_PAGE_SIZE = 200
+
+
+def encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+
+def decode_cursor(cursor):
+    return json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+
+
+@app.route("/api/transactions/search", methods=["GET"])
+@query_budget(max_queries=3)
+@shed_load("list")
+def api_search_transactions():
+    """Prefix search over note/payee/source/category, best matches first.
+
+    Every query word must prefix-match some word of the transaction; results
+    are ranked by how many query words match a whole word, then newest first.
+    Pass the returned ``next_cursor`` back as ``cursor`` for the next page.
+    """
+    if "user_id" not in session:
+        return jsonify({"error": "auth required"}), 403
+
+    words = tokenize(request.args.get("q", ""))[:8]
+    if not words:
+        return jsonify({"error": "query required"}), 400
+    terms = [w[:SEARCH_MAX_PREFIX] for w in words]
+
+    try:
+        limit = min(int(request.args.get("limit", SEARCH_PAGE_SIZE)), SEARCH_MAX_PAGE_SIZE)
+        if limit <= 0:
+            limit = SEARCH_PAGE_SIZE
+    except ValueError:
+        limit = SEARCH_PAGE_SIZE
+
+    match = {"user_id": session["user_id"], "search_terms": {"$all": terms}}
+    pipeline = [
+        {"$match": match},
+        {"$unionWith": {"coll": buckets_col.name, "pipeline": archived_pipeline(match)}},
+        {"$addFields": {"score": {"$size": {"$setIntersection": ["$search_words", words]}}}},
+    ]
+
+    cursor = request.args.get("cursor")
+    if cursor:
+        try:
+            score, created_at, last_id = decode_cursor(cursor)
+            created_at = datetime.fromisoformat(created_at)
+            last_id = ObjectId(last_id)
+        except Exception:
+            return jsonify({"error": "invalid cursor"}), 400
+        pipeline.append({"$match": {"$or": [
+            {"score": {"$lt": score}},
+            {"score": score, "created_at": {"$lt": created_at}},
+            {"score": score, "created_at": created_at, "_id": {"$lt": last_id}},
+        ]}})
+
+    pipeline += [
+        {"$sort": {"score": -1, "created_at": -1, "_id": -1}},
+        {"$limit": limit + 1},
+        {"$project": SEARCH_PROJECTION},
+    ]
+
+    try:
+        results = list(reads(transactions_col).aggregate(pipeline, session=db_session()))
+    except Exception as e:
+        print(f"Error in api_search_transactions: {str(e)}")
+        print(traceback.format_exc())
+        return jsonify({"error": "Search failed"}), 500
+
+    next_cursor = None
+    if len(results) > limit:
+        results = results[:limit]
+        last = results[-1]
+        next_cursor = encode_cursor([last["score"], last["created_at"].isoformat(), str(last["_id"])])
+
+    # A document being archived can briefly exist in both tiers (adjacent after the sort)
+    results = [t for i, t in enumerate(results) if i == 0 or t["_id"] != results[i - 1]["_id"]]
+    for t in results:
+        serialize_tx(t)
+
+    return jsonify({
+        "success": True,
+        "count": len(results),
+        "transactions": results,
+        "next_cursor": next_cursor
+    }), 200
+
+
+def backfill_search_terms(batch_size=1000):
+    """Add search arrays to transactions written before search existed."""
+    updated = 0
+    while True:
+        batch = list(transactions_col.find(
+            {"search_terms": {"$exists": False}},
+            {f: 1 for f in SEARCH_FIELDS}
+        ).limit(batch_size))
+        if not batch:
+            return updated + index_archived_search(batch_size=batch_size // 10 or 1)
+        transactions_col.bulk_write(
+            [UpdateOne({"_id": t["_id"]}, {"$set": search_index_fields(t)}) for t in batch],
+            ordered=False
+        )
+        updated += len(batch)
+
+
+def index_archived_search(user_id=None, batch_size=100):
+    """Add search arrays to archived bucket rows missing them.
+
+    Covers rows archived before search existed and rows whose arrays were
+    dropped by an edit (category merges); one array-filtered $set per row.
+    """
+    pending = {"transactions": {"$elemMatch": {"search_terms": {"$exists": False}}}}
+    if user_id:
+        pending["user_id"] = user_id
+    fields = {"transactions._id": 1, "transactions.search_terms": 1, **{f"transactions.{f}": 1 for f in SEARCH_FIELDS}}
+    updated = 0
+    while True:
+        batch = list(buckets_col.find(pending, fields).limit(batch_size))
+        if not batch:
+            return updated
+        result = buckets_col.bulk_write([
+            UpdateOne(
+                {"_id": b["_id"]},
+                {"$set": {f"transactions.$[t].{k}": v for k, v in search_index_fields(t).items()}},
+                array_filters=[{"t._id": t["_id"], "t.search_terms": {"$exists": False}}]
+            )
+            for b in batch for t in b["transactions"] if "search_terms" not in t
+        ], ordered=False)
+        updated += result.modified_count
+        if result.modified_count == 0:
+            return updated
+
+
 # ✅ Get or Delete specific transaction
 @app.route("/api/transactions/<tx_id>", methods=["GET", "DELETE"])
 def api_transaction_detail(tx_id):
@@ -776,17 +1808,22 @@ def api_transaction_detail(tx_id):
         return jsonify({"error": "invalid id"}), 400
 
     if request.method == "GET":
-        tx = transactions_col.find_one({"_id": obj_id, "user_id": session["user_id"]})
+        tx = transactions_col.find_one({"_id": obj_id, "user_id": session["user_id"]}, SEARCH_PROJECTION)
+        if not tx:
+            _, tx = find_archived(session["user_id"], obj_id)
         if not tx:
             return jsonify({"error": "not found"}), 404
-        tx["_id"] = str(tx["_id"])
+        serialize_tx(tx)
         return jsonify({"success": True, "transaction": tx}), 200
 
     # DELETE
-    result = transactions_col.delete_one({"_id": obj_id, "user_id": session["user_id"]})
-    if result.deleted_count == 0:
+    deleted = delete_transaction(session["user_id"], obj_id)
+    if not deleted:
         return jsonify({"error": "not found or unauthorized"}), 404
     
+    tx_cache.invalidate(session["user_id"])
+    invalidate_limit_counters(session["user_id"])
+    delete_transaction_receipts(session["user_id"], [obj_id])
     return jsonify({"success": True, "message": "Transaction deleted successfully"}), 200
 
 
@@ -804,35 +1841,20 @@ def limits_page():
         user_id = session["user_id"]
         print(f"User ID: {user_id}")
         
-        # Fetch limit with error handling
+        # Fetch limits with error handling
         try:
-            limit = limits_col.find_one({"user_id": user_id})
-            print(f"Limit found: {limit}")
-            
-            # Convert ObjectId to string for JSON serialization and ensure proper structure
-            if limit:
-                if "_id" in limit:
-                    limit["_id"] = str(limit["_id"])
-                if "user_id" in limit:
-                    limit["user_id"] = str(limit["user_id"])
-                # Ensure limit and period fields exist with defaults
-                if "limit" not in limit:
-                    limit["limit"] = 0.0
-                if "period" not in limit:
-                    limit["period"] = "monthly"
-                # Convert limit to float if it's not already
-                try:
-                    limit["limit"] = float(limit["limit"])
-                except (ValueError, TypeError):
-                    limit["limit"] = 0.0
+            limits = limits_with_status(user_id)
+            limit = overall_limit(limits)
+            print(f"Limits found: {len(limits)}")
         except Exception as e:
             print(f"Database error in limits_page: {str(e)}")
             print(traceback.format_exc())
+            limits = []
             limit = None
         
         print("Rendering limits.html template...")
         try:
-            result = render_template("limits.html", limit=limit)
+            result = render_template("limits.html", limit=limit, limits=limits, periods=LIMIT_PERIODS)
             print("Template rendered successfully")
             return result
         except Exception as template_error:
@@ -870,64 +1892,612 @@ def limits_page():
         return redirect(url_for("dashboard"))
 
 
-# ✅ Get current user's limit
+# Limits are per (category, period); category None is the overall limit.
+# Spend is tracked per limit scope and period in ``limit_counters``: creating
+# an expense $incs the counters of the limits it counts toward and compares
+# the before/after spend with the alert thresholds, so enforcement never
+# scans history. A counter missing for a period (new limit, first expense of
+# the period, or dropped after a delete/edit) is seeded once from history.
+LIMIT_PERIODS = ("daily", "weekly", "monthly", "yearly")
+LIMIT_ALERT_THRESHOLDS = [int(t) for t in os.getenv("LIMIT_ALERT_THRESHOLDS", "80,100").split(",") if t.strip()]
+# Counters outlive their period by this long so "last month" stays cheap to show
+LIMIT_COUNTER_RETENTION_DAYS = int(os.getenv("LIMIT_COUNTER_RETENTION_DAYS", 40))
+# A seed lists the expenses it counted that were created this recently, so
+# their own (possibly still pending) charge skips the counter
+LIMIT_SEED_WINDOW_SECONDS = int(os.getenv("LIMIT_SEED_WINDOW_SECONDS", 300))
+
+
+def period_bounds(period, when):
+    """[start, end) datetimes of the ``period`` containing ``when``."""
+    day = datetime(when.year, when.month, when.day)
+    if period == "daily":
+        return day, day + timedelta(days=1)
+    if period == "weekly":
+        start = day - timedelta(days=day.weekday())
+        return start, start + timedelta(days=7)
+    if period == "yearly":
+        return day.replace(month=1, day=1), day.replace(year=day.year + 1, month=1, day=1)
+    start = day.replace(day=1)
+    end = start.replace(year=start.year + 1, month=1) if start.month == 12 else start.replace(month=start.month + 1)
+    return start, end
+
+
+def limit_minor(limit):
+    """Limit amount in paise (limits saved before paise were stored keep a float ``limit``)."""
+    if limit.get("limit_minor") is not None:
+        return int(limit["limit_minor"])
+    try:
+        return to_minor(limit.get("limit") or 0)
+    except (InvalidOperation, ValueError, TypeError):
+        return 0
+
+
+def counter_key(user_id, category, period, start):
+    return f"{user_id}:{category or '*'}:{period}:{start:%Y-%m-%d}"
+
+
+def seed_limit_counter(user_id, category, period, start, end, members=None):
+    """Create a period counter from history (hot + archived expenses), if missing.
+
+    Idempotent with concurrent charges: the seed counts every committed
+    expense and records the recently created ones in ``seeded_ids``;
+    charge_limits() only $incs for expenses not in that list, so an expense
+    is counted by the seed or by its own charge, never both. Concurrent
+    seeds race on a $setOnInsert upsert and the first one wins.
+    A household counter (``user_id`` is the household key) sums ``members``.
+    """
+    key = counter_key(user_id, category, period, start)
+    if limit_counters_col.count_documents({"_id": key}, limit=1):
+        return
+    match = {"user_id": {"$in": members} if members else user_id,
+             "type": "expense", "date": {"$gte": start, "$lt": end}}
+    if category:
+        match["category_ancestors"] = category
+    # One pass sums and lists, so an expense is in both or in neither
+    recent = datetime.utcnow() - timedelta(seconds=LIMIT_SEED_WINDOW_SECONDS)
+    seed = next(merged_aggregate(match, [{"$group": {
+        "_id": None,
+        "spent": {"$sum": MINOR_AMOUNT_EXPR},
+        "recent": {"$push": {"$cond": [{"$gte": ["$created_at", recent]}, "$_id", "$$REMOVE"]}}
+    }}]), {"spent": 0, "recent": []})
+    try:
+        limit_counters_col.update_one({"_id": key}, {"$setOnInsert": {
+            "user_id": user_id,
+            "category": category,
+            "period": period,
+            "period_start": start,
+            "spent_minor": seed["spent"],
+            "seeded_ids": seed["recent"],
+            "expire_at": end + timedelta(days=LIMIT_COUNTER_RETENTION_DAYS)
+        }}, upsert=True)
+    except DuplicateKeyError:
+        pass  # seeded concurrently
+
+
+def charge_limits(tx):
+    """Add an expense to the counters of the limits it counts toward.
+
+    Returns alerts for thresholds this expense crossed (highest per limit).
+    """
+    user_id, amount = tx["user_id"], tx_minor(tx)
+    alerts = []
+    # A category limit also covers the category's subtree
+    scopes = [None] + list(tx.get("category_ancestors") or [])
+    # The spender's own limits plus those of every household they belong to
+    members = {household_key(h["_id"]): h["members"] for h in user_households(user_id)}
+    for limit in limits_col.find({"user_id": {"$in": [user_id] + list(members)}, "category": {"$in": scopes}}):
+        owner = limit["user_id"]
+        period = limit.get("period") or "monthly"
+        scope = limit.get("category") or None
+        start, end = period_bounds(period, tx["date"])
+        key = counter_key(owner, scope, period, start)
+        charge = {"_id": key, "seeded_ids": {"$ne": tx["_id"]}}
+        counter = limit_counters_col.find_one_and_update(
+            charge, {"$inc": {"spent_minor": amount}}, return_document=ReturnDocument.AFTER
+        )
+        if counter is None:
+            seed_limit_counter(owner, scope, period, start, end, members=members.get(owner))
+            counter = limit_counters_col.find_one_and_update(
+                charge, {"$inc": {"spent_minor": amount}}, return_document=ReturnDocument.AFTER
+            )
+        if counter is None:
+            # The seed already counted this expense
+            counter = limit_counters_col.find_one({"_id": key})
+        if counter is None:
+            continue
+        cap = limit_minor(limit)
+        after = counter["spent_minor"]
+        before = after - amount
+        crossed = [t for t in LIMIT_ALERT_THRESHOLDS if before * 100 < cap * t <= after * 100]
+        if cap > 0 and crossed:
+            alerts.append({
+                "limit_id": str(limit["_id"]),
+                "household_id": owner[len(HOUSEHOLD_KEY_PREFIX):] if owner in members else None,
+                "category": limit.get("category_name") or scope,
+                "period": period,
+                "threshold": max(crossed),
+                "limit": to_major(cap),
+                "spent": to_major(after),
+                "exceeded": after > cap
+            })
+    return alerts
+
+
+def invalidate_limit_counters(user_id):
+    """Drop a user's counters (and their households') after a delete or edit; they are re-seeded on next use."""
+    owners = [user_id] + [household_key(h["_id"]) for h in user_households(user_id)]
+    limit_counters_col.delete_many({"user_id": {"$in": owners}})
+
+
+def limits_with_status(user_id, today=None, members=None):
+    """The limits of ``user_id`` (a user or household key) with current-period spend, overall limits first."""
+    now = today or datetime.utcnow()
+    limits = list(limits_col.find({"user_id": user_id}))
+    keys = {}
+    for limit in limits:
+        period = limit.get("period") or "monthly"
+        start, end = period_bounds(period, now)
+        keys[limit["_id"]] = (counter_key(user_id, limit.get("category"), period, start), period, start, end)
+    counters = {c["_id"]: c["spent_minor"] for c in limit_counters_col.find({"_id": {"$in": [k[0] for k in keys.values()]}})}
+    for limit in limits:
+        key, period, start, end = keys[limit["_id"]]
+        if key not in counters:
+            seed_limit_counter(user_id, limit.get("category"), period, start, end, members=members)
+            counters[key] = (limit_counters_col.find_one({"_id": key}) or {}).get("spent_minor", 0)
+        cap = limit_minor(limit)
+        limit["_id"] = str(limit["_id"])
+        limit["category"] = limit.get("category") or None
+        limit["period"] = period
+        limit["limit_minor"] = cap
+        limit["limit"] = to_major(cap)
+        limit["spent"] = to_major(counters[key])
+        limit["percent"] = round(counters[key] * 100 / cap, 1) if cap else 0.0
+        limit["period_start"] = start.strftime("%Y-%m-%d")
+        limit["period_end"] = (end - timedelta(days=1)).strftime("%Y-%m-%d")
+    limits.sort(key=lambda l: (l["category"] is not None, l["category"] or "", LIMIT_PERIODS.index(l["period"]) if l["period"] in LIMIT_PERIODS else 99))
+    return limits
+
+
+def overall_limit(limits):
+    """The limit the single-limit views show: overall monthly if set, else any overall one."""
+    overall = [l for l in limits if l["category"] is None]
+    return next((l for l in overall if l["period"] == "monthly"), overall[0] if overall else None)
+
+
+# ✅ Get current user's limits
 @app.route("/api/limits", methods=["GET"])
 def api_get_limit():
     if "user_id" not in session:
         return jsonify({"error": "auth required"}), 403
 
-    limit = limits_col.find_one({"user_id": session["user_id"]})
-    if not limit:
-        return jsonify({"message": "No limit set yet"}), 200
+    limits = limits_with_status(session["user_id"])
+    if not limits:
+        return jsonify({"message": "No limit set yet", "limits": []}), 200
 
-    limit["_id"] = str(limit["_id"])
-    return jsonify({"success": True, "limit": limit}), 200
+    return jsonify({"success": True, "limit": overall_limit(limits), "limits": limits}), 200
 
 
-# ✅ Create or Update Limit
-@app.route("/api/limits", methods=["POST", "PUT"])
-def api_set_limit():
-    if "user_id" not in session:
-        return jsonify({"error": "auth required"}), 403
-    
-    data = json_or_form(request)
+def parse_limit_input(data):
+    """(amount in paise, period, error) from a limit form or JSON body."""
     try:
-        limit_amount = float(data.get("limit", 0))
+        amount_minor = to_minor(data.get("limit", 0))
     except Exception:
-        return jsonify({"error": "invalid limit"}), 400
+        return None, None, "invalid limit"
+    if amount_minor <= 0:
+        return None, None, "limit must be positive"
+    period = data.get("period") or "monthly"
+    if period not in LIMIT_PERIODS:
+        return None, None, f"period must be one of {', '.join(LIMIT_PERIODS)}"
+    return amount_minor, period, None
+
+
+def upsert_limit(owner, category, period, amount_minor):
+    """Create or update ``owner``'s limit for (category, period); returns (limit, created)."""
+    # Limits are keyed by normalized category path and cover its subtree. Paths
+    # don't depend on whose tree they are in, so a household limit (spanning
+    # every member's tree) only normalizes the path and creates no nodes.
+    if owner == session["user_id"]:
+        resolved = resolve_category(owner, category)
+    else:
+        resolved = category_fields(category_segments(category))
 
+    scope = {"user_id": owner, "category": resolved["category_path"], "period": period}
     doc = {
-        "user_id": session["user_id"],
-        "limit": limit_amount,
-        "period": data.get("period", "monthly"),
+        "category_name": resolved["category"],
+        "limit_minor": amount_minor,
+        "limit": to_major(amount_minor),
         "updated_at": datetime.utcnow()
     }
 
-    existing = limits_col.find_one({"user_id": session["user_id"]})
-    if existing:
-        limits_col.update_one({"user_id": session["user_id"]}, {"$set": doc})
-        message = "Limit updated successfully"
-        doc["_id"] = str(existing["_id"])
-    else:
-        res = limits_col.insert_one(doc)
-        message = "Limit set successfully"
-        doc["_id"] = str(res.inserted_id)
-    
-    return jsonify({"success": True, "message": message, "limit": doc}), 200
+    # Single upsert; the _id we offer only sticks if the document is new
+    new_id = ObjectId()
+    try:
+        saved = limits_col.find_one_and_update(
+            scope,
+            {"$set": doc, "$setOnInsert": {"_id": new_id}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+    except DuplicateKeyError:
+        # Lost an upsert race with a concurrent request; the retry is a plain update
+        saved = limits_col.find_one_and_update(
+            scope,
+            {"$set": doc},
+            return_document=ReturnDocument.AFTER
+        )
+    return saved, saved["_id"] == new_id
 
-# ✅ DELETE: Remove user's limit
-@app.route("/api/limits", methods=["DELETE"])
-def api_delete_limit():
-    if "user_id" not in session:
-        return jsonify({"error": "auth required"}), 403
+
+# ✅ Create or Update a Limit (one per category + period)
+@app.route("/api/limits", methods=["POST", "PUT"])
+def api_set_limit():
+    if "user_id" not in session:
+        return jsonify({"error": "auth required"}), 403
+    
+    data = json_or_form(request)
+    amount_minor, period, error = parse_limit_input(data)
+    if error:
+        return jsonify({"error": error}), 400
+    saved, created = upsert_limit(session["user_id"], data.get("category"), period, amount_minor)
+    message = "Limit set successfully" if created else "Limit updated successfully"
+    saved["_id"] = str(saved["_id"])
+    
+    return jsonify({"success": True, "message": message, "limit": saved}), 200
+
+# ✅ DELETE: Remove the user's overall limits (or ?category=&period= ones)
+@app.route("/api/limits", methods=["DELETE"])
+def api_delete_limit():
+    if "user_id" not in session:
+        return jsonify({"error": "auth required"}), 403
     
-    result = limits_col.delete_one({"user_id": session["user_id"]})
+    query = {"user_id": session["user_id"], "category": category_path(request.args.get("category"))}
+    if request.args.get("period"):
+        query["period"] = request.args["period"]
+    result = limits_col.delete_many(query)
     
     if result.deleted_count == 0:
         return jsonify({"message": "No limit found to delete"}), 404
     
     return jsonify({"success": True, "message": "Limit deleted successfully"}), 200
 
+# ✅ DELETE: Remove one limit by id
+@app.route("/api/limits/<limit_id>", methods=["DELETE"])
+def api_delete_limit_by_id(limit_id):
+    if "user_id" not in session:
+        return jsonify({"error": "auth required"}), 403
+    try:
+        obj_id = ObjectId(limit_id)
+    except Exception:
+        return jsonify({"error": "invalid id"}), 400
+
+    result = limits_col.delete_one({"_id": obj_id, "user_id": session["user_id"]})
+    if result.deleted_count == 0:
+        return jsonify({"error": "not found or unauthorized"}), 404
+
+    return jsonify({"success": True, "message": "Limit deleted successfully"}), 200
+
+
+# -------------------- HOUSEHOLDS (shared budgets) --------------------
+# A household is a named group of users whose dashboards, summaries and
+# limits are combined. Shared views query all members at once with
+# ``user_id: {"$in": members}`` (every transaction index leads with user_id),
+# so they cost the same number of round trips as a single-user view. Household
+# limits live in ``limits`` under the household key "household:<id>" and get
+# their own counters, charged by every member's expenses. Membership is read
+# once per request and reused for every access check and limit lookup.
+# Adding someone only invites them (``invited``); they join ``members`` when
+# they accept, and every shared query reads ``members`` alone, so nobody's
+# data is visible to a household they have not agreed to join.
+HOUSEHOLD_KEY_PREFIX = "household:"
+HOUSEHOLD_MAX_MEMBERS = int(os.getenv("HOUSEHOLD_MAX_MEMBERS", 8))
+
+
+def household_key(household_id):
+    return f"{HOUSEHOLD_KEY_PREFIX}{household_id}"
+
+
+def user_households(user_id):
+    """Households ``user_id`` belongs to, loaded once per request."""
+    cache = g.setdefault("households", {}) if has_request_context() else {}
+    if user_id not in cache:
+        cache[user_id] = list(households_col.find({"members": user_id}))
+    return cache[user_id]
+
+
+def limit_owners(user_ids):
+    """Owners of the limit counters these users' spending feeds: the users and their households."""
+    user_ids = list(user_ids)
+    return user_ids + [household_key(h["_id"]) for h in households_col.find({"members": {"$in": user_ids}}, {"_id": 1})]
+
+
+def current_household(household_id):
+    """The household if the logged-in user is a member, else None."""
+    return next((h for h in user_households(session["user_id"]) if str(h["_id"]) == household_id), None)
+
+
+def membership_changed(household_id):
+    """Forget cached membership and the household's counters (they summed the old members)."""
+    g.pop("households", None)
+    limit_counters_col.delete_many({"user_id": household_key(household_id)})
+
+
+def serialize_household(h):
+    data = {
+        "_id": str(h["_id"]),
+        "name": h.get("name"),
+        "owner_id": h.get("owner_id"),
+        "members": [{"user_id": m, "name": h.get("member_names", {}).get(m, "")} for m in h["members"]],
+        "created_at": h["created_at"].isoformat() + "Z" if h.get("created_at") else None
+    }
+    if has_request_context() and session.get("user_id") == h.get("owner_id"):
+        data["invited"] = h.get("invited", [])
+    return data
+
+
+def household_summary(household):
+    """Household totals, per-member split and category spending in one pipeline."""
+    members = household["members"]
+    facets = next(merged_aggregate({"user_id": {"$in": members}}, [
+        {"$project": {"user_id": 1, "type": 1, "amount": MINOR_AMOUNT_EXPR,
+                      "path": _ROLLUP_PATH_EXPR, "category": 1}},
+        {"$facet": {
+            "members": [{"$group": {"_id": {"user_id": "$user_id", "type": "$type"},
+                                    "total": {"$sum": "$amount"}, "count": {"$sum": 1}}}],
+            # Members' spellings of a category meet on its normalized path
+            "categories": [
+                {"$match": {"type": "expense"}},
+                {"$group": {"_id": "$path", "name": {"$first": "$category"}, "total": {"$sum": "$amount"}}},
+                {"$sort": {"total": -1}}
+            ]
+        }}
+    ]), {"members": [], "categories": []})
+
+    names = household.get("member_names", {})
+    split = {m: {"user_id": m, "name": names.get(m, ""), "income": 0, "expense": 0, "count": 0} for m in members}
+    totals = {"income": 0, "expense": 0, "count": 0}
+    for row in facets["members"]:
+        member = split.get(row["_id"]["user_id"])
+        kind = row["_id"].get("type")
+        if member is None:
+            continue
+        member["count"] += row["count"]
+        totals["count"] += row["count"]
+        if kind in ("income", "expense"):
+            member[kind] += row["total"]
+            totals[kind] += row["total"]
+    for member in split.values():
+        member["income"], member["expense"] = to_major(member["income"]), to_major(member["expense"])
+    return {
+        "total_income": to_major(totals["income"]),
+        "total_expense": to_major(totals["expense"]),
+        "balance": to_major(totals["income"] - totals["expense"]),
+        "transactions_count": totals["count"],
+        "category_spending": {(row["name"] or row["_id"] or "Other"): to_major(row["total"])
+                              for row in facets["categories"]},
+        "members": list(split.values())
+    }
+
+
+# ✅ Households the current user belongs to
+@app.route("/api/households", methods=["GET"])
+def api_get_households():
+    if "user_id" not in session:
+        return jsonify({"error": "auth required"}), 403
+    return jsonify({"success": True, "households": [serialize_household(h) for h in user_households(session["user_id"])]}), 200
+
+
+# ✅ Create a household (the creator is its owner and first member)
+@app.route("/api/households", methods=["POST"])
+def api_create_household():
+    if "user_id" not in session:
+        return jsonify({"error": "auth required"}), 403
+    name = (json_or_form(request).get("name") or "").strip()
+    if not name:
+        return jsonify({"error": "name is required"}), 400
+    user_id = session["user_id"]
+    household = {
+        "name": name[:100],
+        "owner_id": user_id,
+        "members": [user_id],
+        "invited": [],
+        "member_names": {user_id: session.get("user_name", "")},
+        "created_at": datetime.utcnow()
+    }
+    households_col.insert_one(household)
+    g.pop("households", None)
+    return jsonify({"success": True, "household": serialize_household(household)}), 201
+
+
+# ✅ Invite a member by email (owner only); they join once they accept
+@app.route("/api/households/<household_id>/members", methods=["POST"])
+def api_add_household_member(household_id):
+    if "user_id" not in session:
+        return jsonify({"error": "auth required"}), 403
+    household = current_household(household_id)
+    if not household or household["owner_id"] != session["user_id"]:
+        return jsonify({"error": "not found or unauthorized"}), 404
+    email = (json_or_form(request).get("email") or "").strip()
+    user = users_col.find_one({"email": email}, {"name": 1}) if email else None
+    if not user:
+        return jsonify({"error": "no user with that email"}), 404
+    member_id = str(user["_id"])
+    if member_id in household["members"] or member_id in household.get("invited", []):
+        return jsonify({"error": "already a member or invited"}), 400
+
+    # Pending invitations hold a seat, so accepting can never overfill the household
+    result = households_col.update_one(
+        {"_id": household["_id"], "$expr": {"$lt": [
+            {"$add": [{"$size": "$members"}, {"$size": {"$ifNull": ["$invited", []]}}]}, HOUSEHOLD_MAX_MEMBERS
+        ]}},
+        {"$addToSet": {"invited": member_id}}
+    )
+    if result.modified_count == 0:
+        return jsonify({"error": f"a household has at most {HOUSEHOLD_MAX_MEMBERS} members"}), 400
+    g.pop("households", None)
+    return jsonify({"success": True, "message": "Invitation sent",
+                    "household": serialize_household(households_col.find_one({"_id": household["_id"]}))}), 200
+
+
+# ✅ Households the current user has been invited to (name and owner only)
+@app.route("/api/households/invitations", methods=["GET"])
+def api_household_invitations():
+    if "user_id" not in session:
+        return jsonify({"error": "auth required"}), 403
+    invitations = households_col.find({"invited": session["user_id"]}, {"name": 1, "owner_id": 1, "member_names": 1})
+    return jsonify({"success": True, "invitations": [{
+        "_id": str(h["_id"]),
+        "name": h.get("name"),
+        "owner_name": h.get("member_names", {}).get(h.get("owner_id"), "")
+    } for h in invitations]}), 200
+
+
+# ✅ Accept or decline an invitation
+@app.route("/api/households/<household_id>/invitation", methods=["POST", "DELETE"])
+def api_answer_household_invitation(household_id):
+    if "user_id" not in session:
+        return jsonify({"error": "auth required"}), 403
+    try:
+        obj_id = ObjectId(household_id)
+    except Exception:
+        return jsonify({"error": "invalid id"}), 400
+    user_id = session["user_id"]
+    if request.method == "DELETE":
+        update = {"$pull": {"invited": user_id}}
+    else:
+        update = {"$pull": {"invited": user_id}, "$addToSet": {"members": user_id},
+                  "$set": {f"member_names.{user_id}": session.get("user_name", "")}}
+    result = households_col.update_one({"_id": obj_id, "invited": user_id}, update)
+    if result.modified_count == 0:
+        return jsonify({"error": "no such invitation"}), 404
+    if request.method == "DELETE":
+        return jsonify({"success": True, "message": "Invitation declined"}), 200
+    membership_changed(household_id)
+    return jsonify({"success": True, "household": serialize_household(households_col.find_one({"_id": obj_id}))}), 200
+
+
+# ✅ Remove a member or cancel an invitation (the owner removes anyone else; members can leave)
+@app.route("/api/households/<household_id>/members/<member_id>", methods=["DELETE"])
+def api_remove_household_member(household_id, member_id):
+    if "user_id" not in session:
+        return jsonify({"error": "auth required"}), 403
+    household = current_household(household_id)
+    if household and household["owner_id"] == session["user_id"] and member_id in household.get("invited", []):
+        households_col.update_one({"_id": household["_id"]}, {"$pull": {"invited": member_id}})
+        return jsonify({"success": True, "message": "Invitation cancelled"}), 200
+    if not household or member_id not in household["members"]:
+        return jsonify({"error": "not found or unauthorized"}), 404
+    if session["user_id"] not in (household["owner_id"], member_id):
+        return jsonify({"error": "only the owner can remove other members"}), 403
+    if member_id == household["owner_id"]:
+        return jsonify({"error": "the owner cannot leave; delete the household instead"}), 400
+    households_col.update_one({"_id": household["_id"]},
+                              {"$pull": {"members": member_id}, "$unset": {f"member_names.{member_id}": ""}})
+    membership_changed(household_id)
+    return jsonify({"success": True, "message": "Member removed"}), 200
+
+
+# ✅ Delete a household and its limits (owner only)
+@app.route("/api/households/<household_id>", methods=["DELETE"])
+def api_delete_household(household_id):
+    if "user_id" not in session:
+        return jsonify({"error": "auth required"}), 403
+    household = current_household(household_id)
+    if not household or household["owner_id"] != session["user_id"]:
+        return jsonify({"error": "not found or unauthorized"}), 404
+    households_col.delete_one({"_id": household["_id"]})
+    limits_col.delete_many({"user_id": household_key(household_id)})
+    membership_changed(household_id)
+    return jsonify({"success": True, "message": "Household deleted"}), 200
+
+
+# ✅ Combined dashboard: totals, member split, category spend, recent activity, limits
+@app.route("/api/households/<household_id>/dashboard", methods=["GET"])
+@query_budget(max_queries=8)
+@shed_load("dashboard")
+def api_household_dashboard(household_id):
+    if "user_id" not in session:
+        return jsonify({"error": "auth required"}), 403
+    household = current_household(household_id)
+    if not household:
+        return jsonify({"error": "not found or unauthorized"}), 404
+
+    try:
+        names = household.get("member_names", {})
+        recent = find_transactions({"user_id": {"$in": household["members"]}}, limit=10)
+        for t in recent:
+            t["member"] = names.get(t.get("user_id"), "")
+            serialize_tx(t)
+        limits = limits_with_status(household_key(household_id), members=household["members"])
+        data = dict(household_summary(household), recent_transactions=recent,
+                    limit=overall_limit(limits), limits=limits)
+    except Exception as e:
+        print(f"Error in api_household_dashboard: {str(e)}")
+        print(traceback.format_exc())
+        return jsonify({"error": "Failed to load household dashboard"}), 500
+    return jsonify({"success": True, "household": serialize_household(household), "data": data}), 200
+
+
+# ✅ Combined visualization summary (same shape as /api/visualization/summary)
+@app.route("/api/households/<household_id>/visualization/summary", methods=["GET"])
+@query_budget(max_queries=4)
+@shed_load("analytics")
+def api_household_visualization_summary(household_id):
+    if "user_id" not in session:
+        return jsonify({"error": "auth required"}), 403
+    household = current_household(household_id)
+    if not household:
+        return jsonify({"error": "not found or unauthorized"}), 404
+    return jsonify({
+        "success": True,
+        "summary": visualization_summary({"$in": household["members"]})
+    }), 200
+
+
+# ✅ Household limits with combined spend
+@app.route("/api/households/<household_id>/limits", methods=["GET"])
+def api_get_household_limits(household_id):
+    if "user_id" not in session:
+        return jsonify({"error": "auth required"}), 403
+    household = current_household(household_id)
+    if not household:
+        return jsonify({"error": "not found or unauthorized"}), 404
+    limits = limits_with_status(household_key(household_id), members=household["members"])
+    return jsonify({"success": True, "limit": overall_limit(limits), "limits": limits}), 200
+
+
+# ✅ Create or update a household limit (any member)
+@app.route("/api/households/<household_id>/limits", methods=["POST", "PUT"])
+def api_set_household_limit(household_id):
+    if "user_id" not in session:
+        return jsonify({"error": "auth required"}), 403
+    if not current_household(household_id):
+        return jsonify({"error": "not found or unauthorized"}), 404
+    data = json_or_form(request)
+    amount_minor, period, error = parse_limit_input(data)
+    if error:
+        return jsonify({"error": error}), 400
+    saved, created = upsert_limit(household_key(household_id), data.get("category"), period, amount_minor)
+    saved["_id"] = str(saved["_id"])
+    message = "Limit set successfully" if created else "Limit updated successfully"
+    return jsonify({"success": True, "message": message, "limit": saved}), 200
+
+
+# ✅ Delete a household limit
+@app.route("/api/households/<household_id>/limits/<limit_id>", methods=["DELETE"])
+def api_delete_household_limit(household_id, limit_id):
+    if "user_id" not in session:
+        return jsonify({"error": "auth required"}), 403
+    if not current_household(household_id):
+        return jsonify({"error": "not found or unauthorized"}), 404
+    try:
+        obj_id = ObjectId(limit_id)
+    except Exception:
+        return jsonify({"error": "invalid id"}), 400
+    result = limits_col.delete_one({"_id": obj_id, "user_id": household_key(household_id)})
+    if result.deleted_count == 0:
+        return jsonify({"error": "not found"}), 404
+    return jsonify({"success": True, "message": "Limit deleted successfully"}), 200
+
 
 # -------------------- SUBSCRIPTIONS --------------------
 @app.route("/subscriptions")
@@ -974,7 +2544,9 @@ def api_create_subscription():
     except Exception:
         return jsonify({"error": "invalid amount"}), 400
 
-    next_payment_date = data.get("next_payment_date") or data.get("end_date")
+    payment = payment_date_fields(data.get("next_payment_date") or data.get("end_date"))
+    if payment is None:
+        return jsonify({"error": "invalid next_payment_date"}), 400
 
     sub = {
         "user_id": session["user_id"],
@@ -983,12 +2555,14 @@ def api_create_subscription():
         "cycle": data.get("cycle", "monthly"),
         "start_date": data.get("start_date") or datetime.utcnow().isoformat(),
         "end_date": data.get("end_date"),
-        "next_payment_date": next_payment_date,
+        **payment,
         "notes": data.get("notes", ""),
         "created_at": datetime.utcnow()
     }
 
-    res = subscriptions_col.insert_one(sub)
+    with sync_change(sub["user_id"]) as version:
+        sub["sync_version"] = version
+        res = subscriptions_col.insert_one(sub)
     sub["_id"] = str(res.inserted_id)
 
     return jsonify({
@@ -1027,23 +2601,30 @@ def api_update_subscription(sub_id):
     data = json_or_form(request)
     update_fields = {}
 
-    for field in ["name", "amount", "cycle", "start_date", "end_date", "next_payment_date", "notes"]:
+    for field in ["name", "amount", "cycle", "start_date", "end_date", "notes"]:
         if field in data:
             update_fields[field] = data[field]
+    if "next_payment_date" in data:
+        payment = payment_date_fields(data["next_payment_date"])
+        if payment is None:
+            return jsonify({"error": "invalid next_payment_date"}), 400
+        update_fields.update(payment)
 
     if not update_fields:
         return jsonify({"error": "no valid fields to update"}), 400
 
     update_fields["updated_at"] = datetime.utcnow()
-    result = subscriptions_col.update_one(
-        {"_id": obj_id, "user_id": session["user_id"]},
-        {"$set": update_fields}
-    )
+    with sync_change(session["user_id"]) as version:
+        update_fields["sync_version"] = version
+        updated_sub = subscriptions_col.find_one_and_update(
+            {"_id": obj_id, "user_id": session["user_id"]},
+            {"$set": update_fields},
+            return_document=ReturnDocument.AFTER
+        )
 
-    if result.matched_count == 0:
+    if updated_sub is None:
         return jsonify({"error": "subscription not found"}), 404
 
-    updated_sub = subscriptions_col.find_one({"_id": obj_id})
     updated_sub["_id"] = str(updated_sub["_id"])
 
     return jsonify({
@@ -1063,7 +2644,10 @@ def api_delete_subscription(sub_id):
     except Exception:
         return jsonify({"error": "invalid id"}), 400
 
-    result = subscriptions_col.delete_one({"_id": obj_id, "user_id": session["user_id"]})
+    with sync_change(session["user_id"]) as version:
+        result = subscriptions_col.delete_one({"_id": obj_id, "user_id": session["user_id"]})
+        if result.deleted_count:
+            record_deletions(session["user_id"], "subscriptions", [obj_id], version)
 
     if result.deleted_count == 0:
         return jsonify({"error": "not found"}), 404
@@ -1072,6 +2656,164 @@ def api_delete_subscription(sub_id):
 
 
 
+# -------------------- BATCH ACTIONS (multi-select) --------------------
+BATCH_MAX_IDS = 500
+
+# kind -> (collection, extra filter, fields a batch update may set)
+BATCH_KINDS = {
+    "transactions": (transactions_col, {}, {"category", "tags", "source", "payee", "note"}),
+    "income": (transactions_col, {"type": "income"}, {"source", "tags", "note"}),
+    "expense": (transactions_col, {"type": "expense"}, {"category", "tags", "payee", "note"}),
+    "cards": (cards_col, {}, {"cardholder"}),
+    "subscriptions": (subscriptions_col, {}, {"cycle", "notes"}),
+}
+
+
+def parse_batch_ids(data):
+    """Split submitted ids into (ObjectIds to act on, per-id results for invalid ones)."""
+    ids = data.get("ids") if isinstance(data, dict) else None
+    if not isinstance(ids, list) or not ids:
+        return None, None, "ids must be a non-empty list"
+    if len(ids) > BATCH_MAX_IDS:
+        return None, None, f"at most {BATCH_MAX_IDS} ids per batch"
+    valid, results = [], {}
+    for raw in ids:
+        try:
+            valid.append(ObjectId(str(raw)))
+        except (InvalidId, TypeError):
+            results[str(raw)] = "invalid_id"
+    return valid, results, None
+
+
+def owned_ids(col, ids, extra_filter, projection=None):
+    """Documents among ``ids`` that belong to the current user (one query)."""
+    query = {"_id": {"$in": ids}, "user_id": session["user_id"], **extra_filter}
+    return list(col.find(query, projection or {"_id": 1}, session=db_session()))
+
+
+@app.route("/api/<kind>/batch-delete", methods=["POST"])
+@query_budget(max_queries=4)
+def api_batch_delete(kind):
+    """Delete many of the user's documents in one delete_many; per-id results."""
+    if "user_id" not in session:
+        return jsonify({"error": "auth required"}), 403
+    if kind not in BATCH_KINDS:
+        abort(404)
+    col, extra_filter, _ = BATCH_KINDS[kind]
+
+    ids, results, error = parse_batch_ids(json_or_form(request))
+    if error:
+        return jsonify({"error": error}), 400
+
+    is_tx = col is transactions_col
+    owned_docs = owned_ids(col, ids, extra_filter, LEDGER_FIELDS if is_tx else None)
+    owned = [d["_id"] for d in owned_docs]
+    deleted_count = 0
+    owned_set = set(owned)
+    archived = {}
+
+    def delete(s):
+        # Deletes, tombstones and ledger events commit together
+        count = 0
+        if owned:
+            count = col.delete_many(
+                {"_id": {"$in": owned}, "user_id": session["user_id"], **extra_filter}, session=s
+            ).deleted_count
+        archived.clear()
+        if is_tx:
+            # Ids not in the hot collection may live in an archive bucket
+            missing = [oid for oid in ids if oid not in owned_set]
+            if missing:
+                archived.update(delete_archived_many(session["user_id"], missing, extra_filter.get("type"), s))
+            count += len(archived)
+        gone = owned_set | set(archived)
+        if gone:
+            record_deletions(session["user_id"], col.name, gone, version, s)
+        if is_tx:
+            append_ledger([ledger_event(session["user_id"], "delete", d, version)
+                           for d in owned_docs + list(archived.values())], session=s)
+        return count
+
+    with sync_change(session["user_id"]) as version:
+        deleted_count = in_transaction(delete)
+        owned_set.update(archived)
+    for oid in ids:
+        results[str(oid)] = "deleted" if oid in owned_set else "not_found"
+
+    # Derived data is refreshed once for the whole batch
+    if is_tx and deleted_count:
+        tx_cache.invalidate(session["user_id"])
+        invalidate_limit_counters(session["user_id"])
+        delete_transaction_receipts(session["user_id"], owned_set)
+
+    return jsonify({
+        "success": True,
+        "deleted_count": deleted_count,
+        "results": results
+    }), 200
+
+
+@app.route("/api/<kind>/batch-update", methods=["POST"])
+def api_batch_update(kind):
+    """Set the same whitelisted fields on many of the user's documents in one bulk_write."""
+    if "user_id" not in session:
+        return jsonify({"error": "auth required"}), 403
+    if kind not in BATCH_KINDS:
+        abort(404)
+    col, extra_filter, allowed = BATCH_KINDS[kind]
+
+    data = json_or_form(request)
+    ids, results, error = parse_batch_ids(data)
+    if error:
+        return jsonify({"error": error}), 400
+    changes = data.get("set")
+    if not isinstance(changes, dict) or not changes:
+        return jsonify({"error": "set must be an object of fields to update"}), 400
+    bad = sorted(set(changes) - allowed)
+    if bad:
+        return jsonify({"error": f"fields not allowed: {', '.join(bad)}"}), 400
+    changes = {**changes, "updated_at": datetime.utcnow()}
+
+    is_tx = col is transactions_col
+    if is_tx and "category" in changes:
+        changes.update(resolve_category(session["user_id"], changes["category"]))
+    if is_tx and "tags" in changes:
+        changes["tags"] = normalize_tags(changes["tags"])
+    docs = owned_ids(col, ids, extra_filter, {**LEDGER_FIELDS, **{f: 1 for f in SEARCH_FIELDS}} if is_tx else None)
+    if docs:
+        with sync_change(session["user_id"]) as version:
+            ops = []
+            for d in docs:
+                fields = dict(changes, sync_version=version)
+                if is_tx:
+                    # Keep the search index in step with edited text fields
+                    fields.update(search_index_fields({**d, **changes}))
+                ops.append(UpdateOne({"_id": d["_id"], "user_id": session["user_id"]}, {"$set": fields}))
+            if is_tx:
+                edited = {k: v for k, v in changes.items() if k != "updated_at"}
+                events = [ledger_event(session["user_id"], "update", d, version, edited) for d in docs]
+
+                def update(s):
+                    col.bulk_write(ops, ordered=False, session=s)
+                    append_ledger(events, session=s)
+                in_transaction(update)
+            else:
+                col.bulk_write(ops, ordered=False, session=db_session())
+    updated = {d["_id"] for d in docs}
+    for oid in ids:
+        results[str(oid)] = "updated" if oid in updated else "not_found"
+
+    if is_tx and docs:
+        tx_cache.invalidate(session["user_id"])
+        invalidate_limit_counters(session["user_id"])
+
+    return jsonify({
+        "success": True,
+        "updated_count": len(docs),
+        "results": results
+    }), 200
+
+
 # -------------------- UPCOMING SUBSCRIPTIONS (reminders) --------------------
 @app.route("/api/subscriptions/upcoming", methods=["GET"])
 def api_upcoming_subscriptions():
@@ -1098,20 +2840,7 @@ def api_upcoming_subscriptions():
             continue
 
         # Parse next payment date from various formats
-        d = None
-        for fmt in ("%Y-%m-%d", "%Y/%m/%d", "%d-%m-%Y"):
-            try:
-                d = datetime.strptime(npd, fmt).date()
-                break
-            except Exception:
-                continue
-
-        # If still not parsed, try ISO format
-        if not d:
-            try:
-                d = datetime.fromisoformat(npd).date()
-            except Exception:
-                d = None
+        d = parse_date(npd)
 
         # If valid and within reminder window
         if d and today <= d <= upper:
@@ -1129,9 +2858,1740 @@ def api_upcoming_subscriptions():
     }), 200
 
 
+# -------------------- SUBSCRIPTION CALENDAR (projection) --------------------
+# Every charge the user's subscriptions will make over the next
+# SUBSCRIPTION_HORIZON_MONTHS, expanded with vectorized date math (see
+# subcalendar.py) and kept per user until a subscription's sync_version (or
+# the day) changes. Requests for shorter horizons slice the cached expansion.
+SUBSCRIPTION_HORIZONS = (3, 6, 12)
+SUBSCRIPTION_HORIZON_MONTHS = max(SUBSCRIPTION_HORIZONS)
+calendar_cache = CalendarCache(max_entries=int(os.getenv("CALENDAR_CACHE_MAX_ENTRIES", 5000)))
+
+CALENDAR_PROJECTION = {"name": 1, "amount": 1, "cycle": 1, "end_date": 1, "next_payment_date": 1, "sync_version": 1}
+
+
+def subscription_charges(user_id, today):
+    """The user's expanded charges for the full horizon (cached); returns (charges, cached)."""
+    subs = list(subscriptions_col.find({"user_id": user_id}, CALENDAR_PROJECTION))
+    key = (today, sorted((str(s["_id"]), s.get("sync_version"), str(s.get("next_payment_date"))) for s in subs))
+    charges = calendar_cache.get(user_id, key)
+    if charges is not None:
+        return charges, True
+
+    subs = [s for s in subs if parse_date(s.get("next_payment_date"))]
+    amounts = []
+    for s in subs:
+        try:
+            amounts.append(to_minor(s.get("amount") or 0))
+        except (InvalidOperation, ValueError, TypeError):
+            amounts.append(0)
+    rows, dates, charged = expand_charges(
+        [parse_date(s["next_payment_date"]) for s in subs],
+        [s.get("cycle", "monthly") for s in subs],
+        [parse_date(s.get("end_date")) or "NaT" for s in subs],
+        amounts, today, add_months(today, SUBSCRIPTION_HORIZON_MONTHS)
+    )
+    charges = {
+        "rows": rows, "dates": dates, "amounts": charged,
+        # Running total, so any horizon's committed spend is one lookup
+        "cumulative": running_totals(charged),
+        "subs": [{"_id": str(s["_id"]), "name": s.get("name"), "cycle": s.get("cycle", "monthly")} for s in subs]
+    }
+    calendar_cache.put(user_id, key, charges)
+    return charges, False
+
+
+def committed_until(charges, until):
+    """Paise charged before ``until``."""
+    return int(charges["cumulative"][charges_before(charges["dates"], until)])
+
+
+# ✅ Upcoming charges and committed spend (?months=3|6|12, default 12)
+@app.route("/api/subscriptions/calendar", methods=["GET"])
+@query_budget(max_queries=1)
+@shed_load("analytics", stale=True)
+def api_subscription_calendar():
+    if "user_id" not in session:
+        return jsonify({"error": "auth required"}), 403
+    try:
+        months = int(request.args.get("months", SUBSCRIPTION_HORIZON_MONTHS))
+    except ValueError:
+        months = 0
+    if months not in SUBSCRIPTION_HORIZONS:
+        return jsonify({"error": f"months must be one of {', '.join(map(str, SUBSCRIPTION_HORIZONS))}"}), 400
+
+    today = date.today()
+    charges, cached = subscription_charges(session["user_id"], today)
+    until = add_months(today, months)
+    n = charges_before(charges["dates"], until)
+    dates, amounts, rows = charges["dates"][:n], charges["amounts"][:n], charges["rows"][:n]
+    (weeks, week_totals, week_counts), (month_keys, month_totals, month_counts) = group_charges(dates, amounts)
+    subs = charges["subs"]
+
+    return jsonify({
+        "success": True,
+        "as_of": today.isoformat(),
+        "months": months,
+        "total": to_major(committed_until(charges, until)),
+        "committed": {str(h): to_major(committed_until(charges, add_months(today, h))) for h in SUBSCRIPTION_HORIZONS},
+        "by_month": [{"month": str(m), "total": to_major(int(t)), "count": int(c)}
+                     for m, t, c in zip(month_keys, month_totals, month_counts)],
+        "by_week": [{"week_start": str(w), "total": to_major(int(t)), "count": int(c)}
+                    for w, t, c in zip(weeks, week_totals, week_counts)],
+        "charges": [{"date": d, "subscription_id": subs[r]["_id"], "name": subs[r]["name"],
+                     "cycle": subs[r]["cycle"], "amount": to_major(int(a))}
+                    for d, r, a in zip(dates.astype(str).tolist(), rows.tolist(), amounts.tolist())],
+        "cached": cached
+    }), 200
+
+
+# -------------------- SUBSCRIPTION RENEWALS (background) --------------------
+RENEWAL_SCHEDULER_ENABLED = os.getenv("RENEWAL_SCHEDULER_ENABLED", "True").lower() == "true"
+RENEWAL_INTERVAL_SECONDS = int(os.getenv("RENEWAL_INTERVAL_SECONDS", 300))
+RENEWAL_BATCH_SIZE = int(os.getenv("RENEWAL_BATCH_SIZE", 500))
+RENEWAL_LEASE_SECONDS = int(os.getenv("RENEWAL_LEASE_SECONDS", 120))
+RENEWAL_MAX_CYCLES = 24  # cap on missed cycles charged for a single subscription per run
+
+# Identifies this process when holding a lease (host + pid survives gunicorn forks)
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+def advance_cycle(d, cycle):
+    """Return the payment date one billing cycle after ``d``."""
+    if cycle == "weekly":
+        return d + timedelta(weeks=1)
+    months = {"monthly": 1, "quarterly": 3, "yearly": 12}.get(cycle, 1)
+    month_index = d.month - 1 + months
+    year = d.year + month_index // 12
+    month = month_index % 12 + 1
+    # Clamp e.g. Jan 31 -> Feb 28
+    day = min(d.day, calendar.monthrange(year, month)[1])
+    return date(year, month, day)
+
+
+def acquire_lease(name, seconds):
+    """Take (or extend) a named lease; returns True if this worker holds it."""
+    now = datetime.utcnow()
+    try:
+        doc = locks_col.find_one_and_update(
+            {"_id": name, "$or": [{"expires_at": {"$lt": now}}, {"owner": WORKER_ID}]},
+            {"$set": {"owner": WORKER_ID, "expires_at": now + timedelta(seconds=seconds)}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        return doc is not None and doc.get("owner") == WORKER_ID
+    except DuplicateKeyError:
+        # Another worker holds an unexpired lease
+        return False
+
+
+def release_lease(name):
+    locks_col.delete_one({"_id": name, "owner": WORKER_ID})
+
+
+def plan_renewal(sub, today):
+    """Work out the expenses owed and the new next_payment_date for one due subscription.
+
+    Returns (expense_docs, new_next_payment_date_or_None).
+    """
+    due = parse_date(sub.get("next_payment_date"))
+    if not due:
+        return [], sub.get("next_payment_date")
+
+    end = parse_date(sub.get("end_date"))
+    cycle = sub.get("cycle", "monthly")
+    try:
+        amount_minor = to_minor(sub.get("amount") or 0)
+    except (InvalidOperation, ValueError, TypeError):
+        amount_minor = 0
+
+    expenses = []
+    category = None
+    cycles = 0
+    while due <= today and cycles < RENEWAL_MAX_CYCLES:
+        if end and due > end:
+            break
+        if category is None:
+            # One lookup per subscription; creates the node for a user's first renewal
+            category = resolve_category(sub["user_id"], "Subscriptions")
+        tx = {
+            "user_id": sub["user_id"],
+            "type": "expense",
+            "amount_minor": amount_minor,
+            **category,
+            "payee": sub.get("name", ""),
+            "date": datetime(due.year, due.month, due.day),
+            "note": f"Auto-renewal: {sub.get('name', 'subscription')} ({cycle})",
+            "subscription_id": str(sub["_id"]),
+            "renewal_key": f"{sub['_id']}:{due.isoformat()}",
+            "created_at": datetime.utcnow()
+        }
+        tx.update(search_index_fields(tx))
+        expenses.append(tx)
+        due = advance_cycle(due, cycle)
+        cycles += 1
+
+    if end and due > end:
+        return expenses, None
+    return expenses, due.isoformat()
+
+
+def process_due_subscriptions(today=None):
+    """Charge and advance every subscription whose next_payment_date has passed.
+
+    Safe to run concurrently: renewal expenses carry a unique ``renewal_key``
+    and next_payment_date is advanced with a compare-and-set on its old value.
+    Returns the number of renewal expenses inserted.
+    """
+    today = today or date.today()
+    inserted = 0
+    last_id = None
+
+    while True:
+        query = {"next_payment_at": {"$lte": datetime(today.year, today.month, today.day)}}
+        if last_id is not None:
+            query["_id"] = {"$gt": last_id}
+        batch = list(subscriptions_col.find(query).sort("_id", 1).limit(RENEWAL_BATCH_SIZE))
+        if not batch:
+            break
+        last_id = batch[-1]["_id"]
+
+        planned = []
+        for sub in batch:
+            expenses, new_next = plan_renewal(sub, today)
+            if new_next != sub.get("next_payment_date"):
+                planned.append((sub, expenses, new_next))
+
+        with ExitStack() as changes:
+            # One change version per user in the batch, pending until the writes land
+            versions = {uid: changes.enter_context(sync_change(uid)) for uid in {sub["user_id"] for sub, _, _ in planned}}
+            expense_docs = []
+            updates = []
+            for sub, expenses, new_next in planned:
+                for e in expenses:
+                    e["sync_version"] = versions[sub["user_id"]]
+                expense_docs.extend(expenses)
+                updates.append(UpdateOne(
+                    {"_id": sub["_id"], "next_payment_date": sub.get("next_payment_date")},
+                    {"$set": {**payment_date_fields(new_next), "last_renewed_at": datetime.utcnow(),
+                              "sync_version": versions[sub["user_id"]]}}
+                ))
+            inserted += write_renewals(expense_docs, updates)
+
+        if len(batch) < RENEWAL_BATCH_SIZE or not acquire_lease("subscription_renewals", RENEWAL_LEASE_SECONDS):
+            break
+
+    return inserted
+
+
+def write_renewals(expense_docs, updates):
+    """Insert planned renewal expenses and advance their subscriptions; returns expenses inserted."""
+    inserted = 0
+    if expense_docs:
+        inserted = insert_logged(expense_docs)
+        # Renewals skip charge_limits(); re-seed those users' limit counters
+        limit_counters_col.delete_many({"user_id": {"$in": limit_owners({d["user_id"] for d in expense_docs})}})
+    if updates:
+        subscriptions_col.bulk_write(updates, ordered=False)
+    return inserted
+
+
+def renewal_scheduler_loop(stop_event):
+    while not stop_event.is_set():
+        try:
+            if acquire_lease("subscription_renewals", RENEWAL_LEASE_SECONDS):
+                try:
+                    count = process_due_subscriptions()
+                    if count:
+                        print(f"Subscription renewals: recorded {count} expenses")
+                finally:
+                    release_lease("subscription_renewals")
+        except Exception as e:
+            print(f"Error in subscription renewal scheduler: {str(e)}")
+            print(traceback.format_exc())
+        stop_event.wait(RENEWAL_INTERVAL_SECONDS)
+
+
+renewal_stop_event = threading.Event()
+if RENEWAL_SCHEDULER_ENABLED:
+    threading.Thread(
+        target=renewal_scheduler_loop, args=(renewal_stop_event,),
+        name="subscription-renewals", daemon=True
+    ).start()
+
+
+# -------------------- BACKGROUND MIGRATIONS --------------------
+def migrate_transactions(batch_size=1000):
+    """Move legacy transactions to integer ``amount_minor`` and datetime ``date``.
+
+    Runs online: each document is rewritten with a compare-and-set on the
+    values it was read with, so concurrent edits are never clobbered, and the
+    query itself is the resume point.
+    """
+    migrated = 0
+    legacy = {"$or": [{"amount_minor": {"$exists": False}}, {"date": {"$type": "string"}}]}
+    while True:
+        batch = list(transactions_col.find(legacy, {"amount": 1, "amount_minor": 1, "date": 1, "created_at": 1})
+                     .limit(batch_size))
+        if not batch:
+            return migrated
+        ops = []
+        for t in batch:
+            tx_date = t.get("date")
+            if not isinstance(tx_date, datetime):
+                try:
+                    tx_date = to_tx_date(tx_date) if tx_date else t.get("created_at")
+                except ValueError:
+                    tx_date = t.get("created_at")
+            ops.append(UpdateOne(
+                {"_id": t["_id"], "amount": t.get("amount"), "date": t.get("date")},
+                {"$set": {"amount_minor": tx_minor(t), "date": tx_date or datetime.utcnow()},
+                 "$unset": {"amount": ""}}
+            ))
+        result = transactions_col.bulk_write(ops, ordered=False)
+        migrated += result.modified_count
+
+
+def run_backfills():
+    """Run each resumable backfill once per process start, one worker at a time."""
+    for name, backfill in (("migrate_transactions", migrate_transactions),
+                           ("search_backfill", backfill_search_terms),
+                           ("category_backfill", normalize_categories),
+                           ("payment_date_backfill", normalize_payment_dates),
+                           ("ledger_backfill", backfill_ledger)):
+        try:
+            if not acquire_lease(name, 3600):
+                continue
+            try:
+                count = backfill(batch_size=1000)
+                if count:
+                    print(f"Backfill {name}: updated {count} transactions")
+            finally:
+                release_lease(name)
+        except Exception as e:
+            print(f"Error in backfill {name}: {str(e)}")
+            print(traceback.format_exc())
+
+
+def normalize_payment_dates(batch_size=1000):
+    """Give subscriptions written before ``next_payment_at`` their normalized dates.
+
+    Legacy strings in any format parse_date() understands become ISO plus
+    the BSON datetime; unparseable ones get ``next_payment_at: None`` and
+    are left for the user to fix. Compare-and-set on the old string.
+    """
+    updated = 0
+    while True:
+        batch = list(subscriptions_col.find(
+            {"next_payment_at": {"$exists": False}}, {"user_id": 1, "next_payment_date": 1}
+        ).limit(batch_size))
+        if not batch:
+            return updated
+        with ExitStack() as changes:
+            versions = {uid: changes.enter_context(sync_change(uid)) for uid in {s["user_id"] for s in batch}}
+            result = subscriptions_col.bulk_write([
+                UpdateOne(
+                    {"_id": s["_id"], "next_payment_date": s.get("next_payment_date"),
+                     "next_payment_at": {"$exists": False}},
+                    {"$set": {**(payment_date_fields(s.get("next_payment_date"))
+                                 or {"next_payment_at": None}),
+                              "sync_version": versions[s["user_id"]]}}
+                )
+                for s in batch
+            ], ordered=False)
+        updated += result.modified_count
+        if result.modified_count == 0:
+            return updated
+
+
+# -------------------- TRANSACTION ARCHIVE (cold storage) --------------------
+# Transactions dated before the start of the month ARCHIVE_AFTER_DAYS ago are
+# moved out of ``transactions`` into one bucket per user per month. Buckets
+# keep running income/expense totals so unfiltered totals never unwind them.
+ARCHIVE_ENABLED = os.getenv("ARCHIVE_ENABLED", "True").lower() == "true"
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", 365))
+ARCHIVE_INTERVAL_SECONDS = int(os.getenv("ARCHIVE_INTERVAL_SECONDS", 6 * 3600))
+ARCHIVE_BATCH_SIZE = int(os.getenv("ARCHIVE_BATCH_SIZE", 1000))
+ARCHIVE_LEASE_SECONDS = int(os.getenv("ARCHIVE_LEASE_SECONDS", 3600))
+
+# Fields that could be edited while a batch is in flight; compared before deleting
+ARCHIVE_GUARD_FIELDS = ("type", "amount_minor", "date", "category", "category_path", "category_ancestors",
+                        "tags", "source", "payee", "note", "sync_version")
+
+
+def bucket_key(user_id, tx_date):
+    return f"{user_id}:{tx_date.strftime('%Y-%m')}"
+
+
+def bucket_inc(tx, sign=1):
+    """$inc document adding (sign=1) or removing (sign=-1) ``tx`` from its bucket totals."""
+    inc = {"count": sign}
+    if tx.get("type") in TRANSACTION_TYPES:
+        inc[f"{tx['type']}_minor"] = sign * tx_minor(tx)
+        inc[f"{tx['type']}_count"] = sign
+    return inc
+
+
+def find_archived(user_id, obj_id, session=None):
+    """Return (bucket_id, transaction) for an archived transaction, or (None, None)."""
+    bucket = buckets_col.find_one({"user_id": user_id, "transactions._id": obj_id}, {"transactions.$": 1},
+                                  session=session)
+    if not bucket:
+        return None, None
+    tx = dict(bucket["transactions"][0], user_id=user_id)
+    return bucket["_id"], tx
+
+
+def remove_from_bucket(key, tx, session=None):
+    """Pull ``tx`` out of bucket ``key`` and back out its totals; False if it was not there."""
+    result = buckets_col.update_one(
+        {"_id": key, "transactions._id": tx["_id"]},
+        {"$pull": {"transactions": {"_id": tx["_id"]}}, "$inc": bucket_inc(tx, -1)},
+        session=session
+    )
+    return result.modified_count == 1
+
+
+def delete_archived(user_id, obj_id, tx_type=None, session=None):
+    """Delete an archived transaction (optionally only of ``tx_type``); returns it, or None."""
+    key, tx = find_archived(user_id, obj_id, session)
+    if not tx or (tx_type and tx.get("type") != tx_type):
+        return None
+    return tx if remove_from_bucket(key, tx, session) else None
+
+
+def delete_archived_many(user_id, obj_ids, tx_type=None, session=None):
+    """Delete archived transactions by id in two round trips; returns {id: deleted transaction}."""
+    match = {"_id": {"$in": list(obj_ids)}}
+    if tx_type:
+        match["type"] = tx_type
+    found = list(buckets_col.aggregate([
+        {"$match": {"user_id": user_id, "transactions._id": {"$in": list(obj_ids)}}},
+        {"$unwind": "$transactions"},
+        {"$replaceRoot": {"newRoot": {"bucket": "$_id", "tx": "$transactions"}}},
+        {"$match": {f"tx.{k}": v for k, v in match.items()}}
+    ], session=session))
+    if not found:
+        return {}
+    buckets_col.bulk_write([
+        UpdateOne({"_id": row["bucket"], "transactions._id": row["tx"]["_id"]},
+                  {"$pull": {"transactions": {"_id": row["tx"]["_id"]}}, "$inc": bucket_inc(row["tx"], -1)})
+        for row in found
+    ], ordered=False, session=session)
+    return {row["tx"]["_id"]: row["tx"] for row in found}
+
+
+def archive_user_transactions(user_id, cutoff, batch_size):
+    archived = 0
+    old = {"user_id": user_id, "date": {"$lt": cutoff, "$type": "date"}, "amount_minor": {"$exists": True}}
+    while True:
+        # Rows keep their search arrays so archived transactions stay searchable
+        batch = list(transactions_col.find(old).sort("date", 1).limit(batch_size))
+        if not batch:
+            return archived
+
+        ops, seen_keys = [], set()
+        for t in batch:
+            key = bucket_key(user_id, t["date"])
+            if key not in seen_keys:
+                seen_keys.add(key)
+                ops.append(UpdateOne(
+                    {"_id": key},
+                    {"$setOnInsert": {"user_id": user_id, "month": t["date"].strftime("%Y-%m"),
+                                      "transactions": [], "count": 0,
+                                      "income_minor": 0, "income_count": 0,
+                                      "expense_minor": 0, "expense_count": 0}},
+                    upsert=True
+                ))
+            entry = {k: v for k, v in t.items() if k != "user_id"}
+            # The $ne guard makes a re-run after a crash a no-op for this document
+            ops.append(UpdateOne(
+                {"_id": key, "transactions._id": {"$ne": t["_id"]}},
+                {"$push": {"transactions": entry}, "$inc": bucket_inc(t),
+                 "$max": {"max_sync_version": t.get("sync_version", 0)}}
+            ))
+        buckets_col.bulk_write(ops, ordered=True)
+
+        # Compare-and-delete: a document edited since it was read stays hot and
+        # its now-stale bucket copy is removed again (it is re-archived next pass)
+        deleted = transactions_col.bulk_write([
+            DeleteOne(dict({"_id": t["_id"]}, **{f: t.get(f) for f in ARCHIVE_GUARD_FIELDS}))
+            for t in batch
+        ], ordered=False).deleted_count
+        archived += deleted
+        if deleted < len(batch):
+            kept = {t["_id"] for t in transactions_col.find({"_id": {"$in": [t["_id"] for t in batch]}}, {"_id": 1})}
+            for t in batch:
+                if t["_id"] in kept:
+                    remove_from_bucket(bucket_key(user_id, t["date"]), t)
+            if deleted == 0:
+                return archived
+
+
+def archive_transactions(batch_size=ARCHIVE_BATCH_SIZE, older_than_days=None):
+    """Move old transactions into monthly buckets; returns how many were moved.
+
+    Runs online and is resumable: the hot-collection query is the resume point
+    and every bucket write is idempotent, so a crash at any step is repaired
+    by the next run.
+    """
+    days = ARCHIVE_AFTER_DAYS if older_than_days is None else older_than_days
+    threshold = datetime.utcnow() - timedelta(days=days)
+    # Whole months only, so a bucket is never split between tiers by the cutoff
+    cutoff = datetime(threshold.year, threshold.month, 1)
+    archived = 0
+    # Per user, so every scan is served by the (user_id, date) index
+    for user in users_col.find({}, {"_id": 1}):
+        archived += archive_user_transactions(str(user["_id"]), cutoff, batch_size)
+    return archived
+
+
+def archive_scheduler_loop(stop_event):
+    while not stop_event.is_set():
+        try:
+            if acquire_lease("transaction_archive", ARCHIVE_LEASE_SECONDS):
+                try:
+                    count = archive_transactions()
+                    if count:
+                        print(f"Transaction archive: moved {count} transactions to buckets")
+                finally:
+                    release_lease("transaction_archive")
+        except Exception as e:
+            print(f"Error in transaction archiver: {str(e)}")
+            print(traceback.format_exc())
+        stop_event.wait(ARCHIVE_INTERVAL_SECONDS)
+
+
+archive_stop_event = threading.Event()
+if ARCHIVE_ENABLED:
+    threading.Thread(
+        target=archive_scheduler_loop, args=(archive_stop_event,),
+        name="transaction-archiver", daemon=True
+    ).start()
+
+
+# -------------------- DELTA SYNC --------------------
+# Every write to a user's transactions, cards or subscriptions takes the next
+# value of that user's change version and stamps it on the documents it
+# writes (``sync_version``); deletes leave a tombstone carrying the version.
+# GET /api/sync?since=<version> returns only what changed after ``since``.
+# A version stays "pending" until its write lands, and the cursor handed to
+# clients stops below the oldest pending one, so a slow write is never skipped.
+SYNC_PENDING_TIMEOUT_SECONDS = int(os.getenv("SYNC_PENDING_TIMEOUT_SECONDS", 30))
+SYNC_TOMBSTONE_DAYS = int(os.getenv("SYNC_TOMBSTONE_DAYS", 30))
+SYNC_PRUNE_ENABLED = os.getenv("SYNC_PRUNE_ENABLED", "True").lower() == "true"
+SYNC_PRUNE_INTERVAL_SECONDS = int(os.getenv("SYNC_PRUNE_INTERVAL_SECONDS", 3600))
+
+
+def reserve_versions_update(count, batch=None):
+    """Pipeline update taking the next ``count`` versions and marking them pending."""
+    pending = {"v": {"$subtract": ["$version", count - 1]}, "at": "$$NOW"}
+    if batch is not None:
+        pending["batch"] = batch
+    return [
+        {"$set": {
+            "version": {"$add": [{"$ifNull": ["$version", 0]}, count]},
+            # Versions of writers that died mid-block stop holding the cursor back
+            "pending": {"$filter": {
+                "input": {"$ifNull": ["$pending", []]}, "as": "p",
+                "cond": {"$gt": ["$$p.at", {"$subtract": ["$$NOW", SYNC_PENDING_TIMEOUT_SECONDS * 1000]}]}
+            }}
+        }},
+        {"$set": {"pending": {"$concatArrays": ["$pending", [pending]]}}}
+    ]
+
+
+@contextmanager
+def sync_change(user_id):
+    """Reserve the user's next change version for the writes made in the block."""
+    state = sync_col.find_one_and_update(
+        {"_id": user_id},
+        reserve_versions_update(1),
+        projection={"version": 1},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    version = state["version"]
+    try:
+        yield version
+    finally:
+        sync_col.update_one({"_id": user_id}, {"$pull": {"pending": {"v": version}}})
+
+
+def reserve_sync_versions(docs):
+    """Stamp ``sync_version`` on a group-commit batch; returns (batch token, user ids).
+
+    Each user in the batch takes one range of versions, tagged with the
+    token, in a single bulk write; one read of the tagged pending entries
+    gives each range's start. Two round trips per batch instead of two per
+    document.
+    """
+    counts = {}
+    for d in docs:
+        counts[d["user_id"]] = counts.get(d["user_id"], 0) + 1
+    token = ObjectId()
+    sync_col.bulk_write([
+        UpdateOne({"_id": uid}, reserve_versions_update(n, token), upsert=True) for uid, n in counts.items()
+    ], ordered=False)
+    starts = {
+        s["_id"]: s["pending"][0]["v"]
+        for s in sync_col.find({"_id": {"$in": list(counts)}}, {"pending": {"$elemMatch": {"batch": token}}})
+    }
+    for d in docs:
+        d["sync_version"] = starts[d["user_id"]]
+        starts[d["user_id"]] += 1
+    return token, list(counts)
+
+
+def release_sync_batch(reserved):
+    """Release the pending versions of a written batch (one update for all its users)."""
+    token, user_ids = reserved
+    sync_col.update_many({"_id": {"$in": user_ids}}, {"$pull": {"pending": {"batch": token}}})
+
+
+def record_deletions(user_id, collection, ids, version, session=None):
+    """Tombstones for deleted documents, so clients learn about the deletes on sync."""
+    now = datetime.utcnow()
+    tombstones_col.insert_many([
+        {"user_id": user_id, "collection": collection, "doc_id": oid, "sync_version": version, "deleted_at": now}
+        for oid in ids
+    ], ordered=False, session=session)
+
+
+def sync_cursor(state):
+    """Highest version below every still-pending write."""
+    cutoff = datetime.utcnow() - timedelta(seconds=SYNC_PENDING_TIMEOUT_SECONDS)
+    pending = [p["v"] for p in state.get("pending", []) if p["at"] > cutoff]
+    return min(pending) - 1 if pending else state.get("version", 0)
+
+
+def prune_tombstones():
+    """Drop tombstones older than SYNC_TOMBSTONE_DAYS; returns how many users were pruned.
+
+    Raises each user's ``floor`` first: clients whose version is below it
+    may have missed a pruned delete and must resync in full.
+    """
+    cutoff = datetime.utcnow() - timedelta(days=SYNC_TOMBSTONE_DAYS)
+    newest_old = list(tombstones_col.aggregate([
+        {"$match": {"deleted_at": {"$lt": cutoff}}},
+        {"$group": {"_id": "$user_id", "version": {"$max": "$sync_version"}}}
+    ]))
+    if not newest_old:
+        return 0
+    sync_col.bulk_write([UpdateOne({"_id": t["_id"]}, {"$max": {"floor": t["version"]}}) for t in newest_old],
+                        ordered=False)
+    tombstones_col.delete_many({"$or": [
+        {"user_id": t["_id"], "sync_version": {"$lte": t["version"]}} for t in newest_old
+    ]})
+    return len(newest_old)
+
+
+def tombstone_prune_loop(stop_event):
+    while not stop_event.is_set():
+        try:
+            if acquire_lease("tombstone_prune", SYNC_PRUNE_INTERVAL_SECONDS):
+                try:
+                    count = prune_tombstones()
+                    if count:
+                        print(f"Delta sync: pruned old tombstones for {count} users")
+                finally:
+                    release_lease("tombstone_prune")
+        except Exception as e:
+            print(f"Error pruning sync tombstones: {str(e)}")
+            print(traceback.format_exc())
+        stop_event.wait(SYNC_PRUNE_INTERVAL_SECONDS)
+
+
+tombstone_stop_event = threading.Event()
+if SYNC_PRUNE_ENABLED:
+    threading.Thread(
+        target=tombstone_prune_loop, args=(tombstone_stop_event,),
+        name="tombstone-prune", daemon=True
+    ).start()
+
+
+def serialize_card(card):
+    card["_id"] = str(card["_id"])
+    if "number" in card:
+        card["masked_number"] = "**** **** **** " + str(card["number"])[-4:]
+        del card["number"]
+    return card
+
+
+def serialize_subscription(sub):
+    sub["_id"] = str(sub["_id"])
+    return sub
+
+
+# ✅ Changes since a client's last sync (primary reads: a lagging secondary
+# could hide a change below the cursor we return)
+@app.route("/api/sync", methods=["GET"])
+@query_budget(max_queries=8)
+@shed_load("list")
+def api_sync():
+    if "user_id" not in session:
+        return jsonify({"error": "auth required"}), 403
+    user_id = session["user_id"]
+    try:
+        since = int(request.args.get("since", 0))
+        if since < 0:
+            raise ValueError
+    except ValueError:
+        return jsonify({"error": "since must be a non-negative integer version"}), 400
+
+    state = sync_col.find_one({"_id": user_id}) or {}
+    cursor = sync_cursor(state)
+    floor = state.get("floor", 0)
+    # Versions from before a prune, or from the future (e.g. a restored db), start over
+    reset = since > 0 and (since < floor or since > state.get("version", 0))
+    if reset:
+        since = 0
+
+    match = {"user_id": user_id}
+    if since:
+        match["sync_version"] = {"$gt": since}
+    transactions = [serialize_tx(t) for t in transactions_col.aggregate([
+        {"$match": match},
+        {"$unionWith": {"coll": buckets_col.name, "pipeline": archived_pipeline(match)}},
+        {"$project": SEARCH_PROJECTION}
+    ], session=db_session())]
+    changes = {
+        "transactions": transactions,
+        "cards": [serialize_card(c) for c in cards_col.find(match, session=db_session())],
+        "subscriptions": [serialize_subscription(s) for s in subscriptions_col.find(match, session=db_session())],
+    }
+
+    deleted = {}
+    if since:
+        for t in tombstones_col.find({"user_id": user_id, "sync_version": {"$gt": since}},
+                                     {"collection": 1, "doc_id": 1}, session=db_session()):
+            deleted.setdefault(t["collection"], []).append(str(t["doc_id"]))
+
+    # Only non-empty lists, so an idle reconnect is a few bytes
+    return jsonify({
+        "success": True,
+        "version": cursor,
+        "full": since == 0,
+        "reset": reset,
+        "changes": {k: v for k, v in changes.items() if v},
+        "deleted": deleted
+    }), 200
+
+
+# -------------------- LEDGER (append-only event log) --------------------
+# Every create, delete and edit of a transaction appends an event to
+# ``ledger_events``; events are never updated or removed. Create and delete
+# events have deterministic ids ("<tx id>:create"), so a retry or the
+# backfill cannot record one twice. Events commit in the same Mongo
+# transaction as the write they record. Each event carries its signed
+# effect on the user's income and expense totals. ``ledger_snapshots`` holds periodic
+# per-user running totals, so the balance as of any instant is the nearest
+# earlier snapshot plus the events recorded after it.
+LEDGER_SNAPSHOT_ENABLED = os.getenv("LEDGER_SNAPSHOT_ENABLED", "True").lower() == "true"
+LEDGER_SNAPSHOT_INTERVAL_SECONDS = int(os.getenv("LEDGER_SNAPSHOT_INTERVAL_SECONDS", 6 * 3600))
+# A user gets a new snapshot once this many events have piled up since the last one
+LEDGER_SNAPSHOT_MIN_EVENTS = int(os.getenv("LEDGER_SNAPSHOT_MIN_EVENTS", 50))
+# Snapshots stop this far behind now, so events still being written are not skipped
+LEDGER_SETTLE_SECONDS = int(os.getenv("LEDGER_SETTLE_SECONDS", 60))
+LEDGER_LEASE_SECONDS = int(os.getenv("LEDGER_LEASE_SECONDS", 3600))
+
+# Transaction fields an event is built from
+LEDGER_FIELDS = {"user_id": 1, "type": 1, "amount_minor": 1, "amount": 1, "date": 1, "category": 1}
+
+
+def ledger_event(user_id, op, tx, version, fields=None):
+    """Event for ``op`` ("create", "delete" or "update") on transaction ``tx``."""
+    sign = {"create": 1, "delete": -1}.get(op, 0)
+    amount = tx_minor(tx)
+    event = {
+        "_id": f"{tx['_id']}:{op}" if sign else f"{tx['_id']}:{op}:{ObjectId()}",
+        "user_id": user_id,
+        "at": datetime.utcnow(),
+        "op": op,
+        "tx_id": tx["_id"],
+        "type": tx.get("type"),
+        "amount_minor": amount,
+        "date": tx.get("date"),
+        "category": tx.get("category"),
+        "income_minor": sign * amount if tx.get("type") == "income" else 0,
+        "expense_minor": sign * amount if tx.get("type") == "expense" else 0,
+        "sync_version": version
+    }
+    if fields:
+        event["fields"] = fields
+    return event
+
+
+def append_ledger(events, session=None):
+    """Append ``events``; returns how many were added.
+
+    With ``session`` the events are part of the caller's Mongo transaction
+    and any error (including a duplicate) propagates and aborts it.
+    Without one (backfills) events already recorded are skipped and other
+    failures are logged.
+    """
+    if not events:
+        return 0
+    if session is not None:
+        ledger_col.insert_many(events, ordered=False, session=session)
+        return len(events)
+    try:
+        return len(ledger_col.insert_many(events, ordered=False).inserted_ids)
+    except BulkWriteError as bwe:
+        errors = bwe.details.get("writeErrors", [])
+        if any(err.get("code") != 11000 for err in errors):
+            print(f"Error appending ledger events: {errors[:3]}")
+        return bwe.details.get("nInserted", 0)
+    except Exception as e:
+        print(f"Error appending ledger events: {str(e)}")
+        return 0
+
+
+def in_transaction(write):
+    """Run ``write(session)`` in one Mongo transaction and return its result.
+
+    Transient errors retry the whole callback. Uses the request's causally
+    consistent session when there is one, so the commit advances its
+    operation time like any other write.
+    """
+    s = db_session()
+    if s is not None:
+        return s.with_transaction(write)
+    with client.start_session() as s:
+        return s.with_transaction(write)
+
+
+def insert_logged(docs):
+    """insert_many ``docs`` with their create events in one transaction; returns how many were inserted.
+
+    A duplicate key aborts the whole transaction, so the duplicates are
+    dropped and the rest retried; other write errors propagate.
+    """
+    while docs:
+        try:
+            def insert(s):
+                transactions_col.insert_many(docs, ordered=False, session=s)
+                append_ledger([ledger_event(d["user_id"], "create", d, d.get("sync_version")) for d in docs], session=s)
+            in_transaction(insert)
+            return len(docs)
+        except BulkWriteError as bwe:
+            errors = bwe.details.get("writeErrors", [])
+            if not errors or any(err.get("code") != 11000 for err in errors):
+                raise
+            failed = {err["index"] for err in errors}
+            docs = [d for i, d in enumerate(docs) if i not in failed]
+    return 0
+
+
+def delete_transaction(user_id, obj_id, tx_type=None):
+    """Delete one hot or archived transaction with its tombstone and ledger event; returns it, or None."""
+    query = {"_id": obj_id, "user_id": user_id}
+    if tx_type:
+        query["type"] = tx_type
+    with sync_change(user_id) as version:
+        def delete(s):
+            deleted = transactions_col.find_one_and_delete(query, projection=LEDGER_FIELDS, session=s) \
+                or delete_archived(user_id, obj_id, tx_type, s)
+            if deleted:
+                record_deletions(user_id, "transactions", [obj_id], version, s)
+                append_ledger([ledger_event(user_id, "delete", deleted, version)], session=s)
+            return deleted
+        return in_transaction(delete)
+
+
+def balance_as_of(user_id, at):
+    """Ledger totals as recorded at ``at``: nearest snapshot plus the events after it."""
+    snapshot = ledger_snapshots_col.find_one({"user_id": user_id, "at": {"$lte": at}}, sort=[("at", -1)]) or {}
+    match = {"user_id": user_id, "at": {"$lte": at}}
+    if snapshot:
+        match["at"]["$gt"] = snapshot["at"]
+    rows = list(ledger_col.aggregate([
+        {"$match": match},
+        {"$group": {"_id": None, "income": {"$sum": "$income_minor"},
+                    "expense": {"$sum": "$expense_minor"}, "events": {"$sum": 1}}}
+    ]))
+    replayed = rows[0] if rows else {"income": 0, "expense": 0, "events": 0}
+    return {
+        "income_minor": snapshot.get("income_minor", 0) + replayed["income"],
+        "expense_minor": snapshot.get("expense_minor", 0) + replayed["expense"],
+        "events": snapshot.get("events", 0) + replayed["events"],
+        "snapshot_at": snapshot.get("at"),
+        "replayed_events": replayed["events"]
+    }
+
+
+def take_ledger_snapshot(user_id, until):
+    """Fold the events up to ``until`` into a new snapshot; False if too few since the last one."""
+    state = balance_as_of(user_id, until)
+    if state["replayed_events"] < LEDGER_SNAPSHOT_MIN_EVENTS:
+        return False
+    ledger_snapshots_col.update_one({"user_id": user_id, "at": until}, {"$setOnInsert": {
+        "income_minor": state["income_minor"],
+        "expense_minor": state["expense_minor"],
+        "events": state["events"],
+        "created_at": datetime.utcnow()
+    }}, upsert=True)
+    return True
+
+
+def snapshot_ledgers():
+    """Snapshot users with recent events; returns how many snapshots were written.
+
+    Users whose history is still being backfilled are skipped: their
+    backfilled events are dated in the past and would land behind a snapshot.
+    """
+    until = datetime.utcnow() - timedelta(seconds=LEDGER_SETTLE_SECONDS)
+    since = until - timedelta(seconds=2 * LEDGER_SNAPSHOT_INTERVAL_SECONDS)
+    active = ledger_col.distinct("user_id", {"at": {"$gt": since, "$lte": until}})
+    ready = users_col.find(
+        {"_id": {"$in": [ObjectId(u) for u in active if ObjectId.is_valid(u)]}, "ledger_since": {"$exists": True}},
+        {"_id": 1}
+    )
+    return sum(1 for u in ready if take_ledger_snapshot(str(u["_id"]), until))
+
+
+def backfill_ledger(batch_size=1000):
+    """Record create events for transactions written before the ledger existed.
+
+    Goes user by user; ``users.ledger_since`` marks a finished user (new
+    users get it at registration), so the query is the resume point. The
+    events are dated at the transaction's created_at. Deletions from before
+    the ledger existed are unknown, so history before ``ledger_since`` only
+    reflects transactions that still exist.
+    """
+    recorded = 0
+    while True:
+        users = list(users_col.find({"ledger_since": {"$exists": False}}, {"_id": 1}).limit(batch_size))
+        if not users:
+            return recorded
+        for u in users:
+            user_id = str(u["_id"])
+            started = datetime.utcnow()
+            events = []
+            for t in merged_aggregate({"user_id": user_id}, [{"$project": {**LEDGER_FIELDS, "created_at": 1, "sync_version": 1}}]):
+                event = ledger_event(user_id, "create", t, t.get("sync_version"))
+                event.update(at=t.get("created_at") or t.get("date") or started, backfilled=True)
+                events.append(event)
+                if len(events) >= batch_size:
+                    recorded += append_ledger(events)
+                    events = []
+            recorded += append_ledger(events)
+            users_col.update_one({"_id": u["_id"]}, {"$set": {"ledger_since": started}})
+
+
+def ledger_snapshot_loop(stop_event):
+    while not stop_event.is_set():
+        try:
+            if acquire_lease("ledger_snapshots", LEDGER_LEASE_SECONDS):
+                try:
+                    count = snapshot_ledgers()
+                    if count:
+                        print(f"Ledger: wrote {count} balance snapshots")
+                finally:
+                    release_lease("ledger_snapshots")
+        except Exception as e:
+            print(f"Error in ledger snapshots: {str(e)}")
+            print(traceback.format_exc())
+        stop_event.wait(LEDGER_SNAPSHOT_INTERVAL_SECONDS)
+
+
+ledger_stop_event = threading.Event()
+if LEDGER_SNAPSHOT_ENABLED:
+    threading.Thread(
+        target=ledger_snapshot_loop, args=(ledger_stop_event,),
+        name="ledger-snapshots", daemon=True
+    ).start()
+
+
+def parse_as_of(raw):
+    """UTC instant for ?as_of=: a date means the end of that day; None if invalid."""
+    try:
+        at = datetime.fromisoformat(raw.strip().replace("Z", "+00:00"))
+    except (AttributeError, ValueError):
+        return None
+    if at.tzinfo:
+        at = at.astimezone(timezone.utc).replace(tzinfo=None)
+    if len(raw.strip()) == 10:
+        at += timedelta(days=1, microseconds=-1000)
+    return at
+
+
+def serialize_ledger_event(e):
+    e["tx_id"] = str(e["tx_id"])
+    e.pop("user_id", None)
+    for field in ("amount_minor", "income_minor", "expense_minor"):
+        e[field.replace("_minor", "")] = to_major(e.pop(field, 0))
+    for field in ("at", "date"):
+        if isinstance(e.get(field), datetime):
+            e[field] = e[field].isoformat() + "Z"
+    return e
+
+
+# ✅ Balance as recorded at a point in time (?as_of=YYYY-MM-DD or an ISO datetime; default now)
+@app.route("/api/ledger/balance", methods=["GET"])
+@query_budget(max_queries=3)
+def api_ledger_balance():
+    if "user_id" not in session:
+        return jsonify({"error": "auth required"}), 403
+    raw = request.args.get("as_of")
+    at = parse_as_of(raw) if raw else datetime.utcnow()
+    if at is None:
+        return jsonify({"error": "as_of must be a date (YYYY-MM-DD) or an ISO datetime"}), 400
+    user = users_col.find_one({"_id": ObjectId(session["user_id"])}, {"ledger_since": 1}) or {}
+    state = balance_as_of(session["user_id"], at)
+    return jsonify({
+        "success": True,
+        "as_of": at.isoformat() + "Z",
+        "income": to_major(state["income_minor"]),
+        "expense": to_major(state["expense_minor"]),
+        "balance": to_major(state["income_minor"] - state["expense_minor"]),
+        "events": state["events"],
+        "snapshot_at": state["snapshot_at"].isoformat() + "Z" if state["snapshot_at"] else None,
+        "replayed_events": state["replayed_events"],
+        # Until the backfill reaches this user, older transactions are missing
+        "complete": "ledger_since" in user
+    }), 200
+
+
+# ✅ Audit trail, newest first (?tx_id= for one transaction; pass next_cursor back as cursor)
+@app.route("/api/ledger/events", methods=["GET"])
+def api_ledger_events():
+    if "user_id" not in session:
+        return jsonify({"error": "auth required"}), 403
+    query = {"user_id": session["user_id"]}
+    if request.args.get("tx_id"):
+        try:
+            query["tx_id"] = ObjectId(request.args["tx_id"])
+        except Exception:
+            return jsonify({"error": "invalid tx_id"}), 400
+    cursor = request.args.get("cursor")
+    if cursor:
+        try:
+            at, last_id = decode_cursor(cursor)
+            at = datetime.fromisoformat(at)
+        except Exception:
+            return jsonify({"error": "invalid cursor"}), 400
+        # Events written together share a timestamp; the id breaks ties
+        query["$or"] = [{"at": {"$lt": at}}, {"at": at, "_id": {"$lt": last_id}}]
+    try:
+        limit = min(max(int(request.args.get("limit", 50)), 1), 500)
+    except ValueError:
+        limit = 50
+    events = list(ledger_col.find(query).sort([("at", -1), ("_id", -1)]).limit(limit + 1))
+    next_cursor = None
+    if len(events) > limit:
+        events = events[:limit]
+        next_cursor = encode_cursor([events[-1]["at"].isoformat(), events[-1]["_id"]])
+    return jsonify({
+        "success": True,
+        "events": [serialize_ledger_event(e) for e in events],
+        "next_cursor": next_cursor
+    }), 200
+
+
+# -------------------- CATEGORIES & TAGS --------------------
+# Categories form a per-user tree stored in ``categories`` (one node per
+# path). A transaction keeps the display string in ``category``
+# ("Food > Restaurants") plus the normalized ``category_path``
+# ("food/restaurants") and ``category_ancestors``, every prefix of the path
+# as a multikey array, so subtree filters are index lookups and a roll-up is
+# one $unwind. Category strings are normalized on write: case, spacing and
+# "a > b" / "a/b" separators all map to the same node, whose display name is
+# the first spelling seen. ``tags`` is a multikey array of normalized tags.
+CATEGORY_SEPARATOR = re.compile(r"\s*[>/]\s*")
+MAX_CATEGORY_DEPTH = 4
+MAX_TAGS = 20
+MAX_TAG_LENGTH = 32
+# Close-match cutoff (difflib ratio) for /api/categories/suggestions
+CATEGORY_MERGE_SIMILARITY = float(os.getenv("CATEGORY_MERGE_SIMILARITY", 0.85))
+
+
+def category_segments(raw):
+    """Display segments of a category string: " food >  Restaurants" -> ["food", "Restaurants"]."""
+    if not isinstance(raw, str):
+        return []
+    parts = (re.sub(r"\s+", " ", p).strip() for p in CATEGORY_SEPARATOR.split(raw))
+    return [p for p in parts if p][:MAX_CATEGORY_DEPTH]
+
+
+def category_path(raw):
+    """Normalized path of a category string ("Food > Restaurants" -> "food/restaurants"), or None."""
+    return "/".join(s.casefold() for s in category_segments(raw)) or None
+
+
+def path_prefixes(path):
+    keys = path.split("/")
+    return ["/".join(keys[:i + 1]) for i in range(len(keys))]
+
+
+def category_node_key(user_id, path):
+    return f"{user_id}:{path}"
+
+
+def category_fields(segments, names=None):
+    """{category, category_path, category_ancestors} for display ``segments``.
+
+    ``names`` maps paths to stored display names, which win over the typed ones.
+    """
+    if not segments:
+        return {"category": None, "category_path": None, "category_ancestors": []}
+    paths = path_prefixes("/".join(s.casefold() for s in segments))
+    names = names or {}
+    return {
+        "category": " > ".join(names.get(p, s) for p, s in zip(paths, segments)),
+        "category_path": paths[-1],
+        "category_ancestors": paths,
+    }
+
+
+def resolve_category(user_id, raw):
+    """Transaction fields for ``raw`` normalized against the user's tree.
+
+    Creates missing nodes; returns {category, category_path, category_ancestors}.
+    """
+    segments = category_segments(raw)
+    if not segments:
+        return {"category": None, "category_path": None, "category_ancestors": []}
+    paths = path_prefixes("/".join(s.casefold() for s in segments))
+    names = {n["path"]: n["name"] for n in categories_col.find(
+        {"_id": {"$in": [category_node_key(user_id, p) for p in paths]}}, {"path": 1, "name": 1}
+    )}
+    missing = [i for i, p in enumerate(paths) if p not in names]
+    if missing:
+        now = datetime.utcnow()
+        try:
+            categories_col.bulk_write([
+                UpdateOne(
+                    {"_id": category_node_key(user_id, paths[i])},
+                    {"$setOnInsert": {"user_id": user_id, "path": paths[i], "name": segments[i],
+                                      "parent": paths[i - 1] if i else None,
+                                      "ancestors": paths[:i + 1], "created_at": now}},
+                    upsert=True
+                )
+                for i in missing
+            ], ordered=False)
+        except BulkWriteError as bwe:
+            # A concurrent request created the same node first
+            if any(err.get("code") != 11000 for err in bwe.details.get("writeErrors", [])):
+                raise
+    return category_fields(segments, names)
+
+
+def normalize_tags(raw):
+    """["Work", " #travel", "work"] or "work, travel" -> ["work", "travel"]."""
+    if isinstance(raw, str):
+        raw = raw.split(",")
+    if not isinstance(raw, list):
+        return []
+    tags = []
+    for t in raw:
+        tag = re.sub(r"\s+", "-", str(t).strip().lstrip("#").casefold())[:MAX_TAG_LENGTH]
+        if tag and tag not in tags:
+            tags.append(tag)
+    return tags[:MAX_TAGS]
+
+
+def normalize_categories(batch_size=1000):
+    """Backfill category paths onto transactions written before the category tree.
+
+    Legacy strings that differ only in case, spacing or separators land on
+    the same node (and display name). Compare-and-set on the old category.
+    Archived buckets are backfilled afterwards, so tree filters, limit seeding
+    and merges see old rows too.
+    """
+    updated = 0
+    while True:
+        batch = list(transactions_col.find(
+            {"category_path": {"$exists": False}},
+            {"user_id": 1, **{f: 1 for f in SEARCH_FIELDS}}
+        ).limit(batch_size))
+        if not batch:
+            return updated
+        resolved = {}
+        with ExitStack() as changes:
+            versions = {uid: changes.enter_context(sync_change(uid)) for uid in {t["user_id"] for t in batch}}
+            ops = []
+            for t in batch:
+                key = (t["user_id"], t.get("category"))
+                if key not in resolved:
+                    resolved[key] = resolve_category(*key)
+                fields = dict(resolved[key], sync_version=versions[t["user_id"]])
+                if t.get("category") is None:
+                    fields.pop("category")
+                fields.update(search_index_fields({**t, **fields}))
+                ops.append(UpdateOne({"_id": t["_id"], "category": t.get("category")}, {"$set": fields}))
+            result = transactions_col.bulk_write(ops, ordered=False)
+        updated += result.modified_count
+        if result.modified_count == 0:
+            break
+    return updated + normalize_archived_categories(batch_size // 10 or 1)
+
+
+def normalize_archived_categories(batch_size=100):
+    """The same backfill for transactions archived into monthly buckets.
+
+    One update per (bucket, legacy category), matched with an array filter
+    that skips rows already carrying a path, so re-runs are no-ops.
+    """
+    updated = 0
+    pending = {"transactions": {"$elemMatch": {"category_path": {"$exists": False}}}}
+    while True:
+        batch = list(buckets_col.find(pending, {"user_id": 1, "transactions.category": 1,
+                                                "transactions.category_path": 1}).limit(batch_size))
+        if not batch:
+            return updated
+        resolved = {}
+        with ExitStack() as changes:
+            versions = {uid: changes.enter_context(sync_change(uid)) for uid in {b["user_id"] for b in batch}}
+            ops = []
+            for b in batch:
+                version = versions[b["user_id"]]
+                legacy = {t.get("category") for t in b["transactions"] if "category_path" not in t}
+                for category in legacy:
+                    key = (b["user_id"], category)
+                    if key not in resolved:
+                        resolved[key] = resolve_category(*key)
+                    fields = dict(resolved[key])
+                    if category is None:
+                        fields.pop("category")
+                    ops.append(UpdateOne(
+                        {"_id": b["_id"]},
+                        {"$set": {**{f"transactions.$[t].{k}": v for k, v in fields.items()},
+                                  "transactions.$[t].sync_version": version},
+                         "$max": {"max_sync_version": version}},
+                        array_filters=[{"t.category_path": {"$exists": False}, "t.category": category}]
+                    ))
+            result = buckets_col.bulk_write(ops, ordered=False)
+        updated += result.modified_count
+        if result.modified_count == 0:
+            return updated
+
+
+# Roll-up inputs; archived or not-yet-backfilled documents fall back to their raw category
+_ROLLUP_PATH_EXPR = {"$ifNull": ["$category_path", {"$toLower": {"$trim": {"input": {"$ifNull": ["$category", ""]}}}}]}
+
+
+def category_rollup(match):
+    """Spend per category node, each node including its whole subtree, in one pipeline.
+
+    Returns {path: {"own": paise, "total": paise, "count": n}}.
+    """
+    rows = merged_aggregate(match, [
+        {"$project": {"amount": MINOR_AMOUNT_EXPR, "path": _ROLLUP_PATH_EXPR, "ancestors": "$category_ancestors"}},
+        {"$set": {"ancestors": {"$cond": [
+            {"$gt": [{"$size": {"$ifNull": ["$ancestors", []]}}, 0]}, "$ancestors", ["$path"]
+        ]}}},
+        {"$facet": {
+            "own": [{"$group": {"_id": "$path", "total": {"$sum": "$amount"}}}],
+            "rolled": [
+                {"$unwind": "$ancestors"},
+                {"$group": {"_id": "$ancestors", "total": {"$sum": "$amount"}, "count": {"$sum": 1}}}
+            ]
+        }}
+    ])
+    result = next(rows, {"own": [], "rolled": []})
+    nodes = {r["_id"]: {"own": 0, "total": r["total"], "count": r["count"]} for r in result["rolled"]}
+    for r in result["own"]:
+        nodes.setdefault(r["_id"], {"own": 0, "total": r["total"], "count": 0})["own"] = r["total"]
+    return nodes
+
+
+def category_tree(user_id, rollup=None):
+    """Nested category nodes (name, path, children), with roll-up amounts when given."""
+    nodes = {}
+    for n in reads(categories_col).find({"user_id": user_id}, {"path": 1, "name": 1, "parent": 1}, session=db_session()):
+        nodes[n["path"]] = {"path": n["path"], "name": n["name"], "parent": n.get("parent"), "children": []}
+    for path in rollup or {}:
+        # Paths from legacy strings that have no node yet
+        nodes.setdefault(path, {"path": path, "name": path or "Other", "parent": None, "children": []})
+    roots = []
+    for path in sorted(nodes):
+        node = nodes[path]
+        if rollup is not None:
+            amounts = rollup.get(path, {"own": 0, "total": 0, "count": 0})
+            node.update(own=to_major(amounts["own"]), total=to_major(amounts["total"]), count=amounts["count"])
+        parent = nodes.get(node.pop("parent"))
+        (parent["children"] if parent else roots).append(node)
+    if rollup is not None:
+        def by_total(items):
+            items.sort(key=lambda n: n["total"], reverse=True)
+            for n in items:
+                by_total(n["children"])
+        by_total(roots)
+    return roots
+
+
+# ✅ Category tree of the current user
+@app.route("/api/categories", methods=["GET"])
+def api_get_categories():
+    if "user_id" not in session:
+        return jsonify({"error": "auth required"}), 403
+    return jsonify({"success": True, "categories": category_tree(session["user_id"])}), 200
+
+
+# ✅ Spending rolled up the category tree (?from=&to=&type=, default expenses)
+@app.route("/api/analytics/categories", methods=["GET"])
+@query_budget(max_queries=4)
+@shed_load("analytics", stale=True)
+def api_analytics_categories():
+    if "user_id" not in session:
+        return jsonify({"error": "auth required"}), 403
+    args = request.args.to_dict()
+    args.setdefault("type", "expense")
+    match, filters, error = build_transaction_filter(session["user_id"], args)
+    if error:
+        return jsonify({"error": error}), 400
+    rollup = category_rollup(match)
+    return jsonify({
+        "success": True,
+        "filters": filters,
+        "total": to_major(sum(v["own"] for v in rollup.values())),
+        "categories": category_tree(session["user_id"], rollup)
+    }), 200
+
+
+# ✅ Likely duplicates among sibling categories (typos the normalizer cannot fix)
+@app.route("/api/categories/suggestions", methods=["GET"])
+def api_category_suggestions():
+    if "user_id" not in session:
+        return jsonify({"error": "auth required"}), 403
+    user_id = session["user_id"]
+    counts = {r["_id"]: r["count"] for r in reads(transactions_col).aggregate([
+        {"$match": {"user_id": user_id, "category_path": {"$ne": None}}},
+        {"$group": {"_id": "$category_path", "count": {"$sum": 1}}}
+    ], session=db_session())}
+    siblings = {}
+    for n in reads(categories_col).find({"user_id": user_id}, {"path": 1, "name": 1, "parent": 1}, session=db_session()):
+        siblings.setdefault(n.get("parent"), []).append(n)
+    suggestions = []
+    for group in siblings.values():
+        for i, a in enumerate(group):
+            for b in group[i + 1:]:
+                ratio = difflib.SequenceMatcher(None, a["path"], b["path"]).ratio()
+                if ratio < CATEGORY_MERGE_SIMILARITY:
+                    continue
+                # Suggest folding the rarer spelling into the common one
+                src, dst = sorted((a, b), key=lambda n: counts.get(n["path"], 0))
+                suggestions.append({"from": src["name"], "from_path": src["path"],
+                                    "into": dst["name"], "into_path": dst["path"],
+                                    "transactions": counts.get(src["path"], 0), "similarity": round(ratio, 3)})
+    suggestions.sort(key=lambda s: s["similarity"], reverse=True)
+    return jsonify({"success": True, "suggestions": suggestions}), 200
+
+
+# ✅ Merge a category (and its subtree) into another
+@app.route("/api/categories/merge", methods=["POST"])
+def api_merge_categories():
+    if "user_id" not in session:
+        return jsonify({"error": "auth required"}), 403
+    user_id = session["user_id"]
+    data = json_or_form(request)
+    src = category_path(data.get("from"))
+    if not src or not category_path(data.get("into")):
+        return jsonify({"error": "from and into are required"}), 400
+    names = {n["path"]: n["name"] for n in categories_col.find({"user_id": user_id, "ancestors": src}, {"path": 1, "name": 1})}
+    if src not in names:
+        return jsonify({"error": "category not found"}), 404
+    dst = resolve_category(user_id, data.get("into"))
+    if dst["category_path"] == src or dst["category_path"].startswith(src + "/"):
+        return jsonify({"error": "cannot merge a category into itself or its subtree"}), 400
+
+    moved = buckets = 0
+    # One sync version per batch: a single version held across the whole
+    # merge could stay pending past SYNC_PENDING_TIMEOUT_SECONDS
+    for old in sorted(names):
+        # Keep the part below ``src``: from "food/grocries/fruit" into "food/groceries" -> ".../fruit"
+        tail = [names[p] for p in path_prefixes(old)[len(src.split("/")):]]
+        fields = resolve_category(user_id, " > ".join([dst["category"]] + tail))
+        while True:
+            batch = list(transactions_col.find(
+                {"user_id": user_id, "category_path": old}, {**LEDGER_FIELDS, **{f: 1 for f in SEARCH_FIELDS}}
+            ).limit(1000))
+            if not batch:
+                break
+            with sync_change(user_id) as version:
+                ops = [
+                    UpdateOne({"_id": t["_id"]}, {"$set": {
+                        **fields, **search_index_fields({**t, **fields}), "sync_version": version
+                    }})
+                    for t in batch
+                ]
+                events = [ledger_event(user_id, "update", t, version, fields) for t in batch]
+
+                def move(s):
+                    transactions_col.bulk_write(ops, ordered=False, session=s)
+                    append_ledger(events, session=s)
+                in_transaction(move)
+            moved += len(batch)
+        # The category name feeds the search arrays; they are rebuilt below
+        with sync_change(user_id) as version:
+            result = buckets_col.update_many(
+                {"user_id": user_id, "transactions.category_path": old},
+                {"$set": {**{f"transactions.$[t].{k}": v for k, v in fields.items()},
+                          "transactions.$[t].sync_version": version},
+                 "$unset": {"transactions.$[t].search_terms": "", "transactions.$[t].search_words": ""},
+                 "$max": {"max_sync_version": version}},
+                array_filters=[{"t.category_path": old}]
+            )
+        buckets += result.modified_count
+        for limit in limits_col.find({"user_id": user_id, "category": old}, {"_id": 1}):
+            try:
+                limits_col.update_one({"_id": limit["_id"]}, {"$set": {
+                    "category": fields["category_path"], "category_name": fields["category"]
+                }})
+            except DuplicateKeyError:
+                # The target already has a limit for that period; it wins
+                limits_col.delete_one({"_id": limit["_id"]})
+    categories_col.delete_many({"user_id": user_id, "ancestors": src})
+    if buckets:
+        index_archived_search(user_id)
+
+    tx_cache.invalidate(user_id)
+    invalidate_limit_counters(user_id)
+    rebuild_sketches(user_id)
+    return jsonify({"success": True, "into": dst["category"], "moved": moved, "archive_buckets": buckets}), 200
+
+
+# Started once every backfill above is defined
+threading.Thread(target=run_backfills, name="backfills", daemon=True).start()
+
+
+# -------------------- RECEIPTS (GridFS attachments) --------------------
+# Receipt files live in the ``receipts`` GridFS bucket with their owner,
+# expense and thumbnail state in ``metadata``. Uploads are multipart bodies
+# parsed incrementally and written to GridFS chunk by chunk; the file type
+# comes from the first bytes, not the client's header. Each user's stored
+# bytes are kept on ``users.receipt_bytes`` and charged with a conditional
+# $inc, so concurrent uploads cannot overshoot the quota.
+RECEIPT_MAX_BYTES = int(os.getenv("RECEIPT_MAX_BYTES", 10 * 1024 * 1024))
+RECEIPT_QUOTA_BYTES = int(os.getenv("RECEIPT_QUOTA_BYTES", 100 * 1024 * 1024))
+RECEIPT_THUMB_SIZE = int(os.getenv("RECEIPT_THUMB_SIZE", 320))
+# A pending thumbnail older than this is re-queued when someone asks for it
+RECEIPT_THUMB_RETRY_SECONDS = int(os.getenv("RECEIPT_THUMB_RETRY_SECONDS", 300))
+
+receipts_fs = gridfs.GridFSBucket(db, bucket_name="receipts", chunk_size_bytes=RECEIPT_CHUNK_BYTES)
+
+
+class ReceiptRejected(Exception):
+    def __init__(self, message, status):
+        super().__init__(message)
+        self.status = status
+
+
+def serialize_receipt(doc):
+    meta = doc.get("metadata") or {}
+    return {
+        "_id": str(doc["_id"]),
+        "filename": doc.get("filename"),
+        "content_type": meta.get("content_type"),
+        "size": doc.get("length"),
+        "uploaded_at": doc["uploadDate"].isoformat() + "Z" if doc.get("uploadDate") else None,
+        "thumbnail": meta.get("thumbnail"),
+        "url": url_for("api_get_receipt", file_id=str(doc["_id"])),
+    }
+
+
+def receipt_usage(user_id):
+    user = users_col.find_one({"_id": ObjectId(user_id)}, {"receipt_bytes": 1}) or {}
+    return user.get("receipt_bytes", 0)
+
+
+def charge_receipt_bytes(user_id, size):
+    """Add ``size`` to the user's stored bytes unless that would pass the quota."""
+    result = users_col.update_one(
+        {"_id": ObjectId(user_id),
+         "$expr": {"$lte": [{"$add": [{"$ifNull": ["$receipt_bytes", 0]}, size]}, RECEIPT_QUOTA_BYTES]}},
+        {"$inc": {"receipt_bytes": size}}
+    )
+    return result.modified_count == 1
+
+
+def delete_receipt_files(user_id, query):
+    """Delete the user's receipts matching ``query`` (and their thumbnails); returns how many."""
+    docs = list(receipt_files_col.find(
+        {**query, "metadata.user_id": user_id, "metadata.kind": "receipt"},
+        {"length": 1, "metadata.thumbnail_id": 1}
+    ))
+    if not docs:
+        return 0
+    file_ids = [d["_id"] for d in docs] + [d["metadata"]["thumbnail_id"] for d in docs
+                                           if d["metadata"].get("thumbnail_id")]
+    # Files first: an interrupted delete leaves unreachable chunks, never a file missing chunks
+    receipt_files_col.delete_many({"_id": {"$in": file_ids}})
+    receipt_chunks_col.delete_many({"files_id": {"$in": file_ids}})
+    users_col.update_one({"_id": ObjectId(user_id)}, {"$inc": {"receipt_bytes": -sum(d["length"] for d in docs)}})
+    return len(docs)
+
+
+def delete_transaction_receipts(user_id, tx_ids):
+    """Receipts go with their expense; failures only leave orphaned files."""
+    try:
+        delete_receipt_files(user_id, {"metadata.transaction_id": {"$in": list(tx_ids)}})
+    except Exception as e:
+        print(f"Error deleting receipts: {str(e)}")
+
+
+def render_receipt_thumbnail(file_id):
+    doc = receipt_files_col.find_one({"_id": file_id})
+    if not doc or doc["metadata"].get("thumbnail_id"):
+        return
+    try:
+        with receipts_fs.open_download_stream(file_id) as src:
+            data = make_thumbnail(src, RECEIPT_THUMB_SIZE)
+    except Exception as e:
+        print(f"Cannot thumbnail receipt {file_id}: {str(e)}")
+        data = None
+    if data is None:
+        receipt_files_col.update_one({"_id": file_id}, {"$set": {"metadata.thumbnail": "failed"}})
+        return
+    thumb_id = receipts_fs.upload_from_stream(f"thumb-{file_id}.jpg", data, metadata={
+        "user_id": doc["metadata"]["user_id"], "kind": "thumbnail", "of": file_id, "content_type": "image/jpeg"
+    })
+    result = receipt_files_col.update_one(
+        {"_id": file_id, "metadata.thumbnail_id": {"$exists": False}},
+        {"$set": {"metadata.thumbnail_id": thumb_id, "metadata.thumbnail": "ready"}}
+    )
+    if result.modified_count == 0:
+        # Rendered twice (a retry raced the first run) or the receipt was deleted
+        receipts_fs.delete(thumb_id)
+
+
+if not HAVE_PILLOW:
+    print("Warning: Pillow is not installed, receipt thumbnails are disabled (pip install Pillow)")
+
+thumbnail_pool = ThumbnailPool(
+    render_receipt_thumbnail,
+    max_workers=int(os.getenv("THUMBNAIL_WORKERS", 2)),
+    max_pending=int(os.getenv("THUMBNAIL_MAX_PENDING", 64))
+)
+
+
+def store_receipt(user_id, tx_id, filename, chunks, used):
+    """Stream one uploaded file (an iterator of byte chunks) into GridFS.
+
+    Returns the stored file document; raises ReceiptRejected.
+    """
+    head, grid_in, size = b"", None, 0
+
+    def open_upload(head):
+        content_type = sniff_content_type(head)
+        if content_type is None:
+            raise ReceiptRejected("receipts must be JPEG, PNG, WebP, HEIC or PDF", 415)
+        stream = receipts_fs.open_upload_stream(filename, metadata={
+            "user_id": user_id, "transaction_id": tx_id, "kind": "receipt",
+            "content_type": content_type,
+            "thumbnail": "pending" if content_type.startswith("image/") and HAVE_PILLOW else "none",
+        })
+        stream.write(head)
+        return stream
+
+    try:
+        for data in chunks:
+            size += len(data)
+            if size > RECEIPT_MAX_BYTES:
+                raise ReceiptRejected(f"receipt larger than {RECEIPT_MAX_BYTES // (1024 * 1024)} MB", 413)
+            if used + size > RECEIPT_QUOTA_BYTES:
+                raise ReceiptRejected("receipt storage quota exceeded", 413)
+            if grid_in is not None:
+                grid_in.write(data)
+                continue
+            head += data
+            if len(head) >= SNIFF_BYTES:
+                grid_in, head = open_upload(head), b""
+        if grid_in is None:
+            if not head:
+                raise ReceiptRejected("empty receipt file", 400)
+            # A file shorter than SNIFF_BYTES: sniff what there is
+            grid_in = open_upload(head)
+        grid_in.close()
+    except BaseException:
+        if grid_in is not None and not grid_in.closed:
+            grid_in.abort()
+        raise
+    if not charge_receipt_bytes(user_id, size):
+        receipts_fs.delete(grid_in._id)
+        raise ReceiptRejected("receipt storage quota exceeded", 413)
+    return receipt_files_col.find_one({"_id": grid_in._id})
+
+
+def find_owned_expense(user_id, obj_id):
+    tx = transactions_col.find_one({"_id": obj_id, "user_id": user_id, "type": "expense"}, {"_id": 1})
+    if tx:
+        return tx
+    _, tx = find_archived(user_id, obj_id)
+    return tx if tx and tx.get("type") == "expense" else None
+
+
+# ✅ Attach receipts (multipart, field name "receipt"; several files allowed)
+@app.route("/api/expense/<expense_id>/receipts", methods=["POST"])
+def api_upload_receipts(expense_id):
+    if "user_id" not in session:
+        return jsonify({"error": "auth required"}), 403
+    try:
+        obj_id = ObjectId(expense_id)
+    except Exception:
+        return jsonify({"error": "invalid id"}), 400
+    boundary = request.mimetype_params.get("boundary")
+    if request.mimetype != "multipart/form-data" or not boundary:
+        return jsonify({"error": "upload receipts as multipart/form-data"}), 400
+    user_id = session["user_id"]
+    if not find_owned_expense(user_id, obj_id):
+        return jsonify({"error": "not found or unauthorized"}), 404
+
+    used = receipt_usage(user_id)
+    if request.content_length and used + request.content_length > RECEIPT_QUOTA_BYTES + 64 * 1024:
+        return jsonify({"error": "receipt storage quota exceeded", "used": used, "quota": RECEIPT_QUOTA_BYTES}), 413
+
+    events = multipart_events(request.stream, boundary, RECEIPT_CHUNK_BYTES)
+    saved = []
+
+    def file_chunks():
+        # Data events of the current file part, ending with its last chunk
+        for kind, event in events:
+            if kind != "data":
+                raise ValueError("unexpected multipart event")
+            yield event.data
+            if not event.more_data:
+                return
+
+    try:
+        for kind, event in events:
+            if kind != "file" or event.name != "receipt":
+                continue  # other parts' data is skipped by the loop
+            filename = secure_filename(event.filename or "")[:200] or "receipt"
+            doc = store_receipt(user_id, obj_id, filename, file_chunks(), used)
+            used += doc["length"]
+            saved.append(doc)
+            if doc["metadata"]["thumbnail"] == "pending":
+                thumbnail_pool.submit(doc["_id"])
+    except ReceiptRejected as e:
+        return jsonify({"error": str(e), "saved": [serialize_receipt(d) for d in saved],
+                        "used": used, "quota": RECEIPT_QUOTA_BYTES}), e.status
+    except ValueError:
+        return jsonify({"error": "malformed multipart body", "saved": [serialize_receipt(d) for d in saved]}), 400
+
+    if not saved:
+        return jsonify({"error": "no receipt file in the upload"}), 400
+    return jsonify({"success": True, "receipts": [serialize_receipt(d) for d in saved],
+                    "used": used, "quota": RECEIPT_QUOTA_BYTES}), 201
+
+
+# ✅ List an expense's receipts
+@app.route("/api/expense/<expense_id>/receipts", methods=["GET"])
+def api_list_receipts(expense_id):
+    if "user_id" not in session:
+        return jsonify({"error": "auth required"}), 403
+    try:
+        obj_id = ObjectId(expense_id)
+    except Exception:
+        return jsonify({"error": "invalid id"}), 400
+    docs = receipt_files_col.find({"metadata.user_id": session["user_id"], "metadata.transaction_id": obj_id,
+                                   "metadata.kind": "receipt"}).sort("uploadDate", 1)
+    return jsonify({"success": True, "receipts": [serialize_receipt(d) for d in docs]}), 200
+
+
+# ✅ Receipt usage against the quota
+@app.route("/api/receipts/usage", methods=["GET"])
+def api_receipt_usage():
+    if "user_id" not in session:
+        return jsonify({"error": "auth required"}), 403
+    return jsonify({"success": True, "used": receipt_usage(session["user_id"]), "quota": RECEIPT_QUOTA_BYTES}), 200
+
+
+def if_range_matches(etag, modified):
+    """Whether the request's If-Range (if it sent one) still names this file."""
+    if_range = request.if_range  # always an IfRange object, empty without the header
+    if if_range.etag is None and if_range.date is None:
+        return True
+    if if_range.etag is not None:
+        return if_range.etag == etag
+    # HTTP dates have whole seconds
+    return if_range.date.replace(tzinfo=None) >= modified.replace(tzinfo=None, microsecond=0)
+
+
+# ✅ Download a receipt (?size=thumb for its thumbnail); supports Range and ETag
+@app.route("/api/receipts/<file_id>", methods=["GET"])
+def api_get_receipt(file_id):
+    if "user_id" not in session:
+        return jsonify({"error": "auth required"}), 403
+    try:
+        obj_id = ObjectId(file_id)
+    except Exception:
+        return jsonify({"error": "invalid id"}), 400
+    doc = receipt_files_col.find_one({"_id": obj_id, "metadata.user_id": session["user_id"], "metadata.kind": "receipt"})
+    if not doc:
+        return jsonify({"error": "not found"}), 404
+
+    if request.args.get("size") == "thumb":
+        meta = doc["metadata"]
+        if not meta.get("thumbnail_id"):
+            age = (datetime.utcnow() - doc["uploadDate"].replace(tzinfo=None)).total_seconds()
+            if meta.get("thumbnail") == "pending" and age > RECEIPT_THUMB_RETRY_SECONDS:
+                thumbnail_pool.submit(doc["_id"])  # lost with a restarted worker
+            return jsonify({"error": "no thumbnail", "thumbnail": meta.get("thumbnail")}), 404
+        doc = receipt_files_col.find_one({"_id": meta["thumbnail_id"]})
+        if not doc:
+            return jsonify({"error": "not found"}), 404
+
+    # Stored files never change, so the id is a strong validator
+    etag = str(doc["_id"])
+    length = doc["length"]
+    if etag in request.if_none_match:
+        return Response(status=304, headers={"ETag": f'"{etag}"', "Cache-Control": "private, max-age=31536000, immutable"})
+
+    start, stop, status = 0, length, 200
+    # Multi-range requests and a stale If-Range get the whole file
+    if request.range and len(request.range.ranges) == 1 and if_range_matches(etag, doc["uploadDate"]):
+        bounds = request.range.range_for_length(length)
+        if bounds is None:
+            return Response(status=416, headers={"Content-Range": f"bytes */{length}"})
+        start, stop = bounds
+        status = 206
+
+    grid_out = receipts_fs.open_download_stream(doc["_id"])
+    grid_out.seek(start)
+
+    def generate():
+        remaining = stop - start
+        try:
+            while remaining > 0:
+                chunk = grid_out.read(min(RECEIPT_CHUNK_BYTES, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+        finally:
+            grid_out.close()
+
+    response = Response(generate(), status=status, mimetype=doc["metadata"]["content_type"])
+    response.headers["Content-Length"] = str(stop - start)
+    response.headers["Accept-Ranges"] = "bytes"
+    if status == 206:
+        response.headers["Content-Range"] = f"bytes {start}-{stop - 1}/{length}"
+    response.headers["ETag"] = f'"{etag}"'
+    response.headers["Cache-Control"] = "private, max-age=31536000, immutable"
+    response.last_modified = doc["uploadDate"]
+    response.headers["Content-Disposition"] = f'inline; filename="{doc.get("filename") or "receipt"}"'
+    return response
+
+
+# ✅ Delete a receipt
+@app.route("/api/receipts/<file_id>", methods=["DELETE"])
+def api_delete_receipt(file_id):
+    if "user_id" not in session:
+        return jsonify({"error": "auth required"}), 403
+    try:
+        obj_id = ObjectId(file_id)
+    except Exception:
+        return jsonify({"error": "invalid id"}), 400
+    if not delete_receipt_files(session["user_id"], {"_id": obj_id}):
+        return jsonify({"error": "not found"}), 404
+    return jsonify({"success": True, "message": "Receipt deleted successfully"}), 200
+
 
 # -------------------- VISUALIZATION --------------------
 @app.route("/visualization")
+@query_budget(max_queries=4)
 def visualization_page():
     try:
         if "user_id" not in session:
@@ -1139,18 +4599,19 @@ def visualization_page():
         
         user_id = session["user_id"]
         
-        # Get all transactions for visualization with error handling
+        # Load the user's columns with error handling
         try:
-            txs = list(transactions_col.find({"user_id": user_id}))
+            entry = tx_cache.get(user_id)
         except Exception as e:
             print(f"Database error in visualization_page: {str(e)}")
             print(traceback.format_exc())
-            txs = []
+            entry = None
         
         # Calculate totals with error handling
         try:
-            total_income = sum(float(t.get("amount", 0)) for t in txs if t.get("type") == "income")
-            total_expense = sum(float(t.get("amount", 0)) for t in txs if t.get("type") == "expense")
+            totals = entry.totals()
+            total_income = to_major(totals["income"])
+            total_expense = to_major(totals["expense"])
         except Exception as e:
             print(f"Error calculating totals in visualization_page: {str(e)}")
             total_income = 0.0
@@ -1159,37 +4620,24 @@ def visualization_page():
         # Calculate category expenses with error handling
         category_expenses = {}
         income_sources = {}
+        trend = {"labels": [], "income": [], "expense": []}
         
         try:
-            for t in txs:
-                try:
-                    amt = float(t.get("amount", 0))
-                    if t.get("type") == "expense":
-                        category = t.get("category") or "Other"
-                        category_expenses[category] = category_expenses.get(category, 0) + amt
-                    elif t.get("type") == "income":
-                        source = t.get("source") or "Other"
-                        income_sources[source] = income_sources.get(source, 0) + amt
-                except (ValueError, TypeError):
-                    continue
+            for category, total in entry.by_label(KIND_EXPENSE).items():
+                category_expenses[category] = to_major(total)
+            for source, total in entry.by_label(KIND_INCOME).items():
+                income_sources[source] = to_major(total)
+            trend = monthly_trend(entry)
         except Exception as e:
             print(f"Error calculating categories in visualization_page: {str(e)}")
         
-        # Convert ObjectIds for JSON
-        try:
-            for t in txs:
-                if "_id" in t and t["_id"]:
-                    t["_id"] = str(t["_id"])
-        except Exception as e:
-            print(f"Error converting ObjectIds in visualization_page: {str(e)}")
-        
         return render_template(
             "visualization.html",
             total_income=total_income,
             total_expense=total_expense,
             category_expenses=category_expenses if category_expenses else {},
             income_sources=income_sources if income_sources else {},
-            transactions=txs if txs else []
+            monthly_trend=trend
         )
     except Exception as e:
         print(f"Error in visualization_page: {str(e)}")
@@ -1197,51 +4645,276 @@ def visualization_page():
         flash("An error occurred loading visualization. Please try again.", "error")
         return redirect(url_for("dashboard"))
 
+def visualization_summary(owner):
+    """Totals by type and by label for ``owner`` (a user id, or {"$in": member ids})."""
+    totals = transaction_totals({"user_id": owner})
+
+    # Expenses group by category, income by source
+    label_expr = {"$cond": [
+        {"$in": [{"$ifNull": ["$category", ""]}, [""]]},
+        {"$cond": [{"$in": [{"$ifNull": ["$source", ""]}, [""]]}, "Other", "$source"]},
+        "$category"
+    ]}
+    by_category = {}
+    for row in merged_aggregate({"user_id": owner}, [
+        {"$group": {"_id": label_expr, "total": {"$sum": MINOR_AMOUNT_EXPR}}}
+    ]):
+        by_category[row["_id"]] = to_major(row["total"])
+
+    return {
+        "by_type": {"income": to_major(totals["income"]), "expense": to_major(totals["expense"])},
+        "by_category": by_category,
+        "net_balance": to_major(totals["income"] - totals["expense"])
+    }
+
+
 @app.route("/api/visualization/summary", methods=["GET"])
+@query_budget(max_queries=4)
+@shed_load("analytics", stale=True)
 def api_visualization_summary():
     if "user_id" not in session:
         return jsonify({"error": "auth required"}), 403
 
-    user_id = session["user_id"]
-    txs = list(transactions_col.find({"user_id": user_id}))
+    return jsonify({
+        "success": True,
+        "message": "Visualization data fetched successfully!",
+        "summary": visualization_summary(session["user_id"])
+    }), 200
 
-    summary = {
-        "by_type": {"income": 0.0, "expense": 0.0},
-        "by_category": {},
-        "net_balance": 0.0
-    }
 
-    for t in txs:
-        try:
-            t_type = t.get("type", "").lower()
-            amt = float(t.get("amount", 0))
-            category = t.get("category") or t.get("source") or "Other"
+# ✅ Burn rate, month-end projection, category moving averages and anomalies
+@app.route("/api/analytics/forecast", methods=["GET"])
+@shed_load("analytics", stale=True)
+def api_analytics_forecast():
+    if "user_id" not in session:
+        return jsonify({"error": "auth required"}), 403
+
+    try:
+        cols = tx_cache.get(session["user_id"]).to_columns()
+        result = forecast(cols, to_major=to_major)
+    except Exception as e:
+        print(f"Error in api_analytics_forecast: {str(e)}")
+        print(traceback.format_exc())
+        return jsonify({"error": "Failed to compute forecast"}), 500
 
-            # Update type totals
-            if t_type in ["income", "expense"]:
-                summary["by_type"][t_type] += amt
+    return jsonify({"success": True, "forecast": result}), 200
 
-            # Update category totals
-            if category not in summary["by_category"]:
-                summary["by_category"][category] = 0
-            summary["by_category"][category] += amt
 
-        except Exception as e:
-            print("Error processing transaction:", e)
-            continue
+# -------------------- ADMIN: REQUEST PROFILES --------------------
+@app.route("/api/admin/profiles", methods=["GET"])
+def api_admin_list_profiles():
+    denied = require_admin_json()
+    if denied:
+        return denied
+    return jsonify({"success": True, "profiles": profile_store.list()}), 200
 
-    # Calculate net balance
-    summary["net_balance"] = summary["by_type"]["income"] - summary["by_type"]["expense"]
 
+@app.route("/api/admin/profiles/<profile_id>", methods=["GET"])
+def api_admin_get_profile(profile_id):
+    """Profile JSON (summary, Mongo timeline, top functions); ?format=prof for raw cProfile stats."""
+    denied = require_admin_json()
+    if denied:
+        return denied
+    ext = "prof" if request.args.get("format") == "prof" else "json"
+    path = profile_store.path(profile_id, ext)
+    if not path:
+        return jsonify({"error": "not found"}), 404
+    return send_file(path, mimetype="application/json" if ext == "json" else "application/octet-stream",
+                     as_attachment=ext == "prof", download_name=f"{profile_id}.{ext}")
+
+
+@app.route("/api/admin/profiles/token", methods=["POST"])
+def api_admin_profile_token():
+    """Mint a short-lived X-Profile header value."""
+    denied = require_admin_json()
+    if denied:
+        return denied
+    if not PROFILING_SECRET:
+        return jsonify({"error": "PROFILING_SECRET is not configured"}), 503
     return jsonify({
         "success": True,
-        "message": "Visualization data fetched successfully!",
-        "summary": summary
+        "header": "X-Profile",
+        "token": sign_token(PROFILING_SECRET, PROFILE_TOKEN_TTL_SECONDS),
+        "expires_in": PROFILE_TOKEN_TTL_SECONDS
+    }), 200
+
+
+# -------------------- SPENDING DISTRIBUTIONS --------------------
+# Each user x category keeps a t-digest of expense amounts (paise) in
+# ``spending_sketches``: ``digest`` holds the compressed centroids and
+# ``pending`` the raw amounts pushed since the last compaction. New expenses
+# are a single $push; every SKETCH_COMPACT_AT amounts the pending values are
+# folded into the digest with a version compare-and-set, removing only the
+# values that were folded so concurrent pushes are never lost.
+SKETCH_COMPACT_AT = int(os.getenv("SKETCH_COMPACT_AT", 64))
+
+
+def sketch_key(user_id, category):
+    return f"{user_id}:{category}"
+
+
+def record_expense_amount(user_id, category, amount_minor):
+    category = category or "Other"
+    doc = sketches_col.find_one_and_update(
+        {"_id": sketch_key(user_id, category)},
+        {"$push": {"pending": amount_minor}, "$inc": {"pending_count": 1},
+         "$setOnInsert": {"user_id": user_id, "category": category, "digest": None, "count": 0, "version": 0}},
+        projection={"pending_count": 1},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    if doc["pending_count"] >= SKETCH_COMPACT_AT:
+        compact_sketch(doc["_id"])
+
+
+def compact_sketch(key):
+    """Fold pending amounts into the stored digest; False if another writer won the race."""
+    doc = sketches_col.find_one({"_id": key})
+    if not doc or not doc.get("pending"):
+        return False
+    folded = len(doc["pending"])
+    digest = TDigest.from_bytes(doc.get("digest")).update(doc["pending"])
+    result = sketches_col.update_one({"_id": key, "version": doc["version"]}, [
+        {"$set": {
+            "digest": digest.to_bytes(),
+            "count": len(digest),
+            "pending": {"$slice": ["$pending", folded, {"$max": [{"$size": "$pending"}, 1]}]},
+            "pending_count": {"$subtract": ["$pending_count", folded]},
+            "version": {"$add": ["$version", 1]},
+            "updated_at": "$$NOW"
+        }}
+    ])
+    return result.modified_count == 1
+
+
+def rebuild_sketches(user_id):
+    """Recompute every category sketch of ``user_id`` from full history (hot + archived)."""
+    entry = tx_cache.get(user_id)
+    digests = {}
+    mask = entry.kinds == KIND_EXPENSE
+    for code, amount in zip(entry.labels[mask].tolist(), entry.amounts[mask].tolist()):
+        digests.setdefault(entry.label_names[code], TDigest()).add(amount)
+    ops = [
+        UpdateOne(
+            {"_id": sketch_key(user_id, category)},
+            {"$set": {"user_id": user_id, "category": category, "digest": digest.to_bytes(),
+                      "count": len(digest), "pending": [], "pending_count": 0, "updated_at": datetime.utcnow()},
+             "$inc": {"version": 1}},
+            upsert=True
+        )
+        for category, digest in digests.items()
+    ]
+    if ops:
+        sketches_col.bulk_write(ops, ordered=False)
+    sketches_col.delete_many({"user_id": user_id, "category": {"$nin": list(digests)}})
+    users_col.update_one({"_id": ObjectId(user_id)}, {"$set": {"sketches_built_at": datetime.utcnow()}})
+    return digests
+
+
+def load_sketches(user_id, category=None):
+    """{category: TDigest} for the user, building them from history on first use."""
+    user = users_col.find_one({"_id": ObjectId(user_id)}, {"sketches_built_at": 1})
+    if user and not user.get("sketches_built_at"):
+        digests = rebuild_sketches(user_id)
+        return {c: d for c, d in digests.items() if category in (None, c)}
+    query = {"user_id": user_id}
+    if category:
+        query["category"] = category
+    digests = {}
+    for doc in reads(sketches_col).find(query, session=db_session()):
+        digests[doc["category"]] = TDigest.from_bytes(doc.get("digest")).update(doc.get("pending") or [])
+    return digests
+
+
+def distribution_payload(digest):
+    summary = summarize(digest)
+    return {name: value if name == "count" else round(to_major(value), 2) for name, value in summary.items()}
+
+
+# ✅ Median, p90 and outlier threshold of expense amounts per category
+@app.route("/api/analytics/distribution", methods=["GET"])
+@shed_load("analytics", stale=True)
+def api_analytics_distribution():
+    """?category=Food narrows to one category; adding &amount=2500 returns an
+    "unusually large" hint for that amount."""
+    if "user_id" not in session:
+        return jsonify({"error": "auth required"}), 403
+    category = (request.args.get("category") or "").strip() or None
+    amount = (request.args.get("amount") or "").strip()
+    try:
+        amount_minor = to_minor(amount) if amount else None
+    except (InvalidOperation, ValueError):
+        return jsonify({"error": "amount must be a number"}), 400
+
+    try:
+        digests = load_sketches(session["user_id"], category)
+    except Exception as e:
+        print(f"Error in api_analytics_distribution: {str(e)}")
+        print(traceback.format_exc())
+        return jsonify({"error": "Failed to load distributions"}), 500
+
+    result = {"success": True, "distributions": {c: distribution_payload(d) for c, d in digests.items() if len(d)}}
+    if category and amount_minor is not None:
+        digest = digests.get(category)
+        if digest is None or not len(digest):
+            result["hint"] = None
+        else:
+            threshold = summarize(digest)["outlier_threshold"]
+            result["hint"] = {
+                "amount": to_major(amount_minor),
+                "percentile": round(digest.cdf(amount_minor) * 100, 1),
+                "unusual": amount_minor > threshold
+            }
+    return jsonify(result), 200
+
+
+# ✅ Rebuild the user's distribution sketches from history (after deletes or edits)
+@app.route("/api/analytics/distribution/rebuild", methods=["POST"])
+def api_rebuild_distribution():
+    if "user_id" not in session:
+        return jsonify({"error": "auth required"}), 403
+    try:
+        digests = rebuild_sketches(session["user_id"])
+    except Exception as e:
+        print(f"Error in api_rebuild_distribution: {str(e)}")
+        print(traceback.format_exc())
+        return jsonify({"error": "Failed to rebuild distributions"}), 500
+    return jsonify({"success": True, "categories": len(digests)}), 200
+
+
+# ✅ Load-shedding state for this worker process (breaker, limiters, stale payloads)
+@app.route("/api/metrics/load", methods=["GET"])
+def api_load_metrics():
+    if "user_id" not in session:
+        return jsonify({"error": "auth required"}), 403
+    return jsonify({
+        "success": True,
+        "pid": os.getpid(),
+        "enabled": LOAD_SHEDDING_ENABLED,
+        "breaker": mongo_breaker.stats(),
+        "limiters": {name: limiter.stats() for name, limiter in ROUTE_LIMITERS.items()},
+        "stale": stale_payloads.stats()
+    }), 200
+
+
+# ✅ Columnar cache memory usage for this worker process
+@app.route("/api/cache/stats", methods=["GET"])
+def api_cache_stats():
+    if "user_id" not in session:
+        return jsonify({"error": "auth required"}), 403
+    return jsonify({
+        "success": True,
+        "pid": os.getpid(),
+        "stats": tx_cache.stats(),
+        "warmup": dashboard_warmer.stats(),
+        "thumbnails": thumbnail_pool.stats(),
+        "subscription_calendar": calendar_cache.stats()
     }), 200
 
 
 # -------------------- PROFILE --------------------
 @app.route("/profile")
+@query_budget(max_queries=6)
 def profile_page():
     try:
         if "user_id" not in session:
@@ -1266,23 +4939,23 @@ def profile_page():
         
         # Get user statistics with error handling
         try:
-            all_tx = list(transactions_col.find({"user_id": user_id}))
-            total_income = sum(float(t.get("amount", 0)) for t in all_tx if t.get("type") == "income")
-            total_expense = sum(float(t.get("amount", 0)) for t in all_tx if t.get("type") == "expense")
-            balance = total_income - total_expense
+            totals = tx_cache.get(user_id).totals()
+            total_income = to_major(totals["income"])
+            total_expense = to_major(totals["expense"])
+            balance = to_major(totals["income"] - totals["expense"])
         except Exception as e:
             print(f"Error calculating statistics in profile_page: {str(e)}")
             print(traceback.format_exc())
-            all_tx = []
+            totals = {"count": 0}
             total_income = 0.0
             total_expense = 0.0
             balance = 0.0
         
         # Get counts with error handling
         try:
-            cards_count = cards_col.count_documents({"user_id": user_id})
-            subscriptions_count = subscriptions_col.count_documents({"user_id": user_id})
-            transactions_count = len(all_tx)
+            cards_count = reads(cards_col).count_documents({"user_id": user_id}, session=db_session())
+            subscriptions_count = reads(subscriptions_col).count_documents({"user_id": user_id}, session=db_session())
+            transactions_count = totals["count"]
         except Exception as e:
             print(f"Error getting counts in profile_page: {str(e)}")
             cards_count = 0
@@ -0,0 +1,233 @@
+# loadshed.py
+"""Load shedding for slow-database episodes.
+
+``AdaptiveLimiter`` caps concurrent requests per route class and adjusts the
+cap with AIMD on observed latency, so a Mongo slowdown shrinks the number of
+requests waiting on it. ``CircuitBreaker`` opens when the failure or
+slow-call rate over a rolling window is too high and lets a single probe
+through after a cool-down.
+``StaleCache`` keeps the last good payload per key so shed requests can be
+answered with slightly old data instead of an error.
+"""
+from collections import OrderedDict
+import threading
+import time
+
+from pymongo import monitoring
+
+# Client-side failures that mean "the database is unhealthy", not "bad request"
+UNHEALTHY_ERRTYPES = {"AutoReconnect", "ConnectionFailure", "NetworkTimeout",
+                      "ServerSelectionTimeoutError", "WaitQueueTimeoutError"}
+MAX_TIME_MS_EXPIRED = 50
+
+
+class AdaptiveLimiter:
+    def __init__(self, name, initial=16, min_limit=2, max_limit=64,
+                 queue_timeout=0.5, target_latency_ms=250):
+        self.name = name
+        self.limit = float(initial)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.queue_timeout = queue_timeout
+        self.target_latency_ms = target_latency_ms
+        self.in_flight = 0
+        self.waiting = 0
+        self.shed = self.admitted = 0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        """Take a slot, waiting up to ``queue_timeout``; False if none freed up."""
+        deadline = time.monotonic() + self.queue_timeout
+        with self._cond:
+            self.waiting += 1
+            try:
+                while self.in_flight >= int(self.limit):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.shed += 1
+                        return False
+                    self._cond.wait(remaining)
+                self.in_flight += 1
+                self.admitted += 1
+                return True
+            finally:
+                self.waiting -= 1
+
+    def release(self, latency_ms, ok=True):
+        with self._cond:
+            self.in_flight -= 1
+            if ok and latency_ms <= self.target_latency_ms:
+                # Additive increase: about +1 per window of ``limit`` fast requests
+                self.limit = min(self.max_limit, self.limit + 1.0 / self.limit)
+            else:
+                # Multiplicative decrease on slow or failed requests
+                self.limit = max(self.min_limit, self.limit * 0.9)
+            self._cond.notify()
+
+    def stats(self):
+        with self._cond:
+            return {
+                "limit": int(self.limit),
+                "in_flight": self.in_flight,
+                "waiting": self.waiting,
+                "admitted": self.admitted,
+                "shed": self.shed,
+            }
+
+
+class CircuitBreaker(monitoring.CommandListener):
+    """Trips when too many recent Mongo commands fail or run slow.
+
+    Registered as a pymongo command listener so every command feeds a rolling
+    window of per-second buckets; the breaker opens once the window holds at
+    least ``min_calls`` commands and either the failure rate or the slow-call
+    rate reaches its threshold. Callers can also ``record_failure()`` errors
+    that never reach the wire (e.g. server selection timeouts).
+
+    While open or half-open, only the probe request admitted by ``allow()``
+    decides the outcome: pymongo publishes command events on the thread that
+    ran the command, so events from any other thread are ignored. A failed or
+    slow probe command reopens the breaker; a probe that finishes after only
+    healthy commands closes it. ``clock`` (seconds, monotonic) is
+    injectable for tests.
+    """
+
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, failure_rate=0.5, slow_call_rate=0.5, min_calls=20,
+                 window_seconds=10, reset_timeout=10.0, slow_call_ms=1000, clock=time.monotonic):
+        self.failure_rate = failure_rate
+        self.slow_call_rate = slow_call_rate
+        self.min_calls = min_calls
+        self.window_seconds = int(window_seconds)
+        self.reset_timeout = reset_timeout
+        self.slow_call_ms = slow_call_ms
+        self.clock = clock
+        self.state = self.CLOSED
+        self.opened_at = None
+        self.trips = self.rejected = 0
+        # [second, calls, failures, slow] per slot, indexed by second % window
+        self._buckets = [[0, 0, 0, 0] for _ in range(self.window_seconds)]
+        self._probe_thread = None
+        self._probe_calls = 0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """Whether a request may touch Mongo right now."""
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and self.clock() - self.opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                self._probe_thread = None
+            if self.state == self.HALF_OPEN and self._probe_thread is None:
+                self._probe_thread = threading.get_ident()
+                self._probe_calls = 0
+                return True
+            self.rejected += 1
+            return False
+
+    def finish_probe(self):
+        """End a request admitted by ``allow()``. Closes the breaker if this
+        was the half-open probe and all its commands were healthy; lets another
+        probe through if it finished without touching Mongo."""
+        with self._lock:
+            if self.state != self.HALF_OPEN or self._probe_thread != threading.get_ident():
+                return
+            if self._probe_calls:
+                self.state = self.CLOSED
+                for bucket in self._buckets:
+                    bucket[:] = [0, 0, 0, 0]
+            self._probe_thread = None
+
+    def record_failure(self):
+        self._record(failed=True, slow=False)
+
+    def _record(self, failed, slow):
+        with self._lock:
+            if self.state != self.CLOSED:
+                if self.state == self.HALF_OPEN and self._probe_thread == threading.get_ident():
+                    if failed or slow:
+                        self._open()
+                    else:
+                        self._probe_calls += 1
+                return
+            now = int(self.clock())
+            bucket = self._buckets[now % self.window_seconds]
+            if bucket[0] != now:
+                bucket[:] = [now, 0, 0, 0]
+            bucket[1] += 1
+            bucket[2] += failed
+            bucket[3] += slow
+            calls, failures, slow_calls = self._window(now)
+            if calls >= self.min_calls and (failures >= self.failure_rate * calls
+                                            or slow_calls >= self.slow_call_rate * calls):
+                self._open()
+
+    def _window(self, now):
+        live = [b for b in self._buckets if now - b[0] < self.window_seconds]
+        return sum(b[1] for b in live), sum(b[2] for b in live), sum(b[3] for b in live)
+
+    def _open(self):
+        self.state = self.OPEN
+        self.opened_at = self.clock()
+        self.trips += 1
+        self._probe_thread = None
+
+    # ---- pymongo command listener ----------------------------------------
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        self._record(failed=False, slow=event.duration_micros / 1000 > self.slow_call_ms)
+
+    def failed(self, event):
+        failure = event.failure or {}
+        unhealthy = failure.get("errtype") in UNHEALTHY_ERRTYPES or failure.get("code") == MAX_TIME_MS_EXPIRED
+        # Other server errors (duplicate keys, validation) still mean Mongo answered
+        self._record(failed=unhealthy, slow=event.duration_micros / 1000 > self.slow_call_ms)
+
+    def stats(self):
+        with self._lock:
+            calls, failures, slow_calls = self._window(int(self.clock()))
+            return {
+                "state": self.state,
+                "window_calls": calls,
+                "failure_rate": round(failures / calls, 3) if calls else 0.0,
+                "slow_call_rate": round(slow_calls / calls, 3) if calls else 0.0,
+                "open_for_seconds": round(self.clock() - self.opened_at, 1)
+                if self.state != self.CLOSED and self.opened_at else 0,
+                "trips": self.trips,
+                "rejected": self.rejected,
+            }
+
+
+class StaleCache:
+    """Bounded LRU of the last good payload per key."""
+
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.served = 0
+
+    def put(self, key, payload):
+        with self._lock:
+            self._entries[key] = (payload, time.time())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def get(self, key):
+        """(payload, age_seconds) or (None, None)."""
+        with self._lock:
+            hit = self._entries.get(key)
+            if hit is None:
+                return None, None
+            self.served += 1
+            payload, stored_at = hit
+            return payload, time.time() - stored_at
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "served": self.served}
@@ -0,0 +1,226 @@
+# profiler.py
+"""Opt-in per-request profiling: cProfile plus the Mongo command timeline.
+
+A request is profiled when it carries a valid admin-signed token or is
+picked by sampling. ``RequestProfile`` runs cProfile around the handler,
+``CommandTimeline`` (a pymongo command listener) records every command the
+handler's thread sends while a profile is active, and ``ProfileStore`` keeps
+the newest profiles on disk, deleting the oldest beyond its limits.
+"""
+from datetime import datetime
+import cProfile
+import hashlib
+import hmac
+import io
+import json
+import os
+import pstats
+import re
+import threading
+import time
+import uuid
+
+from pymongo import monitoring
+
+_local = threading.local()
+
+# cProfile cannot run two profilers at once in one process (Python 3.12+
+# rejects it outright), so concurrent profiled requests get the Mongo
+# timeline only.
+_cprofile_lock = threading.Lock()
+
+PROFILE_ID = re.compile(r"^\d{8}T\d{6}-[0-9a-f]{8}$")
+
+
+def sign_token(secret, ttl_seconds=600, now=None):
+    """Token for the profiling header: "<expires>.<hmac-sha256(expires)>"."""
+    expires = int((now or time.time()) + ttl_seconds)
+    mac = hmac.new(secret.encode(), str(expires).encode(), hashlib.sha256).hexdigest()
+    return f"{expires}.{mac}"
+
+
+def verify_token(secret, token, now=None):
+    if not secret or not token:
+        return False
+    expires, _, mac = token.partition(".")
+    if not expires.isdigit() or int(expires) < (now or time.time()):
+        return False
+    expected = hmac.new(secret.encode(), expires.encode(), hashlib.sha256).hexdigest()
+    return hmac.compare_digest(mac, expected)
+
+
+class CommandTimeline(monitoring.CommandListener):
+    """Records the commands a thread sends while it has an active RequestProfile.
+
+    pymongo publishes command events on the thread that runs the operation,
+    so a thread-local is enough to attribute them to the right request.
+    """
+
+    def started(self, event):
+        profile = getattr(_local, "profile", None)
+        if profile is None:
+            return
+        target = event.command.get(event.command_name)
+        profile.pending[event.request_id] = {
+            "command": event.command_name,
+            "database": event.database_name,
+            "collection": target if isinstance(target, str) else None,
+            "offset_ms": round((time.perf_counter() - profile.started) * 1000, 3),
+        }
+
+    def succeeded(self, event):
+        self._finish(event, "ok")
+
+    def failed(self, event):
+        self._finish(event, "failed", str(event.failure))
+
+    def _finish(self, event, status, error=None):
+        profile = getattr(_local, "profile", None)
+        if profile is None:
+            return
+        entry = profile.pending.pop(event.request_id, None)
+        if entry is None:
+            return
+        entry["duration_ms"] = event.duration_micros / 1000
+        entry["status"] = status
+        if error:
+            entry["error"] = error
+        profile.commands.append(entry)
+
+
+class RequestProfile:
+    def __init__(self, method, path, reason, user_id=None):
+        self.id = f"{datetime.utcnow():%Y%m%dT%H%M%S}-{uuid.uuid4().hex[:8]}"
+        self.method = method
+        self.path = path
+        self.reason = reason
+        self.user_id = user_id
+        self.created_at = datetime.utcnow()
+        self.commands = []
+        self.pending = {}
+        self.status = None
+        self.duration_ms = None
+        self.started = time.perf_counter()
+        self._profiler = None
+
+    def start(self):
+        if _cprofile_lock.acquire(blocking=False):
+            self._profiler = cProfile.Profile()
+            try:
+                self._profiler.enable()
+            except ValueError:
+                # Some other profiler is active in this process
+                self._profiler = None
+                _cprofile_lock.release()
+        self.started = time.perf_counter()
+        _local.profile = self
+
+    def stop(self, status=None):
+        self.duration_ms = round((time.perf_counter() - self.started) * 1000, 3)
+        self.status = status
+        if getattr(_local, "profile", None) is self:
+            _local.profile = None
+        if self._profiler is not None:
+            self._profiler.disable()
+            _cprofile_lock.release()
+
+    def stats_text(self, top=40):
+        if self._profiler is None:
+            return None
+        out = io.StringIO()
+        pstats.Stats(self._profiler, stream=out).strip_dirs().sort_stats("cumulative").print_stats(top)
+        return out.getvalue()
+
+    def to_dict(self):
+        mongo_ms = sum(c["duration_ms"] for c in self.commands)
+        return {
+            "id": self.id,
+            "created_at": self.created_at.isoformat() + "Z",
+            "method": self.method,
+            "path": self.path,
+            "reason": self.reason,
+            "user_id": self.user_id,
+            "status": self.status,
+            "duration_ms": self.duration_ms,
+            "mongo": {"commands": len(self.commands), "total_ms": round(mongo_ms, 3)},
+            "has_cprofile": self._profiler is not None,
+            "timeline": self.commands,
+            "cprofile_top": self.stats_text(),
+        }
+
+
+class ProfileStore:
+    """Directory of profiles: ``<id>.json`` (summary + timeline) and ``<id>.prof``
+    (raw cProfile stats, loadable with pstats or snakeviz)."""
+
+    SUMMARY_FIELDS = ("id", "created_at", "method", "path", "reason", "user_id",
+                      "status", "duration_ms", "mongo", "has_cprofile")
+
+    def __init__(self, directory, max_profiles=200, max_bytes=100 * 1024 * 1024):
+        self.directory = directory
+        self.max_profiles = max_profiles
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def save(self, profile):
+        data = profile.to_dict()
+        path = os.path.join(self.directory, profile.id)
+        with self._lock:
+            if profile._profiler is not None:
+                profile._profiler.dump_stats(path + ".prof.tmp")
+                os.replace(path + ".prof.tmp", path + ".prof")
+            with open(path + ".json.tmp", "w") as f:
+                json.dump(data, f, default=str)
+            os.replace(path + ".json.tmp", path + ".json")
+            self._rotate()
+        return profile.id
+
+    def list(self):
+        """Summaries of stored profiles, newest first."""
+        summaries = []
+        for name in sorted(os.listdir(self.directory), reverse=True):
+            if not name.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(self.directory, name)) as f:
+                    data = json.load(f)
+            except (OSError, ValueError):
+                continue
+            summaries.append({k: data.get(k) for k in self.SUMMARY_FIELDS})
+        return summaries
+
+    def path(self, profile_id, ext="json"):
+        """Filesystem path of a stored profile, or None (ids are validated)."""
+        if not PROFILE_ID.match(profile_id or "") or ext not in ("json", "prof"):
+            return None
+        path = os.path.join(self.directory, f"{profile_id}.{ext}")
+        return path if os.path.exists(path) else None
+
+    def _rotate(self):
+        # Profile ids start with a timestamp, so name order is age order
+        files = {}
+        for name in os.listdir(self.directory):
+            profile_id, _, ext = name.partition(".")
+            if ext in ("json", "prof"):
+                files.setdefault(profile_id, []).append(os.path.join(self.directory, name))
+        ids = sorted(files)
+        size = sum(os.path.getsize(p) for group in files.values() for p in group)
+        while ids and (len(ids) > self.max_profiles or size > self.max_bytes):
+            for p in files[ids.pop(0)]:
+                try:
+                    size -= os.path.getsize(p)
+                    os.remove(p)
+                except OSError:
+                    pass
+
+
+if __name__ == "__main__":
+    # Mint a header token: python profiler.py [ttl_seconds]  (reads PROFILING_SECRET)
+    import sys
+
+    secret = os.getenv("PROFILING_SECRET")
+    if not secret:
+        sys.exit("PROFILING_SECRET is not set")
+    ttl = int(sys.argv[1]) if len(sys.argv) > 1 else 600
+    print(sign_token(secret, ttl))
@@ -0,0 +1,125 @@
+# querybudget.py
+"""Per-request query budgets and N+1 detection from pymongo command monitoring.
+
+``QueryTracker`` counts the commands (and reply bytes) each request's thread
+sends to Mongo and groups them by *shape*, i.e. the command with every
+literal value replaced by a placeholder. Routes declare limits with
+``@query_budget(...)``; a request that goes over them, or repeats one
+shape more than ``max_repeats`` times (the N+1 pattern), produces a report.
+"""
+from collections import Counter
+import json
+import threading
+
+import bson
+from pymongo import monitoring
+
+_local = threading.local()
+
+# Commands that are part of one logical query rather than a new one
+CONTINUATIONS = {"getMore", "killCursors", "endSessions"}
+
+# Fields of a command that describe its shape; everything else is options
+SHAPE_FIELDS = ("filter", "q", "query", "pipeline", "updates", "deletes", "documents", "key")
+
+
+def query_budget(max_queries=None, max_bytes=None, max_repeats=5):
+    """Declare a route's Mongo budget. Apply below ``@app.route``."""
+    def decorate(view):
+        view._query_budget = {"max_queries": max_queries, "max_bytes": max_bytes, "max_repeats": max_repeats}
+        return view
+    return decorate
+
+
+def shape_of(value):
+    """Replace literals with "?" so queries differing only in values compare equal."""
+    if isinstance(value, dict):
+        return {k: shape_of(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        shapes = []
+        for item in value:
+            s = shape_of(item)
+            if s not in shapes:
+                shapes.append(s)
+        return shapes
+    return "?"
+
+
+def command_shape(name, command):
+    target = command.get(name)
+    shape = {"cmd": name, "coll": target if isinstance(target, str) else None}
+    for field in SHAPE_FIELDS:
+        if field in command:
+            shape[field] = shape_of(command[field])
+    return json.dumps(shape, sort_keys=True, default=str)
+
+
+class RequestQueries:
+    def __init__(self, endpoint, budget=None):
+        self.endpoint = endpoint
+        self.budget = budget or {}
+        self.queries = 0
+        self.commands = 0
+        self.bytes = 0
+        self.shapes = Counter()
+
+    def violations(self):
+        problems = []
+        max_queries = self.budget.get("max_queries")
+        max_bytes = self.budget.get("max_bytes")
+        max_repeats = self.budget.get("max_repeats")
+        if max_queries is not None and self.queries > max_queries:
+            problems.append(f"{self.queries} queries > budget {max_queries}")
+        if max_bytes is not None and self.bytes > max_bytes:
+            problems.append(f"{self.bytes} bytes returned > budget {max_bytes}")
+        if max_repeats is not None:
+            for shape, count in self.shapes.items():
+                if count > max_repeats:
+                    problems.append(f"query shape repeated {count}x (possible N+1)")
+                    break
+        return problems
+
+    def report(self):
+        return {
+            "endpoint": self.endpoint,
+            "queries": self.queries,
+            "commands": self.commands,
+            "bytes_returned": self.bytes,
+            "budget": self.budget,
+            "violations": self.violations(),
+            "repeated_shapes": [
+                {"count": count, "shape": json.loads(shape)}
+                for shape, count in self.shapes.most_common()
+                if count > 1
+            ],
+        }
+
+
+class QueryTracker(monitoring.CommandListener):
+    """Command listener feeding the thread's active RequestQueries, if any."""
+
+    def begin(self, endpoint, budget=None):
+        _local.queries = RequestQueries(endpoint, budget)
+        return _local.queries
+
+    def end(self):
+        queries = getattr(_local, "queries", None)
+        _local.queries = None
+        return queries
+
+    def started(self, event):
+        queries = getattr(_local, "queries", None)
+        if queries is None:
+            return
+        queries.commands += 1
+        if event.command_name not in CONTINUATIONS:
+            queries.queries += 1
+            queries.shapes[command_shape(event.command_name, event.command)] += 1
+
+    def succeeded(self, event):
+        queries = getattr(_local, "queries", None)
+        if queries is not None and event.reply:
+            queries.bytes += len(bson.encode(event.reply))
+
+    def failed(self, event):
+        pass
@@ -0,0 +1,129 @@
+# receipts.py
+"""Receipt attachments: streaming multipart parsing, type sniffing, thumbnails.
+
+``multipart_events`` parses a multipart body incrementally with werkzeug's
+sans-IO decoder, so file data can be written to GridFS chunk by chunk as it
+arrives instead of being buffered in memory or spooled to a temp file (as
+``request.files`` would). ``ThumbnailPool`` renders thumbnails on a small
+worker pool off the request path. Pillow is optional: without it receipts
+are stored and served as usual but get no thumbnail.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import io
+import threading
+
+from werkzeug.sansio.multipart import Data, Epilogue, Field, File, MultipartDecoder, NeedData
+
+try:
+    from PIL import Image
+except ImportError:  # optional dependency
+    Image = None
+
+HAVE_PILLOW = Image is not None
+# Refuse to decode images larger than this (decompression bombs)
+MAX_IMAGE_PIXELS = 40_000_000
+# Bytes read before sniffing; shorter files are sniffed on what they have
+SNIFF_BYTES = 16
+
+
+def multipart_events(stream, boundary, chunk_size=256 * 1024, max_form_memory_size=64 * 1024):
+    """Yield ("file", File) / ("field", Field) / ("data", Data) events from ``stream``.
+
+    Reads ``chunk_size`` bytes at a time; raises ValueError on a malformed body.
+    The decoder's buffer holds one read plus whatever a part header or a
+    partial boundary left over, capped at ``max_form_memory_size`` beyond it.
+    """
+    decoder = MultipartDecoder(boundary.encode("latin-1"), chunk_size + max_form_memory_size)
+    while True:
+        chunk = stream.read(chunk_size)
+        decoder.receive_data(chunk or None)
+        event = decoder.next_event()
+        while not isinstance(event, (NeedData, Epilogue)):
+            if isinstance(event, File):
+                yield "file", event
+            elif isinstance(event, Field):
+                yield "field", event
+            elif isinstance(event, Data):
+                yield "data", event
+            event = decoder.next_event()
+        if isinstance(event, Epilogue):
+            return
+        if not chunk:
+            raise ValueError("unexpected end of multipart body")
+
+
+def sniff_content_type(head):
+    """Content type from a file's first bytes, or None if not an accepted receipt type."""
+    if head.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if head.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    if head.startswith(b"RIFF") and head[8:12] == b"WEBP":
+        return "image/webp"
+    if head[4:8] == b"ftyp" and head[8:12] in (b"heic", b"heix", b"mif1", b"msf1"):
+        return "image/heic"
+    if head.startswith(b"%PDF-"):
+        return "application/pdf"
+    return None
+
+
+def make_thumbnail(fileobj, max_side=320):
+    """JPEG bytes of an image scaled to fit ``max_side``; None if it cannot be decoded."""
+    if not HAVE_PILLOW:
+        return None
+    with Image.open(fileobj) as img:
+        if img.width * img.height > MAX_IMAGE_PIXELS:
+            return None
+        # JPEG can decode straight at a reduced scale, which is most of the cost
+        img.draft("RGB", (max_side, max_side))
+        img.thumbnail((max_side, max_side))
+        out = io.BytesIO()
+        img.convert("RGB").save(out, "JPEG", quality=80, optimize=True)
+        return out.getvalue()
+
+
+class ThumbnailPool:
+    """Runs ``render(file_id)`` on a worker pool; submissions beyond
+    ``max_pending`` are dropped (the caller can resubmit later)."""
+
+    def __init__(self, render, max_workers=2, max_pending=64):
+        self.render = render
+        self.max_pending = max_pending
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="thumbnail")
+        self._pending = set()
+        self._lock = threading.Lock()
+        self.completed = self.failed = self.dropped = 0
+
+    def submit(self, file_id):
+        with self._lock:
+            if file_id in self._pending:
+                return True
+            if len(self._pending) >= self.max_pending:
+                self.dropped += 1
+                return False
+            self._pending.add(file_id)
+        self._executor.submit(self._run, file_id)
+        return True
+
+    def _run(self, file_id):
+        try:
+            self.render(file_id)
+            with self._lock:
+                self.completed += 1
+        except Exception as e:
+            print(f"Thumbnail of {file_id} failed: {str(e)}")
+            with self._lock:
+                self.failed += 1
+        finally:
+            with self._lock:
+                self._pending.discard(file_id)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "pillow": HAVE_PILLOW,
+                "pending": len(self._pending),
+                "completed": self.completed,
+                "failed": self.failed,
+                "dropped": self.dropped,
+            }
@@ -0,0 +1,302 @@
+# recompute.py
+"""Rebuild derived per-user data for every user, in parallel.
+
+Users are split into ``_id`` ranges ($bucketAuto) and each range is handled
+by one worker process of a ``ProcessPoolExecutor``. A worker streams its
+users in ``_id`` order, recomputes the selected derived data per user, and
+flushes the resulting writes with ``bulk_write``. After each flush it stores
+the last finished ``_id`` in ``recompute_checkpoints``, so an interrupted run
+continues where it stopped (same ``--run-id``). Writes go out with majority
+write concern and a shared ops/second budget, so the job cannot outrun
+replication or crowd the primary. The parent process prints progress.
+
+    python recompute.py --only sketches,bucket_totals --workers 4
+    python recompute.py --run-id 2026-10-rollups          # resume
+    python recompute.py --run-id 2026-10-rollups --restart
+
+Derived data (must match how app.py writes it):
+  bucket_totals   income/expense totals and counts of archive buckets
+  sketches        per-category t-digests of expense amounts
+  limit_counters  per-period limit spend (dropped; the app re-seeds on use)
+"""
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from datetime import datetime
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+import argparse
+import multiprocessing
+import os
+import sys
+import time
+
+from bson.objectid import ObjectId
+from dotenv import load_dotenv
+from pymongo import DeleteMany, MongoClient, UpdateOne
+from pymongo.write_concern import WriteConcern
+
+from sketches import TDigest
+
+load_dotenv()
+
+MINOR_UNITS = 100
+
+
+def minor_of(doc):
+    """Amount of a transaction in paise (app.tx_minor for unmigrated documents)."""
+    if doc.get("amount_minor") is not None:
+        return int(doc["amount_minor"])
+    try:
+        amount = Decimal(str(doc.get("amount") or 0))
+        return int((amount * MINOR_UNITS).quantize(Decimal("1"), rounding=ROUND_HALF_UP))
+    except (InvalidOperation, ValueError):
+        return 0
+
+
+def _typed_sum(tx_type):
+    return {"$sum": {"$map": {
+        "input": {"$filter": {"input": "$transactions", "cond": {"$eq": ["$$this.type", tx_type]}}},
+        "in": "$$this.amount_minor"
+    }}}
+
+
+def _typed_count(tx_type):
+    return {"$size": {"$filter": {"input": "$transactions", "cond": {"$eq": ["$$this.type", tx_type]}}}}
+
+
+# ---- recomputers: (db, user_id) -> [(collection name, write op)] -----------
+def recompute_bucket_totals(db, user_id):
+    ops = []
+    for b in db["transaction_buckets"].aggregate([
+        {"$match": {"user_id": user_id}},
+        {"$project": {
+            "count": {"$size": "$transactions"},
+            "income_minor": _typed_sum("income"), "income_count": _typed_count("income"),
+            "expense_minor": _typed_sum("expense"), "expense_count": _typed_count("expense"),
+            "max_sync_version": {"$ifNull": [{"$max": "$transactions.sync_version"}, 0]}
+        }}
+    ]):
+        key, count = b.pop("_id"), b["count"]
+        # A bucket the app changed since we read it is left alone (size differs)
+        ops.append(("transaction_buckets", UpdateOne(
+            {"_id": key, "transactions": {"$size": count}}, {"$set": b}
+        )))
+    return ops
+
+
+def recompute_sketches(db, user_id):
+    digests = {}
+    expenses = {"user_id": user_id, "type": "expense"}
+    fields = {"category": 1, "amount_minor": 1, "amount": 1}
+    hot = db["transactions"].find(expenses, fields, batch_size=2000)
+    archived = db["transaction_buckets"].aggregate([
+        {"$match": {"user_id": user_id}},
+        {"$unwind": "$transactions"},
+        {"$replaceRoot": {"newRoot": "$transactions"}},
+        {"$match": {"type": "expense"}},
+        {"$project": fields}
+    ], batchSize=2000)
+    for source in (hot, archived):
+        for t in source:
+            digests.setdefault(t.get("category") or "Other", TDigest()).add(minor_of(t))
+    now = datetime.utcnow()
+    ops = [
+        ("spending_sketches", UpdateOne(
+            {"_id": f"{user_id}:{category}"},
+            {"$set": {"user_id": user_id, "category": category, "digest": digest.to_bytes(),
+                      "count": len(digest), "pending": [], "pending_count": 0, "updated_at": now},
+             "$inc": {"version": 1}},
+            upsert=True
+        ))
+        for category, digest in digests.items()
+    ]
+    ops.append(("spending_sketches", DeleteMany({"user_id": user_id, "category": {"$nin": list(digests)}})))
+    ops.append(("users", UpdateOne({"_id": ObjectId(user_id)}, {"$set": {"sketches_built_at": now}})))
+    return ops
+
+
+def recompute_limit_counters(db, user_id):
+    # Household counters include this user's spending too (app.household_key)
+    households = [f"household:{h['_id']}" for h in db["households"].find({"members": user_id}, {"_id": 1})]
+    return [("limit_counters", DeleteMany({"user_id": {"$in": [user_id] + households}}))]
+
+
+RECOMPUTERS = {
+    "bucket_totals": recompute_bucket_totals,
+    "sketches": recompute_sketches,
+    "limit_counters": recompute_limit_counters,
+}
+
+
+class RateLimiter:
+    """Token bucket: at most ``rate`` operations per second (0 = unlimited)."""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+
+    def acquire(self, n):
+        if self.rate <= 0:
+            return
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= min(n, self.rate):
+                self.tokens -= n
+                return
+            time.sleep((min(n, self.rate) - self.tokens) / self.rate)
+
+
+def connect():
+    uri = os.getenv("MONGO_URI")
+    if not uri:
+        sys.exit("MONGO_URI not found in environment (.env)")
+    client = MongoClient(uri.strip().strip('"').strip("'"), serverSelectionTimeoutMS=5000)
+    return client.get_database(os.getenv("DB_NAME", "expen"), write_concern=WriteConcern(w="majority"))
+
+
+def run_partition(checkpoint_id, kinds, batch_size, ops_per_second):
+    """Worker: recompute every user of one checkpointed ``_id`` range."""
+    db = connect()
+    checkpoints = db["recompute_checkpoints"]
+    cp = checkpoints.find_one({"_id": checkpoint_id})
+    limiter = RateLimiter(ops_per_second)
+
+    query = {"_id": {"$gte": cp["lo"]}}
+    if cp.get("last_id") is not None:
+        query["_id"] = {"$gt": cp["last_id"]}
+    if cp.get("hi") is not None:
+        query["_id"]["$lt"] = cp["hi"]
+
+    pending, users, last_id = {}, 0, None
+
+    def flush():
+        writes = 0
+        for name, ops in pending.items():
+            for start in range(0, len(ops), batch_size):
+                chunk = ops[start:start + batch_size]
+                limiter.acquire(len(chunk))
+                db[name].bulk_write(chunk, ordered=False)
+                writes += len(chunk)
+        pending.clear()
+        checkpoints.update_one({"_id": checkpoint_id}, {
+            "$set": {"last_id": last_id, "updated_at": datetime.utcnow()},
+            "$inc": {"users": users, "writes": writes}
+        })
+
+    queued = 0
+    for user in db["users"].find(query, {"_id": 1}, batch_size=batch_size).sort("_id", 1):
+        for kind in kinds:
+            for name, op in RECOMPUTERS[kind](db, str(user["_id"])):
+                pending.setdefault(name, []).append(op)
+                queued += 1
+        users += 1
+        last_id = user["_id"]
+        if queued >= batch_size:
+            flush()
+            users = queued = 0
+    if users or pending:
+        flush()
+    checkpoints.update_one({"_id": checkpoint_id}, {"$set": {"done": True, "finished_at": datetime.utcnow()}})
+    return checkpoint_id
+
+
+def plan_partitions(db, run_id, kinds, partitions, restart):
+    """Checkpoint documents for ``run_id``, creating the ``_id`` ranges on first run."""
+    checkpoints = db["recompute_checkpoints"]
+    if restart:
+        checkpoints.delete_many({"run_id": run_id})
+    existing = list(checkpoints.find({"run_id": run_id}).sort("index", 1))
+    if existing:
+        if existing[0]["kinds"] != kinds:
+            sys.exit(f"run {run_id} was started with --only {','.join(existing[0]['kinds'])}; use --restart to change it")
+        return existing
+    ranges = list(db["users"].aggregate([{"$bucketAuto": {"groupBy": "$_id", "buckets": partitions}}]))
+    docs = []
+    for i, r in enumerate(ranges):
+        docs.append({
+            "_id": f"{run_id}:{i}", "run_id": run_id, "index": i, "kinds": kinds,
+            "lo": r["_id"]["min"],
+            # $bucketAuto ranges are [min, max) except the last, which includes max
+            "hi": r["_id"]["max"] if i < len(ranges) - 1 else None,
+            "expected_users": r["count"],
+            "last_id": None, "users": 0, "writes": 0, "done": False,
+            "created_at": datetime.utcnow()
+        })
+    if docs:
+        checkpoints.insert_many(docs)
+    return docs
+
+
+def progress(db, run_id):
+    cps = list(db["recompute_checkpoints"].find({"run_id": run_id}))
+    return {
+        "partitions": len(cps),
+        "done": sum(1 for c in cps if c.get("done")),
+        "users": sum(c["users"] for c in cps),
+        "writes": sum(c["writes"] for c in cps),
+        "expected_users": sum(c["expected_users"] for c in cps),
+    }
+
+
+def report(db, run_id, started, baseline):
+    """Print one progress line; rates count only this process's work (not resumed work)."""
+    p = progress(db, run_id)
+    elapsed = max(time.monotonic() - started, 1e-9)
+    user_rate = (p["users"] - baseline["users"]) / elapsed
+    write_rate = (p["writes"] - baseline["writes"]) / elapsed
+    remaining = p["expected_users"] - p["users"]
+    eta = f"{remaining / user_rate:.0f}s" if user_rate > 0 and remaining > 0 else "-"
+    print(f"[{elapsed:7.1f}s] partitions {p['done']}/{p['partitions']}  "
+          f"users {p['users']:,}/{p['expected_users']:,} ({user_rate:,.0f}/s)  "
+          f"writes {p['writes']:,} ({write_rate:,.0f}/s)  eta {eta}", flush=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Recompute derived per-user data for all users.")
+    parser.add_argument("--only", default=",".join(RECOMPUTERS),
+                        help=f"comma-separated subset of: {', '.join(RECOMPUTERS)}")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 2)
+    parser.add_argument("--partitions", type=int, default=None, help="user _id ranges (default 4 x workers)")
+    parser.add_argument("--batch-size", type=int, default=500, help="write ops per bulk_write / checkpoint")
+    parser.add_argument("--max-ops-per-sec", type=float, default=2000,
+                        help="write budget across all workers (0 = unlimited)")
+    parser.add_argument("--run-id", default=None, help="checkpoint name; reuse it to resume (default: --only)")
+    parser.add_argument("--restart", action="store_true", help="discard the run's checkpoints first")
+    parser.add_argument("--report-every", type=float, default=5.0, help="seconds between progress lines")
+    args = parser.parse_args(argv)
+
+    kinds = [k.strip() for k in args.only.split(",") if k.strip()]
+    unknown = sorted(set(kinds) - set(RECOMPUTERS))
+    if unknown or not kinds:
+        parser.error(f"unknown derived data: {', '.join(unknown) or '(none)'}")
+    run_id = args.run_id or "+".join(kinds)
+    partitions = args.partitions or args.workers * 4
+
+    db = connect()
+    todo = [cp["_id"] for cp in plan_partitions(db, run_id, kinds, partitions, args.restart) if not cp["done"]]
+    if not todo:
+        print(f"run {run_id}: nothing to do (all partitions done; --restart to run again)")
+        return 0
+    print(f"run {run_id}: {len(todo)} partition(s) of {', '.join(kinds)} on {args.workers} worker(s)")
+
+    started = time.monotonic()
+    baseline = progress(db, run_id)
+    per_worker_rate = args.max_ops_per_sec / args.workers if args.max_ops_per_sec > 0 else 0
+    failed = 0
+    # spawn: each worker opens its own MongoClient (clients are not fork-safe)
+    with ProcessPoolExecutor(max_workers=args.workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+        futures = {pool.submit(run_partition, cp_id, kinds, args.batch_size, per_worker_rate): cp_id for cp_id in todo}
+        while futures:
+            finished, _ = wait(futures, timeout=args.report_every, return_when=FIRST_COMPLETED)
+            for f in finished:
+                cp_id = futures.pop(f)
+                if f.exception() is not None:
+                    failed += 1
+                    print(f"partition {cp_id} failed (resume with --run-id {run_id}): {f.exception()}")
+            report(db, run_id, started, baseline)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,164 @@
+# sketches.py
+"""Mergeable quantile sketches (merging t-digest) for spending distributions.
+
+A ``TDigest`` summarizes any number of amounts in at most ``compression``
+centroids. Centroids near the tails are kept small (k1 scale function), so
+tail quantiles such as p90/p99 stay accurate while the middle is coarser.
+Digests merge by concatenating centroids and recompressing, and serialize
+to a compact byte string (12 bytes per centroid) for storage in Mongo.
+"""
+import bisect
+import math
+import struct
+
+import numpy as np
+
+DEFAULT_COMPRESSION = 100
+_HEADER = struct.Struct("<HddI")  # compression, min, max, centroid count
+
+
+class TDigest:
+    def __init__(self, compression=DEFAULT_COMPRESSION):
+        self.compression = compression
+        self.means = []
+        self.weights = []
+        self.total = 0
+        self.min = math.inf
+        self.max = -math.inf
+        self._buffer = []
+
+    def __len__(self):
+        return int(self.total + sum(w for _, w in self._buffer))
+
+    # ---- building ----------------------------------------------------------
+    def add(self, value, weight=1):
+        value = float(value)
+        self._buffer.append((value, weight))
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+        if len(self._buffer) >= 5 * self.compression:
+            self._compress()
+
+    def update(self, values):
+        for v in values:
+            self.add(v)
+        return self
+
+    def merge(self, other):
+        """Fold ``other`` into this digest (both stay valid sketches)."""
+        other._compress()
+        self._buffer.extend(zip(other.means, other.weights))
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self._compress()
+        return self
+
+    def _k(self, q):
+        # k1 scale: centroid size shrinks toward q=0 and q=1
+        return self.compression / (2 * math.pi) * math.asin(2 * min(max(q, 0.0), 1.0) - 1)
+
+    def _compress(self):
+        if not self._buffer:
+            return
+        points = sorted(list(zip(self.means, self.weights)) + self._buffer)
+        self._buffer = []
+        total = sum(w for _, w in points)
+
+        means, weights = [], []
+        cur_mean, cur_weight = points[0]
+        before = 0  # weight of centroids already emitted
+        k_left = self._k(0)
+        for mean, weight in points[1:]:
+            if self._k((before + cur_weight + weight) / total) - k_left <= 1:
+                cur_weight += weight
+                cur_mean += (mean - cur_mean) * weight / cur_weight
+            else:
+                means.append(cur_mean)
+                weights.append(cur_weight)
+                before += cur_weight
+                k_left = self._k(before / total)
+                cur_mean, cur_weight = mean, weight
+        means.append(cur_mean)
+        weights.append(cur_weight)
+        self.means, self.weights, self.total = means, weights, total
+
+    # ---- queries -----------------------------------------------------------
+    def quantile(self, q):
+        """Estimated value at quantile ``q`` in [0, 1]; None when empty."""
+        self._compress()
+        n = len(self.means)
+        if n == 0:
+            return None
+        if n == 1 or q <= 0:
+            return self.min if q <= 0 else self.means[0]
+        if q >= 1:
+            return self.max
+        target = q * self.total
+        cumulative = 0
+        prev_center = 0.0
+        prev_value = self.min
+        for mean, weight in zip(self.means, self.weights):
+            center = cumulative + weight / 2
+            if target < center:
+                span = center - prev_center
+                return prev_value + (mean - prev_value) * ((target - prev_center) / span if span else 0)
+            cumulative += weight
+            prev_center, prev_value = center, mean
+        span = self.total - prev_center
+        return prev_value + (self.max - prev_value) * ((target - prev_center) / span if span else 0)
+
+    def cdf(self, value):
+        """Estimated fraction of amounts <= ``value``."""
+        self._compress()
+        if not self.means:
+            return None
+        if value < self.min:
+            return 0.0
+        if value >= self.max:
+            return 1.0
+        centers, cumulative = [], 0
+        for weight in self.weights:
+            centers.append(cumulative + weight / 2)
+            cumulative += weight
+        i = bisect.bisect_right(self.means, value)
+        left_value, left_rank = (self.min, 0.0) if i == 0 else (self.means[i - 1], centers[i - 1])
+        right_value, right_rank = (self.max, self.total) if i == len(self.means) else (self.means[i], centers[i])
+        if right_value == left_value:
+            return right_rank / self.total
+        fraction = (value - left_value) / (right_value - left_value)
+        return (left_rank + fraction * (right_rank - left_rank)) / self.total
+
+    # ---- storage -----------------------------------------------------------
+    def to_bytes(self):
+        self._compress()
+        header = _HEADER.pack(self.compression, self.min, self.max, len(self.means))
+        return (header + np.asarray(self.means, dtype="<f8").tobytes()
+                + np.asarray(self.weights, dtype="<u4").tobytes())
+
+    @classmethod
+    def from_bytes(cls, data):
+        digest = cls()
+        if not data:
+            return digest
+        data = bytes(data)
+        compression, lo, hi, n = _HEADER.unpack_from(data)
+        offset = _HEADER.size
+        digest.compression = compression
+        digest.min, digest.max = lo, hi
+        digest.means = np.frombuffer(data, dtype="<f8", count=n, offset=offset).tolist()
+        digest.weights = np.frombuffer(data, dtype="<u4", count=n, offset=offset + 8 * n).tolist()
+        digest.total = sum(digest.weights)
+        return digest
+
+
+def summarize(digest, quantiles=(0.25, 0.5, 0.75, 0.9, 0.99)):
+    """Quantiles plus a Tukey upper fence (Q3 + 1.5 * IQR) used as the outlier threshold."""
+    if not len(digest):
+        return None
+    q1, q3 = digest.quantile(0.25), digest.quantile(0.75)
+    summary = {"count": len(digest), "min": digest.min, "max": digest.max}
+    for q in quantiles:
+        summary[f"p{q * 100:g}"] = digest.quantile(q)
+    summary["outlier_threshold"] = q3 + 1.5 * (q3 - q1)
+    return summary
+
@@ -265,11 +265,19 @@ document.addEventListener('DOMContentLoaded', function() {
       try {
       const res = await postJSON('/api/expense', data);
         if (res.success) {
-          showMessage('Expense added successfully!', 'success');
+          const alert = (res.alerts || [])[0];
+          if (alert) {
+            const scope = alert.category || 'overall';
+            showMessage(alert.exceeded
+              ? `Expense added. You're over your ${alert.period} ${scope} limit (₹${alert.spent.toFixed(2)} of ₹${alert.limit.toFixed(2)}).`
+              : `Expense added. You've used ${alert.threshold}% of your ${alert.period} ${scope} limit.`, 'error');
+          } else {
+            showMessage('Expense added successfully!', 'success');
+          }
           addExpenseForm.reset();
           const addExpenseFormContainer = document.getElementById('addExpenseFormContainer');
           if (addExpenseFormContainer) addExpenseFormContainer.style.display = 'none';
-          setTimeout(() => location.reload(), 1000);
+          setTimeout(() => location.reload(), alert ? 2500 : 1000);
         } else {
           showMessage(res.error || 'Error adding expense', 'error');
         }
@@ -494,23 +502,25 @@ document.addEventListener('DOMContentLoaded', function() {
   const endDate = document.getElementById('endDate');
   const applyFilters = document.getElementById('applyFilters');
   
+  const minAmount = document.getElementById('minAmount');
+  const maxAmount = document.getElementById('maxAmount');
+  const categoryFilterInput = document.getElementById('categoryFilterInput');
+  
   if (applyFilters) {
     applyFilters.addEventListener('click', function() {
-      const start = startDate ? startDate.value : '';
-      const end = endDate ? endDate.value : '';
-      const items = document.querySelectorAll('.transaction-timeline-item');
-      
-      items.forEach(item => {
-        const itemDate = item.dataset.date || '';
-        const show = (!start || itemDate >= start) && (!end || itemDate <= end);
-        if (show && item.style.display !== 'none') {
-          // Keep visible if it passes date range filter
-        } else {
-          item.style.display = show ? '' : 'none';
-        }
-      });
+      // Date, amount and category filters run server-side against indexed queries
+      const params = new URLSearchParams();
+      if (startDate && startDate.value) params.set('from', startDate.value);
+      if (endDate && endDate.value) params.set('to', endDate.value);
+      if (minAmount && minAmount.value) params.set('min_amount', minAmount.value);
+      if (maxAmount && maxAmount.value) params.set('max_amount', maxAmount.value);
+      if (categoryFilterInput && categoryFilterInput.value.trim()) {
+        params.set('category', categoryFilterInput.value.trim());
+      }
+      if (currentTypeFilter !== 'all') params.set('type', currentTypeFilter);
       
-      updateTransactionSummary();
+      const query = params.toString();
+      window.location.href = window.location.pathname + (query ? `?${query}` : '');
     });
   }
 
@@ -542,9 +552,18 @@ document.addEventListener('DOMContentLoaded', function() {
         currentPeriod = 'all';
       }
       
+      // Server-side filters are in the URL; drop them
+      if (window.location.search) {
+        window.location.href = window.location.pathname;
+        return;
+      }
+      
       // Clear date inputs
       if (startDate) startDate.value = '';
       if (endDate) endDate.value = '';
+      if (minAmount) minAmount.value = '';
+      if (maxAmount) maxAmount.value = '';
+      if (categoryFilterInput) categoryFilterInput.value = '';
       if (transactionSearch) transactionSearch.value = '';
       
       // Show all items
@@ -612,6 +631,57 @@ document.addEventListener('DOMContentLoaded', function() {
     });
   });
 
+  // Multi-select delete (one batch request)
+  const selectAllTransactions = document.getElementById('selectAllTransactions');
+  const deleteSelectedTransactions = document.getElementById('deleteSelectedTransactions');
+  const selectedTransactionCount = document.getElementById('selectedTransactionCount');
+  
+  function selectedTransactionIds() {
+    return Array.from(document.querySelectorAll('.select-transaction:checked'))
+      .filter(box => box.closest('.transaction-timeline-item').style.display !== 'none')
+      .map(box => box.dataset.id);
+  }
+  
+  function updateSelectionUI() {
+    const count = selectedTransactionIds().length;
+    if (selectedTransactionCount) selectedTransactionCount.textContent = count;
+    if (deleteSelectedTransactions) deleteSelectedTransactions.style.display = count ? '' : 'none';
+  }
+  
+  document.querySelectorAll('.select-transaction').forEach(box => {
+    box.addEventListener('change', updateSelectionUI);
+  });
+  
+  if (selectAllTransactions) {
+    selectAllTransactions.addEventListener('change', function() {
+      document.querySelectorAll('.transaction-timeline-item').forEach(item => {
+        const box = item.querySelector('.select-transaction');
+        if (box && item.style.display !== 'none') box.checked = this.checked;
+      });
+      updateSelectionUI();
+    });
+  }
+  
+  if (deleteSelectedTransactions) {
+    deleteSelectedTransactions.addEventListener('click', async () => {
+      const ids = selectedTransactionIds();
+      if (!ids.length) return;
+      if (!confirm(`Delete ${ids.length} selected transaction${ids.length > 1 ? 's' : ''}?`)) return;
+      
+      try {
+        const res = await postJSON('/api/transactions/batch-delete', { ids });
+        if (res.success) {
+          showMessage(`Deleted ${res.deleted_count} transaction${res.deleted_count === 1 ? '' : 's'}`, 'success');
+          setTimeout(() => location.reload(), 1000);
+        } else {
+          showMessage(res.error || 'Error deleting transactions', 'error');
+        }
+      } catch (error) {
+        showMessage('Error deleting transactions. Please try again.', 'error');
+      }
+    });
+  }
+
   // ========== LIMITS ==========
   const setLimitForm = document.getElementById('setLimitForm');
   if (setLimitForm) {
@@ -640,13 +710,12 @@ document.addEventListener('DOMContentLoaded', function() {
   }
 
   // Delete limit
-  const deleteLimit = document.getElementById('deleteLimit');
-  if (deleteLimit) {
-    deleteLimit.addEventListener('click', async (e) => {
-      if (!confirm('Are you sure you want to delete your expense limit?')) return;
+  document.querySelectorAll('.delete-limit').forEach(btn => {
+    btn.addEventListener('click', async (e) => {
+      if (!confirm('Are you sure you want to delete this expense limit?')) return;
       
       try {
-        const res = await fetch('/api/limits', { method: 'DELETE' });
+        const res = await fetch(`/api/limits/${btn.dataset.limitId}`, { method: 'DELETE' });
         const data = await res.json();
         if (data.success) {
           showMessage('Limit deleted successfully!', 'success');
@@ -658,37 +727,7 @@ document.addEventListener('DOMContentLoaded', function() {
         showMessage('Error deleting limit. Please try again.', 'error');
       }
     });
-  }
-
-  // Update limit progress
-  if (typeof window.limitData !== 'undefined' && window.limitData) {
-    updateLimitProgress();
-  }
-
-  function updateLimitProgress() {
-    // Fetch current spending and update progress bar
-    fetch('/api/expense')
-      .then(res => res.json())
-      .then(data => {
-        if (data.expenses && window.limitData) {
-          const totalSpent = data.expenses.reduce((sum, e) => sum + parseFloat(e.amount || 0), 0);
-          const limit = parseFloat(window.limitData.limit || 0);
-          const percentage = limit > 0 ? Math.min((totalSpent / limit) * 100, 100) : 0;
-          
-          const progressBar = document.getElementById('limitProgress');
-          const spentAmount = document.getElementById('spentAmount');
-          const limitWarning = document.getElementById('limitWarning');
-          
-          if (progressBar) progressBar.style.width = `${percentage}%`;
-          if (spentAmount) spentAmount.textContent = `₹${totalSpent.toFixed(2)}`;
-          
-          if (limitWarning && percentage >= 80) {
-            limitWarning.style.display = 'flex';
-          }
-        }
-      })
-      .catch(err => console.error('Error updating limit progress:', err));
-  }
+  });
 
   // ========== SUBSCRIPTIONS ==========
   const addSubscriptionForm = document.getElementById('addSubscriptionForm');
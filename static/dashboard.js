@@ -1,7 +1,7 @@
 // Dashboard JavaScript
 document.addEventListener('DOMContentLoaded', function() {
-  // Dashboard Charts
-  initDashboardCharts();
+  // Dashboard widgets (fetched in parallel after the shell renders)
+  loadDashboardWidgets();
   
   // Transaction Filters
   initTransactionFilters();
@@ -10,137 +10,248 @@ document.addEventListener('DOMContentLoaded', function() {
   initFormToggles();
 });
 
-// Initialize Dashboard Charts
-function initDashboardCharts() {
-  if (typeof window.dashboardData === 'undefined') return;
+const formatRupees = value => `₹${Number(value || 0).toFixed(2)}`;
+
+function escapeHtml(value) {
+  const div = document.createElement('div');
+  div.textContent = value == null ? '' : String(value);
+  return div.innerHTML;
+}
+
+// Fetch every dashboard widget at once; each one renders as soon as it arrives
+function loadDashboardWidgets() {
+  const grid = document.getElementById('dashboardGrid');
+  if (!grid) return;
   
-  const data = window.dashboardData;
+  window.dashboardData = {};
+  const names = (grid.dataset.widgets || '').split(',').filter(Boolean);
+  return Promise.all(names.map(async name => {
+    try {
+      const res = await fetch(`/api/dashboard/widgets/${name}`, { credentials: 'same-origin' });
+      const data = await res.json();
+      if (!data.success) throw new Error(data.error || `${name} failed`);
+      Object.assign(window.dashboardData, data.widget);
+      // Served from the last good copy while the server is shedding load
+      grid.querySelectorAll(`[data-widget="${name}"]`).forEach(el => {
+        el.classList.toggle('is-stale', !!data.stale);
+        el.title = data.stale ? `Showing data from ${Math.round(data.stale_age_seconds)}s ago` : '';
+      });
+      const render = DASHBOARD_WIDGET_RENDERERS[name];
+      if (render) render(data.widget);
+    } catch (error) {
+      console.error(`Error loading dashboard widget ${name}:`, error);
+      grid.querySelectorAll(`[data-widget="${name}"] .empty-state`).forEach(el => {
+        el.textContent = 'Unavailable, please refresh';
+      });
+    }
+  }));
+}
+
+const DASHBOARD_WIDGET_RENDERERS = {
+  summary(widget) {
+    document.getElementById('balanceAmount').textContent = formatRupees(widget.balance);
+    document.getElementById('spendingAmount').textContent = formatRupees(widget.total_expense);
+    document.getElementById('budgetSpent').textContent = formatRupees(widget.total_expense);
+    document.getElementById('overviewIncome').textContent = formatRupees(widget.total_income);
+    document.getElementById('overviewCount').textContent = widget.transactions_count;
+    
+    if (widget.total_income > 0) {
+      const pct = (widget.total_income - widget.total_expense) / widget.total_income * 100;
+      document.getElementById('earningsPct').textContent = pct.toFixed(2);
+      document.getElementById('balanceTrend').style.display = '';
+    }
+    
+    const legend = document.getElementById('spendingLegend');
+    const categories = Object.entries(widget.category_spending || {});
+    const colors = generateColors(7);
+    legend.innerHTML = categories.length ? categories.map(([category, amount], i) => `
+      <div class="legend-item">
+        <span class="legend-dot" style="background-color: ${colors[i % colors.length]}"></span>
+        <span>${escapeHtml(category)} (${formatRupees(amount)})</span>
+      </div>`).join('') : '<p>No spending data</p>';
+    
+    renderBalanceChart(widget);
+    renderSpendingChart(widget);
+    renderBudgetChart(widget);
+  },
   
-  // Balance Chart
-  const balanceCtx = document.getElementById('balanceChart');
-  if (balanceCtx) {
-    const balanceData = generateWeeklyData(data.balance);
-    new Chart(balanceCtx, {
-      type: 'line',
-      data: {
-        labels: ['Sun', 'Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat'],
-        datasets: [{
-          label: 'Balance',
-          data: balanceData,
-          borderColor: '#00ACC1',
-          backgroundColor: 'rgba(0, 172, 193, 0.1)',
-          tension: 0.4,
-          fill: true
-        }]
-      },
-      options: {
-        responsive: true,
-        maintainAspectRatio: false,
-        plugins: {
-          legend: { display: false }
-        },
-        scales: {
-          y: { beginAtZero: false }
-        }
-      }
-    });
-  }
+  cards(widget) {
+    const container = document.getElementById('cardsPreview');
+    const cards = (widget.cards || []).slice(0, 2);
+    container.innerHTML = cards.length ? cards.map(card => `
+      <div class="preview-card-item">
+        <div class="card-brand">${escapeHtml(card.brand || 'Card')}</div>
+        <div class="card-number">${escapeHtml(card.masked_number || '**** **** **** ' + (card.last4 || '----'))}</div>
+        <div class="card-holder">${escapeHtml(card.cardholder || 'Card Holder')}</div>
+      </div>`).join('') : '<p class="empty-state">No cards added</p>';
+  },
   
-  // Spending Chart (Doughnut)
-  const spendingCtx = document.getElementById('spendingChart');
-  if (spendingCtx && data.categorySpending) {
-    const categories = Object.keys(data.categorySpending);
-    const amounts = Object.values(data.categorySpending);
-    const colors = generateColors(categories.length);
+  transactions(widget) {
+    const list = document.getElementById('recentTransactions');
+    const txs = (widget.recent_transactions || []).slice(0, 5);
+    list.innerHTML = txs.length ? txs.map(tx => `
+      <div class="transaction-item" data-type="${escapeHtml(tx.type || '')}">
+        <div class="transaction-icon">
+          <i class='bx ${tx.type === 'income' ? 'bx-trending-up' : 'bx-trending-down'}'></i>
+        </div>
+        <div class="transaction-details">
+          <div class="transaction-title">${escapeHtml(tx.category || tx.source || tx.payee || 'Transaction')}</div>
+          <div class="transaction-date">${escapeHtml(tx.date ? String(tx.date).slice(0, 10) : 'N/A')}</div>
+        </div>
+        <div class="transaction-amount ${tx.type === 'expense' ? 'negative' : 'positive'}">
+          ${tx.type === 'expense' ? '-' : '+'}${formatRupees(tx.amount)}
+        </div>
+      </div>`).join('') : '<p class="empty-state">No transactions yet</p>';
     
-    new Chart(spendingCtx, {
-      type: 'doughnut',
-      data: {
-        labels: categories,
-        datasets: [{
-          data: amounts,
-          backgroundColor: colors,
-          borderWidth: 0
-        }]
+    const active = document.querySelector('.filter-btn.active');
+    if (active) applyTransactionFilter(active.dataset.filter);
+    renderOverviewChart(widget);
+  },
+  
+  subscriptions(widget) {
+    const list = document.getElementById('subscriptionsList');
+    const subs = (widget.subscriptions || []).slice(0, 4);
+    list.innerHTML = subs.length ? subs.map(sub => `
+      <div class="subscription-item">
+        <div class="subscription-name">${escapeHtml(sub.name || 'Subscription')}</div>
+        <div class="subscription-amount">${formatRupees(sub.amount)}</div>
+        <div class="subscription-date">Next: ${escapeHtml(sub.next_payment_date || 'N/A')}</div>
+      </div>`).join('') : '<p class="empty-state">No active subscriptions</p>';
+  },
+  
+  limit(widget) {
+    const limit = widget.limit && widget.limit.limit;
+    document.getElementById('budgetLimit').textContent = limit ? `Limit: ${formatRupees(limit)}` : 'No limit set';
+  }
+};
+
+// Charts are redrawn when their widget reloads
+const dashboardCharts = {};
+
+function drawChart(id, config) {
+  const ctx = document.getElementById(id);
+  if (!ctx || typeof Chart === 'undefined') return;
+  if (dashboardCharts[id]) dashboardCharts[id].destroy();
+  dashboardCharts[id] = new Chart(ctx, config);
+}
+
+function renderBalanceChart(data) {
+  drawChart('balanceChart', {
+    type: 'line',
+    data: {
+      labels: ['Sun', 'Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat'],
+      datasets: [{
+        label: 'Balance',
+        data: generateWeeklyData(data.balance),
+        borderColor: '#00ACC1',
+        backgroundColor: 'rgba(0, 172, 193, 0.1)',
+        tension: 0.4,
+        fill: true
+      }]
+    },
+    options: {
+      responsive: true,
+      maintainAspectRatio: false,
+      plugins: {
+        legend: { display: false }
       },
-      options: {
-        responsive: true,
-        maintainAspectRatio: false,
-        plugins: {
-          legend: { display: false }
-        }
+      scales: {
+        y: { beginAtZero: false }
       }
-    });
-  }
+    }
+  });
+}
+
+// Spending Chart (Doughnut)
+function renderSpendingChart(data) {
+  if (!data.category_spending) return;
+  const categories = Object.keys(data.category_spending);
+  const amounts = Object.values(data.category_spending);
   
-  // Budget Chart
-  const budgetCtx = document.getElementById('budgetChart');
-  if (budgetCtx) {
-    new Chart(budgetCtx, {
-      type: 'bar',
-      data: {
-        labels: ['Sun', 'Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat'],
-        datasets: [
-          {
-            label: 'Income',
-            data: generateWeeklyData(data.totalIncome / 7),
-            backgroundColor: '#10b981'
-          },
-          {
-            label: 'Spent',
-            data: generateWeeklyData(data.totalExpense / 7),
-            backgroundColor: '#ef4444'
-          }
-        ]
-      },
-      options: {
-        responsive: true,
-        maintainAspectRatio: false,
-        scales: {
-          x: { stacked: true },
-          y: { stacked: true, beginAtZero: true }
+  drawChart('spendingChart', {
+    type: 'doughnut',
+    data: {
+      labels: categories,
+      datasets: [{
+        data: amounts,
+        backgroundColor: generateColors(categories.length),
+        borderWidth: 0
+      }]
+    },
+    options: {
+      responsive: true,
+      maintainAspectRatio: false,
+      plugins: {
+        legend: { display: false }
+      }
+    }
+  });
+}
+
+function renderBudgetChart(data) {
+  drawChart('budgetChart', {
+    type: 'bar',
+    data: {
+      labels: ['Sun', 'Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat'],
+      datasets: [
+        {
+          label: 'Income',
+          data: generateWeeklyData(data.total_income / 7),
+          backgroundColor: '#10b981'
+        },
+        {
+          label: 'Spent',
+          data: generateWeeklyData(data.total_expense / 7),
+          backgroundColor: '#ef4444'
         }
+      ]
+    },
+    options: {
+      responsive: true,
+      maintainAspectRatio: false,
+      scales: {
+        x: { stacked: true },
+        y: { stacked: true, beginAtZero: true }
       }
-    });
-  }
+    }
+  });
+}
+
+function renderOverviewChart(data) {
+  const recent = (data.recent_transactions || []).slice(0, 7);
+  const dates = recent.map(t => {
+    const date = t.date ? new Date(t.date) : new Date();
+    return date.toLocaleDateString('en-US', { weekday: 'short' });
+  });
+  const counts = Array(7).fill(0);
+  recent.forEach((t, i) => {
+    counts[i] = 1;
+  });
   
-  // Overview Chart
-  const overviewCtx = document.getElementById('overviewChart');
-  if (overviewCtx && data.recentTransactions) {
-    const dates = data.recentTransactions.slice(0, 7).map(t => {
-      const date = t.date ? new Date(t.date) : new Date();
-      return date.toLocaleDateString('en-US', { weekday: 'short' });
-    });
-    const counts = Array(7).fill(0);
-    data.recentTransactions.slice(0, 7).forEach((t, i) => {
-      counts[i] = 1;
-    });
-    
-    new Chart(overviewCtx, {
-      type: 'line',
-      data: {
-        labels: dates.length > 0 ? dates : ['Sun', 'Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat'],
-        datasets: [{
-          label: 'Transactions',
-          data: counts,
-          borderColor: '#00ACC1',
-          backgroundColor: 'rgba(0, 172, 193, 0.1)',
-          tension: 0.4,
-          fill: true
-        }]
+  drawChart('overviewChart', {
+    type: 'line',
+    data: {
+      labels: dates.length > 0 ? dates : ['Sun', 'Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat'],
+      datasets: [{
+        label: 'Transactions',
+        data: counts,
+        borderColor: '#00ACC1',
+        backgroundColor: 'rgba(0, 172, 193, 0.1)',
+        tension: 0.4,
+        fill: true
+      }]
+    },
+    options: {
+      responsive: true,
+      maintainAspectRatio: false,
+      plugins: {
+        legend: { display: false }
       },
-      options: {
-        responsive: true,
-        maintainAspectRatio: false,
-        plugins: {
-          legend: { display: false }
-        },
-        scales: {
-          y: { beginAtZero: true, ticks: { stepSize: 1 } }
-        }
+      scales: {
+        y: { beginAtZero: true, ticks: { stepSize: 1 } }
       }
-    });
-  }
+    }
+  });
 }
 
 // Generate weekly data for charts
@@ -163,7 +274,6 @@ function generateColors(count) {
 // Transaction Filters
 function initTransactionFilters() {
   const filterBtns = document.querySelectorAll('.filter-btn');
-  const transactionItems = document.querySelectorAll('.transaction-item');
   
   filterBtns.forEach(btn => {
     btn.addEventListener('click', function() {
@@ -171,20 +281,22 @@ function initTransactionFilters() {
       filterBtns.forEach(b => b.classList.remove('active'));
       this.classList.add('active');
       
-      const filter = this.dataset.filter;
-      
-      // Filter transactions
-      transactionItems.forEach(item => {
-        if (filter === 'all' || item.dataset.type === filter) {
-          item.style.display = 'flex';
-        } else {
-          item.style.display = 'none';
-        }
-      });
+      applyTransactionFilter(this.dataset.filter);
     });
   });
 }
 
+// Items are looked up on each call because widgets render them after load
+function applyTransactionFilter(filter) {
+  document.querySelectorAll('.transaction-item').forEach(item => {
+    if (filter === 'all' || item.dataset.type === filter) {
+      item.style.display = 'flex';
+    } else {
+      item.style.display = 'none';
+    }
+  });
+}
+
 // Form Toggles
 function initFormToggles() {
   // Show/Hide Add Card Form
@@ -355,8 +467,9 @@ if (typeof window.visualizationData !== 'undefined') {
     
     // Monthly Trend Chart
     const monthlyTrendCtx = document.getElementById('monthlyTrendChart');
-    if (monthlyTrendCtx && data.transactions) {
-      const monthlyData = calculateMonthlyTrend(data.transactions);
+    if (monthlyTrendCtx && (data.monthlyTrend || data.transactions)) {
+      // Server sends precomputed monthly totals; fall back to raw transactions
+      const monthlyData = data.monthlyTrend || calculateMonthlyTrend(data.transactions);
       
       new Chart(monthlyTrendCtx, {
         type: 'line',
@@ -393,6 +506,45 @@ if (typeof window.visualizationData !== 'undefined') {
   });
 }
 
+// Load burn rate, projection and anomalies for the visualization page
+if (document.getElementById('forecastSummary')) {
+  document.addEventListener('DOMContentLoaded', async function() {
+    const formatINR = value => `₹${Number(value || 0).toFixed(2)}`;
+    const tbody = document.getElementById('anomalyTableBody');
+    
+    try {
+      const res = await fetch('/api/analytics/forecast');
+      const data = await res.json();
+      if (!data.success) throw new Error(data.error || 'forecast failed');
+      const f = data.forecast;
+      
+      document.getElementById('forecastBurnRate').textContent = formatINR(f.burn_rate_daily);
+      document.getElementById('forecastMonthToDate').textContent = formatINR(f.month_to_date_expense);
+      document.getElementById('forecastProjected').textContent = formatINR(f.projected_month_end_expense);
+      
+      if (!tbody) return;
+      tbody.innerHTML = '';
+      if (!f.anomalies.length) {
+        tbody.innerHTML = '<tr><td colspan="4" class="empty-state">No unusual expenses found</td></tr>';
+        return;
+      }
+      f.anomalies.forEach(a => {
+        const avg = f.categories[a.category] ? f.categories[a.category].current_moving_average : 0;
+        const row = document.createElement('tr');
+        [a.date, a.category, formatINR(a.amount), formatINR(avg)].forEach(text => {
+          const cell = document.createElement('td');
+          cell.textContent = text;
+          row.appendChild(cell);
+        });
+        tbody.appendChild(row);
+      });
+    } catch (error) {
+      console.error('Error loading forecast:', error);
+      if (tbody) tbody.innerHTML = '<tr><td colspan="4" class="empty-state">Forecast unavailable</td></tr>';
+    }
+  });
+}
+
 // Calculate monthly trend from transactions
 function calculateMonthlyTrend(transactions) {
   const monthly = {};
@@ -0,0 +1,177 @@
+# subcalendar.py
+"""Subscription charge calendar: every upcoming charge over a horizon.
+
+``expand_charges`` turns each subscription's next payment date and cycle
+into all of its charge dates up to a horizon with NumPy date arithmetic:
+one row per subscription, one column per cycle step, masked by the window
+and each subscription's end date. Month-based cycles follow the renewal
+job's rule (``advance_cycle`` in app.py): a day clamped to a short month
+stays clamped, so Jan 31 -> Feb 28 -> Mar 28. ``group_charges`` totals the
+charges per week (Monday start) and per month.
+"""
+from collections import OrderedDict
+from datetime import date
+import calendar
+import threading
+
+import numpy as np
+
+CYCLE_MONTHS = {"monthly": 1, "quarterly": 3, "yearly": 12}
+WEEK = np.timedelta64(7, "D")
+
+
+def add_months(d, months):
+    """``d`` moved ``months`` calendar months ahead, clamped to the month's length."""
+    index = d.month - 1 + months
+    year, month = d.year + index // 12, index % 12 + 1
+    return date(year, month, min(d.day, calendar.monthrange(year, month)[1]))
+
+
+def expand_charges(next_dates, cycles, end_dates, amounts, start, until):
+    """All charges dated in [start, until) for each subscription, sorted by date.
+
+    ``next_dates`` and ``end_dates`` are datetime64[D]-compatible (NaT end =
+    open-ended), ``cycles`` cycle names, ``amounts`` paise per charge.
+    Returns (subscription row index, datetime64[D] dates, int64 amounts).
+    """
+    next_dates = np.asarray(next_dates, dtype="datetime64[D]")
+    end_dates = np.asarray(end_dates, dtype="datetime64[D]")
+    amounts = np.asarray(amounts, dtype=np.int64)
+    cycles = np.asarray(cycles, dtype=object)
+    start, until = np.datetime64(start, "D"), np.datetime64(until, "D")
+
+    grids = []
+    weekly = cycles == "weekly"
+    if weekly.any():
+        idx = np.flatnonzero(weekly)
+        first = next_dates[idx]
+        steps = np.arange((until - first.min()) // WEEK + 1)
+        grids.append((idx, first[:, None] + steps[None, :] * WEEK))
+    if (~weekly).any():
+        idx = np.flatnonzero(~weekly)
+        step = np.array([CYCLE_MONTHS.get(c, 1) for c in cycles[idx]])
+        first = next_dates[idx]
+        first_month = first.astype("datetime64[M]")
+        day0 = (first - first_month.astype("datetime64[D]")).astype(np.int64) + 1
+        span = (until.astype("datetime64[M]") - first_month.min()).astype(np.int64)
+        offsets = (step[:, None] * np.arange(max(span, 0) + 1)[None, :]).astype("timedelta64[M]")
+        months = first_month[:, None] + offsets
+        month_days = ((months + np.timedelta64(1, "M")).astype("datetime64[D]")
+                      - months.astype("datetime64[D]")).astype(np.int64)
+        # A clamped day sticks: each charge falls on the shortest month length seen so far
+        day = np.minimum.accumulate(np.minimum(month_days, day0[:, None]), axis=1)
+        grids.append((idx, months.astype("datetime64[D]") + (day - 1).astype("timedelta64[D]")))
+
+    rows, dates = [], []
+    for idx, grid in grids:
+        end = end_dates[idx][:, None]
+        keep = (grid >= start) & (grid < until) & (np.isnat(end) | (grid <= end))
+        rows.append(np.broadcast_to(idx[:, None], grid.shape)[keep])
+        dates.append(grid[keep])
+    if not rows:
+        return np.array([], dtype=np.int64), np.array([], dtype="datetime64[D]"), np.array([], dtype=np.int64)
+    rows, dates = np.concatenate(rows), np.concatenate(dates)
+    order = np.lexsort((rows, dates))
+    return rows[order], dates[order], amounts[rows[order]]
+
+
+def charges_before(dates, until):
+    """How many of the sorted charge ``dates`` fall before ``until``."""
+    return int(np.searchsorted(dates, np.datetime64(until, "D")))
+
+
+def running_totals(amounts):
+    """Paise charged before each position; ``totals[charges_before(...)]`` is a window's spend."""
+    return np.concatenate([np.zeros(1, dtype=np.int64), np.cumsum(amounts, dtype=np.int64)])
+
+
+def _group(keys, amounts):
+    uniq, inverse = np.unique(keys, return_inverse=True)
+    totals = np.zeros(len(uniq), dtype=np.int64)
+    np.add.at(totals, inverse, amounts)
+    return uniq, totals, np.bincount(inverse, minlength=len(uniq))
+
+
+def group_charges(dates, amounts):
+    """((week starts, totals, counts), (months, totals, counts)) for sorted charges."""
+    # 1970-01-01 was a Thursday, so (days + 3) % 7 is days since Monday
+    weekday = (dates.astype(np.int64) + 3) % 7
+    return _group(dates - weekday.astype("timedelta64[D]"), amounts), _group(dates.astype("datetime64[M]"), amounts)
+
+
+class CalendarCache:
+    """Per-user LRU of expanded calendars, valid while the cache key matches.
+
+    The key is built from the user's subscription versions (and the day),
+    so any create, edit, delete or renewal produces a miss.
+    """
+
+    def __init__(self, max_entries=5000):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    def get(self, user_id, key):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None or entry[0] != key:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(user_id)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, user_id, key, value):
+        with self._lock:
+            self._entries[user_id] = (key, value)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+
+if __name__ == "__main__":
+    # Check against stepping one charge at a time, then time a large expansion
+    import time
+    from datetime import timedelta
+
+    def reference(first, cycle, end, start, until):
+        out, d = [], first
+        while d < until:
+            if end and d > end:
+                break
+            if d >= start:
+                out.append(d)
+            d = d + timedelta(weeks=1) if cycle == "weekly" else add_months(d, CYCLE_MONTHS.get(cycle, 1))
+        return out
+
+    rng = np.random.default_rng(0)
+    today = date(2026, 1, 15)
+    until = add_months(today, 12)
+    subs = []
+    for _ in range(2000):
+        first = date(2025, 1, 1) + timedelta(days=int(rng.integers(0, 500)))
+        end = first + timedelta(days=int(rng.integers(0, 700))) if rng.random() < 0.3 else None
+        subs.append((first, str(rng.choice(["weekly", "monthly", "quarterly", "yearly"])), end))
+    subs.append((date(2026, 1, 31), "monthly", None))
+
+    started = time.perf_counter()
+    rows, dates, _ = expand_charges([s[0] for s in subs], [s[1] for s in subs],
+                                    [s[2] or "NaT" for s in subs], np.ones(len(subs)), today, until)
+    elapsed = time.perf_counter() - started
+    print(f"{len(subs)} subscriptions -> {len(dates)} charges in {elapsed * 1000:.1f} ms")
+    for i, (first, cycle, end) in enumerate(subs):
+        expected = reference(first, cycle, end, today, until)
+        got = [d.item() for d in dates[rows == i]]
+        assert got == expected, (first, cycle, end, got[:5], expected[:5])
+    print("Jan 31 monthly:", [str(d) for d in dates[rows == len(subs) - 1][:4]])
@@ -0,0 +1,62 @@
+"""Shared fixtures.
+
+Tests that touch the app need Flask and a MongoDB replica set: point
+``MONGO_TEST_URI`` at one (see "Read Routing" in the README for a local
+set). Each run uses a throwaway database that is dropped afterwards.
+Without them those tests are skipped; pure helper tests always run.
+"""
+from datetime import datetime
+import os
+import sys
+import uuid
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(scope="session")
+def expenzo():
+    """The imported app module, connected to a fresh test database."""
+    uri = os.getenv("MONGO_TEST_URI")
+    if not uri:
+        pytest.skip("MONGO_TEST_URI not set")
+    pytest.importorskip("flask")
+    os.environ.update({
+        "MONGO_URI": uri,
+        "DB_NAME": f"expenzo_test_{uuid.uuid4().hex[:8]}",
+        "SECRET_KEY": "test",
+        # Responses carry X-Query-Count without failing over-budget requests
+        "QUERY_BUDGET_MODE": "staging",
+        "PROFILE_SAMPLE_RATE": "0",
+        "LOAD_SHEDDING_ENABLED": "False",
+        "WARMUP_ENABLED": "False",
+        "RENEWAL_SCHEDULER_ENABLED": "False",
+        "ARCHIVE_ENABLED": "False",
+        "LEDGER_SNAPSHOT_ENABLED": "False",
+        "SYNC_PRUNE_ENABLED": "False",
+    })
+    import app
+    yield app
+    app.client.drop_database(app.db.name)
+
+
+@pytest.fixture
+def user_id(expenzo):
+    """A freshly registered user's id."""
+    now = datetime.utcnow()
+    result = expenzo.users_col.insert_one({
+        "name": "Test User", "email": f"{uuid.uuid4().hex}@example.com",
+        "password": "x", "created_at": now, "ledger_since": now
+    })
+    return str(result.inserted_id)
+
+
+@pytest.fixture
+def client(expenzo, user_id):
+    """A test client logged in as ``user_id``."""
+    client = expenzo.app.test_client()
+    with client.session_transaction() as s:
+        s["user_id"] = user_id
+        s["user_name"] = "Test User"
+    return client
@@ -0,0 +1,22 @@
+"""Category limits key on normalized paths; household limits write no category nodes."""
+
+
+def test_personal_limit_resolves_against_the_users_tree(expenzo, client, user_id):
+    created = client.post("/api/limits", json={"limit": 500, "category": "Food > Restaurants"})
+    assert created.status_code == 200
+    assert created.get_json()["limit"]["category"] == "food/restaurants"
+    paths = {n["path"] for n in expenzo.categories_col.find({"user_id": user_id})}
+    assert {"food", "food/restaurants"} <= paths
+
+
+def test_household_limit_creates_no_category_nodes(expenzo, client, user_id):
+    household = client.post("/api/households", json={"name": "Home"}).get_json()["household"]
+    created = client.post(f"/api/households/{household['_id']}/limits",
+                          json={"limit": 900, "category": "Travel > Flights"})
+    assert created.status_code == 200
+    limit = created.get_json()["limit"]
+    assert limit["category"] == "travel/flights"
+    assert limit["category_name"] == "Travel > Flights"
+    assert limit["user_id"] == expenzo.household_key(household["_id"])
+    owners = [user_id, limit["user_id"]]
+    assert expenzo.categories_col.count_documents({"user_id": {"$in": owners}, "path": {"$regex": "^travel"}}) == 0
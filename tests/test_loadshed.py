@@ -0,0 +1,182 @@
+"""CircuitBreaker state machine and AdaptiveLimiter AIMD bounds."""
+from types import SimpleNamespace
+import threading
+
+import pytest
+
+from loadshed import AdaptiveLimiter, CircuitBreaker
+
+
+class Clock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def ok(ms=5):
+    return SimpleNamespace(duration_micros=ms * 1000)
+
+
+def failed(errtype="AutoReconnect", code=None, ms=5):
+    return SimpleNamespace(duration_micros=ms * 1000, failure={"errtype": errtype, "code": code})
+
+
+@pytest.fixture
+def clock():
+    return Clock()
+
+
+@pytest.fixture
+def breaker(clock):
+    return CircuitBreaker(failure_rate=0.5, slow_call_rate=0.5, min_calls=10,
+                          window_seconds=10, reset_timeout=5, slow_call_ms=100, clock=clock)
+
+
+def test_stays_closed_below_min_calls(breaker):
+    for _ in range(9):
+        breaker.failed(failed())
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_opens_on_windowed_failure_rate(breaker):
+    for _ in range(6):
+        breaker.succeeded(ok())
+    for _ in range(4):
+        breaker.failed(failed())
+    assert breaker.state == CircuitBreaker.CLOSED  # 4 of 10
+    breaker.failed(failed())
+    breaker.failed(failed())
+    assert breaker.state == CircuitBreaker.OPEN  # 6 of 12
+    assert breaker.trips == 1
+    assert not breaker.allow()
+
+
+def test_opens_on_slow_call_rate(breaker):
+    for _ in range(10):
+        breaker.succeeded(ok(ms=500))
+    assert breaker.state == CircuitBreaker.OPEN
+
+
+def test_client_errors_do_not_count_as_failures(breaker):
+    for _ in range(20):
+        breaker.failed(failed(errtype="DuplicateKeyError", code=11000))
+    assert breaker.state == CircuitBreaker.CLOSED
+    breaker.record_failure()
+    assert breaker.stats()["window_calls"] == 21
+
+
+def test_old_failures_leave_the_window(breaker, clock):
+    for _ in range(9):
+        breaker.failed(failed())
+    clock.now += 11
+    for _ in range(9):
+        breaker.succeeded(ok())
+    breaker.failed(failed())
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.stats()["window_calls"] == 10
+
+
+def trip(breaker):
+    for _ in range(10):
+        breaker.failed(failed())
+    assert breaker.state == CircuitBreaker.OPEN
+
+
+def test_half_open_after_cooldown_admits_one_probe(breaker, clock):
+    trip(breaker)
+    clock.now += 4.9
+    assert not breaker.allow()
+    clock.now += 0.1
+    assert breaker.allow()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert not breaker.allow()  # one probe at a time
+    assert breaker.rejected == 2
+
+
+def test_healthy_probe_closes(breaker, clock):
+    trip(breaker)
+    clock.now += 5
+    assert breaker.allow()
+    breaker.succeeded(ok())
+    breaker.finish_probe()
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.stats()["window_calls"] == 0
+    assert breaker.allow()
+
+
+def test_failed_or_slow_probe_reopens(breaker, clock):
+    trip(breaker)
+    clock.now += 5
+    assert breaker.allow()
+    breaker.failed(failed())
+    assert breaker.state == CircuitBreaker.OPEN
+    assert breaker.trips == 2
+
+    clock.now += 5
+    assert breaker.allow()
+    breaker.succeeded(ok(ms=500))
+    assert breaker.state == CircuitBreaker.OPEN
+
+
+def test_probe_without_mongo_calls_lets_another_through(breaker, clock):
+    trip(breaker)
+    clock.now += 5
+    assert breaker.allow()
+    breaker.finish_probe()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert breaker.allow()
+
+
+def test_only_the_probe_thread_decides(breaker, clock):
+    trip(breaker)
+    clock.now += 5
+    assert breaker.allow()
+
+    def other_request():
+        breaker.succeeded(ok())
+        breaker.failed(failed())
+        breaker.finish_probe()
+
+    worker = threading.Thread(target=other_request)
+    worker.start()
+    worker.join()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    breaker.succeeded(ok())
+    breaker.finish_probe()
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_limiter_grows_additively_up_to_max():
+    limiter = AdaptiveLimiter("test", initial=4, min_limit=2, max_limit=8, target_latency_ms=100)
+    assert limiter.acquire()
+    limiter.release(10)
+    assert limiter.limit == pytest.approx(4.25)
+    for _ in range(1000):
+        limiter.acquire()
+        limiter.release(10)
+    assert limiter.limit == 8
+
+
+def test_limiter_shrinks_multiplicatively_down_to_min():
+    limiter = AdaptiveLimiter("test", initial=10, min_limit=2, max_limit=64, target_latency_ms=100)
+    limiter.acquire()
+    limiter.release(500)
+    assert limiter.limit == pytest.approx(9)
+    limiter.acquire()
+    limiter.release(10, ok=False)
+    assert limiter.limit == pytest.approx(8.1)
+    for _ in range(100):
+        limiter.acquire()
+        limiter.release(500)
+    assert limiter.limit == 2
+
+
+def test_limiter_sheds_when_full():
+    limiter = AdaptiveLimiter("test", initial=2, min_limit=1, max_limit=4, queue_timeout=0.01)
+    assert limiter.acquire() and limiter.acquire()
+    assert not limiter.acquire()
+    assert limiter.stats() == {"limit": 2, "in_flight": 2, "waiting": 0, "admitted": 2, "shed": 1}
+    limiter.release(10)
+    assert limiter.acquire()
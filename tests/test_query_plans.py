@@ -0,0 +1,85 @@
+"""The transaction list filters are served by the indexes added for them.
+
+Each test compiles a filter with build_transaction_filter(), explains the
+same find + sort that find_transactions() runs and checks the winning plan.
+"""
+from datetime import datetime, timedelta
+
+import pytest
+
+CATEGORIES = [["food", "food/groceries"], ["food", "food/restaurants"], ["travel"], ["rent"]]
+
+
+def plan_stages(node):
+    """(stage, indexName) for every stage in an explain plan tree."""
+    if isinstance(node, dict):
+        if "stage" in node:
+            yield node["stage"], node.get("indexName")
+        for value in node.values():
+            yield from plan_stages(value)
+    elif isinstance(node, list):
+        for value in node:
+            yield from plan_stages(value)
+
+
+def winning_plan(expenzo, query):
+    explain = expenzo.transactions_col.find(query).sort("created_at", -1).explain()
+    plan = explain["queryPlanner"]["winningPlan"]
+    # Slot-based engine plans nest the classic tree under "queryPlan"
+    return list(plan_stages(plan.get("queryPlan", plan)))
+
+
+@pytest.fixture
+def seeded(expenzo, user_id):
+    now = datetime.utcnow()
+    expenzo.transactions_col.insert_many([
+        {
+            "user_id": user_id,
+            "type": "expense" if i % 4 else "income",
+            "amount_minor": 1000 + i * 37,
+            "category": CATEGORIES[i % 4][-1],
+            "category_path": CATEGORIES[i % 4][-1],
+            "category_ancestors": CATEGORIES[i % 4],
+            "tags": ["work"] if i % 10 == 0 else [],
+            "date": now - timedelta(days=i),
+            "created_at": now - timedelta(days=i),
+        }
+        for i in range(400)
+    ])
+    return user_id
+
+
+def filter_for(expenzo, user_id, **args):
+    from werkzeug.datastructures import MultiDict
+
+    query, _, error = expenzo.build_transaction_filter(user_id, MultiDict(args))
+    assert error is None
+    return query
+
+
+@pytest.mark.parametrize("args, index", [
+    ({"type": "expense"}, "user_id_1_type_1_created_at_-1"),
+    ({"category": "Food"}, "user_id_1_category_ancestors_1_created_at_-1"),
+    ({"tag": "work"}, "user_id_1_tags_1_created_at_-1"),
+    ({}, "user_id_1_created_at_-1"),
+])
+def test_filter_uses_its_index_without_sorting(expenzo, seeded, args, index):
+    stages = winning_plan(expenzo, filter_for(expenzo, seeded, **args))
+    assert ("IXSCAN", index) in stages
+    # The index order serves the created_at sort
+    assert "SORT" not in {stage for stage, _ in stages}
+
+
+def test_date_range_uses_an_index(expenzo, seeded):
+    today = datetime.utcnow().date()
+    query = filter_for(expenzo, seeded, **{"from": (today - timedelta(days=30)).isoformat(), "to": today.isoformat()})
+    stages = winning_plan(expenzo, query)
+    used = {name for stage, name in stages if stage == "IXSCAN"}
+    assert used & {"user_id_1_date_-1", "user_id_1_created_at_-1"}
+    assert "COLLSCAN" not in {stage for stage, _ in stages}
+
+
+def test_amount_range_never_scans_the_collection(expenzo, seeded):
+    stages = winning_plan(expenzo, filter_for(expenzo, seeded, min_amount="50", max_amount="100"))
+    assert "COLLSCAN" not in {stage for stage, _ in stages}
+    assert any(stage == "IXSCAN" for stage, _ in stages)
@@ -0,0 +1,103 @@
+"""Receipt type sniffing, upload limits and ranged downloads."""
+import io
+
+import pytest
+
+PDF = b"%PDF-1.4\n" + b"x" * 1000 + b"\n%%EOF\n"
+
+
+@pytest.fixture(scope="module")
+def receipts():
+    pytest.importorskip("werkzeug")
+    import receipts
+    return receipts
+
+
+@pytest.mark.parametrize("head, content_type", [
+    (b"\xff\xd8\xff\xe0\x00\x10JFIF\x00\x01\x01\x00\x00\x01", "image/jpeg"),
+    (b"\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR", "image/png"),
+    (b"RIFF\x24\x00\x00\x00WEBPVP8 ", "image/webp"),
+    (b"\x00\x00\x00\x18ftypheic\x00\x00\x00\x00", "image/heic"),
+    (b"%PDF-1.7\n%\xe2\xe3\xcf\xd3\n", "application/pdf"),
+    # Shorter than SNIFF_BYTES: what is there still decides
+    (b"%PDF-", "application/pdf"),
+    (b"\xff\xd8\xff", "image/jpeg"),
+])
+def test_sniff_accepted_types(receipts, head, content_type):
+    assert receipts.sniff_content_type(head) == content_type
+
+
+@pytest.mark.parametrize("head", [
+    b"GIF89a\x01\x00\x01\x00\x80\x00\x00\x00\x00\x00",
+    b"<html><body>hi</body></html>",
+    b"RIFF\x24\x00\x00\x00WAVEfmt ",
+    b"%PD",
+    b"",
+])
+def test_sniff_rejects_other_content(receipts, head):
+    assert receipts.sniff_content_type(head) is None
+
+
+@pytest.fixture
+def expense_id(client):
+    created = client.post("/api/expense", json={"amount": 120, "category": "Food"})
+    assert created.status_code == 201
+    return created.get_json()["transaction"]["_id"]
+
+
+def upload(client, expense_id, data, filename="receipt.pdf"):
+    return client.post(f"/api/expense/{expense_id}/receipts", content_type="multipart/form-data",
+                       data={"receipt": (io.BytesIO(data), filename)})
+
+
+def test_upload_and_ranged_download(client, expense_id):
+    created = upload(client, expense_id, PDF)
+    assert created.status_code == 201
+    receipt_id = created.get_json()["receipts"][0]["_id"]
+
+    whole = client.get(f"/api/receipts/{receipt_id}")
+    assert whole.status_code == 200
+    assert whole.data == PDF
+    etag = whole.headers["ETag"]
+
+    # A plain Range request, with no If-Range, is honoured
+    part = client.get(f"/api/receipts/{receipt_id}", headers={"Range": "bytes=0-9"})
+    assert part.status_code == 206
+    assert part.headers["Content-Range"] == f"bytes 0-9/{len(PDF)}"
+    assert part.data == PDF[:10]
+
+    same = client.get(f"/api/receipts/{receipt_id}", headers={"Range": "bytes=10-19", "If-Range": etag})
+    assert same.status_code == 206
+    assert same.data == PDF[10:20]
+
+    stale = client.get(f"/api/receipts/{receipt_id}", headers={"Range": "bytes=0-9", "If-Range": '"other"'})
+    assert stale.status_code == 200
+    assert stale.data == PDF
+
+    beyond = client.get(f"/api/receipts/{receipt_id}", headers={"Range": f"bytes={len(PDF) + 10}-"})
+    assert beyond.status_code == 416
+    assert beyond.headers["Content-Range"] == f"bytes */{len(PDF)}"
+
+
+def test_short_file_is_sniffed(client, expense_id):
+    assert upload(client, expense_id, b"%PDF-").status_code == 201
+    assert upload(client, expense_id, b"").status_code == 400
+
+
+def test_unsupported_type_is_415(client, expense_id):
+    rejected = upload(client, expense_id, b"GIF89a" + b"\x00" * 64, "receipt.gif")
+    assert rejected.status_code == 415
+    assert rejected.get_json()["saved"] == []
+
+
+def test_oversized_file_is_413(expenzo, client, expense_id, monkeypatch):
+    monkeypatch.setattr(expenzo, "RECEIPT_MAX_BYTES", 512)
+    assert upload(client, expense_id, PDF).status_code == 413
+
+
+def test_quota_is_413(expenzo, client, expense_id, monkeypatch):
+    monkeypatch.setattr(expenzo, "RECEIPT_QUOTA_BYTES", len(PDF) + 100)
+    assert upload(client, expense_id, PDF).status_code == 201
+    over = upload(client, expense_id, PDF)
+    assert over.status_code == 413
+    assert over.get_json()["quota"] == len(PDF) + 100
@@ -0,0 +1,77 @@
+"""Mongo round trips per request, counted by the QueryTracker command listener.
+
+The fixtures run the app with QUERY_BUDGET_MODE=staging, so every response
+carries the tracked count in ``X-Query-Count``. The write routes below were
+rewritten as single atomic writes; a read-before-write would show up here.
+"""
+import uuid
+
+import pytest
+
+
+def round_trips(response):
+    return int(response.headers["X-Query-Count"])
+
+
+def test_register_is_one_insert(expenzo):
+    client = expenzo.app.test_client()
+    body = {"name": "New", "email": f"{uuid.uuid4().hex}@example.com", "password": "secret"}
+
+    created = client.post("/register", json=body)
+    assert created.status_code == 201
+    assert round_trips(created) == 1
+
+    # The unique index rejects the duplicate; no lookup first
+    duplicate = client.post("/register", json=body)
+    assert duplicate.status_code == 400
+    assert round_trips(duplicate) == 1
+
+
+def test_create_card_is_one_insert_plus_sync_version(client):
+    card = {"cardholder": "Test User", "number": "4111111111111111", "exp_month": 12,
+            "exp_year": 2099, "brand": "visa"}
+
+    created = client.post("/api/cards", json=card)
+    assert created.status_code == 201
+    # Reserve a sync version, insert, release the version
+    assert round_trips(created) == 3
+
+    duplicate = client.post("/api/cards", json=card)
+    assert duplicate.status_code == 409
+    assert round_trips(duplicate) == 3
+
+
+def test_set_limit_is_one_upsert(client):
+    created = client.post("/api/limits", json={"limit": 5000})
+    assert created.status_code == 200
+    assert created.get_json()["message"] == "Limit set successfully"
+    assert round_trips(created) == 1
+
+    updated = client.put("/api/limits", json={"limit": 6000})
+    assert updated.get_json()["message"] == "Limit updated successfully"
+    assert round_trips(updated) == 1
+
+
+def test_update_subscription_is_one_write_plus_sync_version(client):
+    created = client.post("/api/subscriptions", json={"name": "Music", "amount": 199,
+                                                      "next_payment_date": "2030-01-15"})
+    assert created.status_code == 201
+    sub_id = created.get_json()["subscription"]["_id"]
+
+    updated = client.put(f"/api/subscriptions/{sub_id}", json={"amount": 249})
+    assert updated.status_code == 200
+    assert updated.get_json()["subscription"]["amount"] == 249
+    assert round_trips(updated) == 3
+
+    missing = client.put(f"/api/subscriptions/{'0' * 24}", json={"amount": 1})
+    assert missing.status_code == 404
+    assert round_trips(missing) == 3
+
+
+@pytest.mark.parametrize("path", ["/api/transactions", "/api/transactions/search?q=food", "/api/sync"])
+def test_read_routes_stay_within_their_budget(expenzo, client, path):
+    response = client.get(path)
+    assert response.status_code == 200
+    endpoint = expenzo.app.url_map.bind("localhost").match(path.split("?")[0])[0]
+    budget = expenzo.app.view_functions[endpoint]._query_budget["max_queries"]
+    assert round_trips(response) <= budget
@@ -0,0 +1,83 @@
+"""TDigest accuracy, merging and storage against exact NumPy quantiles."""
+import time
+
+import numpy as np
+import pytest
+
+from sketches import TDigest, summarize
+
+QUANTILES = (0.01, 0.1, 0.25, 0.5, 0.75, 0.9, 0.99, 0.999)
+
+
+@pytest.fixture(scope="module")
+def amounts():
+    # Expense amounts are roughly lognormal: many small, a long tail of large
+    rng = np.random.default_rng(0)
+    return rng.lognormal(mean=7.0, sigma=1.0, size=200_000).round()
+
+
+@pytest.fixture(scope="module")
+def digest(amounts):
+    return TDigest().update(amounts.tolist())
+
+
+def rank_error(sorted_amounts, estimate, q):
+    """How far the estimate's true rank is from ``q``."""
+    return abs(np.searchsorted(sorted_amounts, estimate, side="right") / len(sorted_amounts) - q)
+
+
+@pytest.mark.parametrize("q", QUANTILES)
+def test_quantiles_are_within_rank_error(amounts, digest, q):
+    assert rank_error(np.sort(amounts), digest.quantile(q), q) < 0.005
+
+
+def test_digest_stays_compact(digest):
+    assert len(digest) == 200_000
+    assert len(digest.means) <= digest.compression
+    assert len(digest.to_bytes()) < 2048
+
+
+def test_merged_shards_match_one_digest(amounts):
+    shards = [TDigest().update(part.tolist()) for part in np.array_split(amounts, 8)]
+    merged = shards[0]
+    for shard in shards[1:]:
+        merged.merge(shard)
+    assert len(merged) == len(amounts)
+    assert (merged.min, merged.max) == (amounts.min(), amounts.max())
+    sorted_amounts = np.sort(amounts)
+    for q in (0.5, 0.9, 0.99):
+        assert rank_error(sorted_amounts, merged.quantile(q), q) < 0.005
+
+
+def test_bytes_round_trip(digest):
+    restored = TDigest.from_bytes(digest.to_bytes())
+    assert (restored.min, restored.max, len(restored)) == (digest.min, digest.max, len(digest))
+    for q in (0.25, 0.9, 0.99):
+        assert restored.quantile(q) == pytest.approx(digest.quantile(q), abs=1e-9)
+    assert len(TDigest.from_bytes(b"")) == 0
+
+
+def test_cdf_inverts_quantile(digest):
+    assert digest.cdf(digest.min - 1) == 0.0
+    assert digest.cdf(digest.max) == 1.0
+    for q in (0.1, 0.5, 0.9):
+        assert digest.cdf(digest.quantile(q)) == pytest.approx(q, abs=0.005)
+
+
+def test_summarize():
+    assert summarize(TDigest()) is None
+    summary = summarize(TDigest().update(range(1, 101)))
+    assert summary["count"] == 100
+    assert (summary["min"], summary["max"]) == (1, 100)
+    assert summary["p50"] == pytest.approx(50.5, abs=1)
+    iqr = summary["p75"] - summary["p25"]
+    assert summary["outlier_threshold"] == pytest.approx(summary["p75"] + 1.5 * iqr)
+
+
+def test_add_throughput(amounts):
+    values = amounts[:50_000].tolist()
+    started = time.perf_counter()
+    TDigest().update(values).quantile(0.5)
+    elapsed = time.perf_counter() - started
+    # A loose floor: an expense insert adds one value, a rebuild a user's history
+    assert len(values) / elapsed > 50_000
@@ -0,0 +1,141 @@
+"""GroupCommitWriter batching, backpressure and shutdown against a stub collection."""
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+
+import pytest
+from pymongo.errors import BulkWriteError
+
+from writebuffer import GroupCommitWriter, WriteTimeout, WriterBusy, WriterClosed
+
+
+class StubCollection:
+    """Records insert_many batches; ``gate`` holds a flush until it is set."""
+
+    def __init__(self, duplicates=()):
+        self.batches = []
+        self.gate = threading.Event()
+        self.gate.set()
+        self.duplicates = set(duplicates)
+        self.entered = threading.Event()
+
+    def insert_many(self, docs, ordered=True):
+        assert ordered is False
+        self.entered.set()
+        self.gate.wait(5)
+        self.batches.append([d["_id"] for d in docs])
+        errors = [{"index": i, "code": 11000, "errmsg": "duplicate key"}
+                  for i, d in enumerate(docs) if d["_id"] in self.duplicates]
+        if errors:
+            raise BulkWriteError({"writeErrors": errors})
+
+
+@pytest.fixture
+def stub():
+    return StubCollection()
+
+
+def writer_for(collection, **kwargs):
+    kwargs.setdefault("max_delay_ms", 20)
+    return GroupCommitWriter(collection, **kwargs)
+
+
+def test_concurrent_inserts_share_batches(stub):
+    writer = writer_for(stub, max_batch=50)
+    with ThreadPoolExecutor(max_workers=32) as pool:
+        ids = list(pool.map(lambda i: writer.insert({"_id": i}), range(200)))
+    writer.close()
+    assert ids == list(range(200))
+    assert sorted(i for batch in stub.batches for i in batch) == ids
+    assert len(stub.batches) < 200
+    assert max(len(batch) for batch in stub.batches) <= 50
+    assert writer.stats()["documents"] == 200
+
+
+def test_lone_insert_flushes_after_max_delay(stub):
+    writer = writer_for(stub, max_delay_ms=10)
+    started = time.monotonic()
+    assert writer.insert({"_id": 1}) == 1
+    assert time.monotonic() - started < 1
+    writer.close()
+
+
+def test_full_buffer_raises_writer_busy(stub):
+    stub.gate.clear()
+    writer = writer_for(stub, max_batch=1, max_pending=2)
+    writer.submit({"_id": 0})
+    assert stub.entered.wait(1)  # the writer holds doc 0; the queue is empty again
+    writer.submit({"_id": 1})
+    writer.submit({"_id": 2})
+    with pytest.raises(WriterBusy):
+        writer.submit({"_id": 3}, enqueue_timeout=0.05)
+    stub.gate.set()
+    writer.close()
+    assert [i for batch in stub.batches for i in batch] == [0, 1, 2]
+
+
+def test_unacknowledged_insert_raises_write_timeout(stub):
+    stub.gate.clear()
+    writer = writer_for(stub)
+    with pytest.raises(WriteTimeout) as pending:
+        writer.insert({"_id": 7}, timeout=0.05)
+    # The write was queued, so it still lands
+    stub.gate.set()
+    assert pending.value.future.result(timeout=5) == 7
+    writer.close()
+
+
+def test_duplicates_fail_only_their_own_futures():
+    stub = StubCollection(duplicates={2})
+    writer = writer_for(stub, max_delay_ms=200)
+    futures = [writer.submit({"_id": i}) for i in range(4)]
+    writer.close()
+    assert [f.result() for i, f in enumerate(futures) if i != 2] == [0, 1, 3]
+    with pytest.raises(BulkWriteError):
+        futures[2].result()
+    assert writer.stats()["failures"] == 1
+
+
+def test_flush_hooks_see_each_batch(stub):
+    seen = []
+    writer = writer_for(stub, max_delay_ms=200,
+                        before_flush=lambda docs: len(docs),
+                        after_flush=lambda context, inserted: seen.append((context, [d["_id"] for d in inserted])))
+    futures = [writer.submit({"_id": i}) for i in range(3)]
+    writer.close()
+    assert [f.result() for f in futures] == [0, 1, 2]
+    assert seen == [(3, [0, 1, 2])]
+
+
+def test_close_drains_queued_documents(stub):
+    stub.gate.clear()
+    writer = writer_for(stub, max_batch=2)
+    futures = [writer.submit({"_id": i}) for i in range(5)]
+    closer = threading.Thread(target=writer.close)
+    closer.start()
+    stub.gate.set()
+    closer.join(5)
+    assert [f.result(timeout=0) for f in futures] == list(range(5))
+    with pytest.raises(WriterClosed):
+        writer.submit({"_id": 99})
+
+
+def test_close_waits_for_a_submit_in_progress(stub):
+    writer = writer_for(stub)
+    put = writer._queue.put
+    closer = threading.Thread(target=writer.close)
+
+    def slow_put(item, timeout=None):
+        if item is not None:
+            # close() starts after this submit passed the closed check
+            closer.start()
+            time.sleep(0.05)
+        put(item, timeout=timeout)
+
+    writer._queue.put = slow_put
+    future = writer.submit({"_id": 1})
+    closer.join(5)
+    # Queued ahead of the sentinel, so it is written rather than stranded
+    assert future.result(timeout=1) == 1
+    with pytest.raises(WriterClosed):
+        writer.submit({"_id": 2})
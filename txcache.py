@@ -0,0 +1,245 @@
+# txcache.py
+"""In-process columnar cache of each active user's transactions.
+
+Read-heavy pages only need type, amount, date and category/source of every
+transaction. Instead of materializing full pymongo dicts per request, each
+cached user keeps those fields as NumPy arrays (8-byte amount, 8-byte
+timestamp, 4-byte interned label code, 1-byte kind, 12-byte ObjectId), about
+33 bytes per row. Entries are refreshed incrementally by ``created_at`` and
+evicted least-recently-used once the cache exceeds its byte budget.
+"""
+from collections import OrderedDict
+from datetime import datetime, timedelta
+import sys
+import threading
+import time
+
+import numpy as np
+
+from analytics import TransactionColumns
+
+KIND_OTHER, KIND_INCOME, KIND_EXPENSE = 0, 1, 2
+KINDS = {"income": KIND_INCOME, "expense": KIND_EXPENSE}
+
+# Rows written by other workers may carry a slightly older created_at than the
+# newest row we've seen; re-scan this far back and de-duplicate by _id.
+CLOCK_SKEW = timedelta(seconds=5)
+
+_COLUMNS = (
+    ("amounts", np.int64),
+    ("timestamps", "datetime64[s]"),
+    ("labels", np.int32),
+    ("kinds", np.int8),
+    ("ids", "V12"),
+)
+
+
+class UserColumns:
+    """Append-only columns for one user. Label = category for expenses, source for income."""
+
+    def __init__(self):
+        self.n = 0
+        for name, dtype in _COLUMNS:
+            setattr(self, "_" + name, np.empty(0, dtype=dtype))
+        self.label_names = []
+        self.label_codes = {}
+        self._label_bytes = 0
+        self.last_created_at = None
+        self.recent_ids = {}  # _id bytes -> created_at, for rows inside the skew window
+        self.loaded_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def __getattr__(self, name):
+        # amounts / timestamps / labels / kinds / ids -> the filled part of the buffer
+        if name in dict(_COLUMNS):
+            return self.__dict__["_" + name][:self.n]
+        raise AttributeError(name)
+
+    @property
+    def nbytes(self):
+        arrays = sum(self.__dict__["_" + name].nbytes for name, _ in _COLUMNS)
+        return arrays + self._label_bytes + 96 * len(self.recent_ids)
+
+    def _buffers(self, extra):
+        """Column buffers with room for ``extra`` more rows; new ones if the current are full."""
+        need = self.n + extra
+        current = {name: self.__dict__["_" + name] for name, _ in _COLUMNS}
+        capacity = len(current["amounts"])
+        if need <= capacity:
+            return current
+        capacity = max(need, capacity * 2, 64)
+        grown = {}
+        for name, dtype in _COLUMNS:
+            grown[name] = np.empty(capacity, dtype=dtype)
+            grown[name][:self.n] = current[name][:self.n]
+        return grown
+
+    def extend(self, docs, amount_of):
+        """Append transaction documents (any order); skips ids already seen recently.
+
+        The rows are staged off to the side and every field is swapped in at
+        the end, so a failure part-way leaves the entry as it was.
+        """
+        rows = []
+        recent_ids = dict(self.recent_ids)
+        last_created_at = self.last_created_at
+        codes, new_labels = {}, []
+        for d in docs:
+            oid = d["_id"].binary
+            if oid in recent_ids:
+                continue
+            when = d.get("date") if isinstance(d.get("date"), datetime) else d.get("created_at")
+            kind = KINDS.get(d.get("type"), KIND_OTHER)
+            label = (d.get("source") if kind == KIND_INCOME else d.get("category")) or "Other"
+            code = self.label_codes.get(label, codes.get(label))
+            if code is None:
+                code = codes[label] = len(self.label_names) + len(new_labels)
+                new_labels.append(sys.intern(label))
+            rows.append((amount_of(d), when or datetime.utcnow(), code, kind, oid))
+            created = d.get("created_at")
+            if created and (last_created_at is None or created > last_created_at):
+                last_created_at = created
+            recent_ids[oid] = created or datetime.utcnow()
+        if not rows:
+            return 0
+
+        # Only ids inside the skew window can be returned again by a refresh
+        if len(recent_ids) > 1024 and last_created_at is not None:
+            cutoff = last_created_at - CLOCK_SKEW
+            recent_ids = {oid: at for oid, at in recent_ids.items() if at >= cutoff}
+
+        # Rows past self.n are invisible to readers until n moves
+        buffers = self._buffers(len(rows))
+        amounts, stamps, labels, kinds, ids = zip(*rows)
+        end = self.n + len(rows)
+        buffers["amounts"][self.n:end] = amounts
+        buffers["timestamps"][self.n:end] = np.array(stamps, dtype="datetime64[s]")
+        buffers["labels"][self.n:end] = labels
+        buffers["kinds"][self.n:end] = kinds
+        buffers["ids"][self.n:end] = ids
+
+        self.label_names.extend(new_labels)
+        self.label_codes.update(codes)
+        self._label_bytes += sum(sys.getsizeof(label) for label in new_labels)
+        for name, _ in _COLUMNS:
+            self.__dict__["_" + name] = buffers[name]
+        self.n = end
+        self.last_created_at = last_created_at
+        self.recent_ids = recent_ids
+        return len(rows)
+
+    # ---- aggregates -------------------------------------------------------
+    def totals(self):
+        """Income/expense totals in paise plus the row count."""
+        sums = np.bincount(self.kinds, weights=self.amounts, minlength=3)
+        return {"income": int(sums[KIND_INCOME]), "expense": int(sums[KIND_EXPENSE]), "count": self.n}
+
+    def by_label(self, kind):
+        """{label: paise} for one kind, largest first."""
+        mask = self.kinds == kind
+        sums = np.bincount(self.labels[mask], weights=self.amounts[mask], minlength=len(self.label_names))
+        order = np.argsort(-sums)
+        return {self.label_names[i]: int(sums[i]) for i in order if sums[i]}
+
+    def monthly(self):
+        """(labels "YYYY-MM", income paise per month, expense paise per month)."""
+        if not self.n:
+            return [], [], []
+        months = self.timestamps.astype("datetime64[M]")
+        first = months.min()
+        offsets = (months - first).astype(np.int64)
+        span = int(offsets.max()) + 1
+        income = np.bincount(offsets, weights=np.where(self.kinds == KIND_INCOME, self.amounts, 0), minlength=span)
+        expense = np.bincount(offsets, weights=np.where(self.kinds == KIND_EXPENSE, self.amounts, 0), minlength=span)
+        labels = [str(first + np.timedelta64(i, "M")) for i in range(span)]
+        return labels, income.astype(np.int64).tolist(), expense.astype(np.int64).tolist()
+
+    def to_columns(self):
+        """Analytics view (categories are the expense/income labels)."""
+        return TransactionColumns(
+            [oid.hex() for oid in self.ids.tolist()],
+            self.amounts.copy(),
+            self.timestamps.copy(),
+            self.labels.copy(),
+            list(self.label_names),
+            self.kinds == KIND_EXPENSE,
+        )
+
+
+class ColumnarCache:
+    """LRU of UserColumns bounded by total bytes.
+
+    ``fetch(user_id, since)`` must return the user's transaction documents,
+    restricted to ``created_at >= since`` when ``since`` is given.
+    """
+
+    def __init__(self, fetch, amount_of, max_bytes=64 * 1024 * 1024, ttl_seconds=60):
+        self.fetch = fetch
+        self.amount_of = amount_of
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()
+        self._sizes = {}  # user_id -> bytes counted in self._bytes
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.evictions = self.refreshed_rows = 0
+
+    def get(self, user_id):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and time.monotonic() - entry.loaded_at > self.ttl_seconds:
+                # Full reload bounds staleness from deletes made by other workers
+                self._drop(user_id)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                entry = UserColumns()
+                self._entries[user_id] = entry
+            else:
+                self.hits += 1
+            self._entries.move_to_end(user_id)
+
+        with entry.lock:
+            if entry.n == 0 and entry.last_created_at is None:
+                entry.extend(self.fetch(user_id, None), self.amount_of)
+            else:
+                since = entry.last_created_at - CLOCK_SKEW if entry.last_created_at else None
+                self.refreshed_rows += entry.extend(self.fetch(user_id, since), self.amount_of)
+            size = entry.nbytes
+        self._evict(user_id, entry, size)
+        return entry
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._drop(user_id)
+
+    def _drop(self, user_id):
+        self._entries.pop(user_id, None)
+        self._bytes -= self._sizes.pop(user_id, 0)
+
+    def _evict(self, user_id, entry, size):
+        with self._lock:
+            # Only count the entry if it was not invalidated or replaced meanwhile
+            if self._entries.get(user_id) is entry:
+                self._bytes += size - self._sizes.get(user_id, 0)
+                self._sizes[user_id] = size
+            while self._bytes > self.max_bytes and len(self._entries) > 1:
+                oldest = next(iter(self._entries))
+                self._drop(oldest)
+                self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            entries = list(self._entries.values())
+            lookups = self.hits + self.misses
+            return {
+                "users": len(entries),
+                "rows": sum(e.n for e in entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "evictions": self.evictions,
+                "incremental_rows": self.refreshed_rows,
+            }
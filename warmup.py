@@ -0,0 +1,105 @@
+# warmup.py
+"""Background pre-computation of a user's dashboard right after login.
+
+``Warmer.schedule`` runs a set of named loaders for one user on a small
+thread pool and keeps each result for ``ttl_seconds``. The first dashboard
+request for that widget takes the precomputed payload (single use, so later
+requests are always fresh). Scheduling is skipped, never queued, when the
+pool is backed up or the caller reports the server is under load.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+
+
+class Warmer:
+    def __init__(self, max_workers=2, max_pending=32, ttl_seconds=60):
+        self.max_pending = max_pending
+        self.ttl_seconds = ttl_seconds
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="warmup")
+        # user_id -> {"at": scheduled, "names": not yet requested, "payloads": {name: payload}}
+        self._entries = {}
+        self._pending = 0
+        self._lock = threading.Lock()
+        self.scheduled = self.completed = self.failed = 0
+        self.skipped = {}
+        self.hits = self.misses = 0
+
+    def schedule(self, user_id, loaders, busy=False):
+        """Warm ``loaders`` ({name: fn(user_id) -> payload}) for ``user_id``.
+
+        Returns False (and counts the reason) when skipped.
+        """
+        with self._lock:
+            now = time.monotonic()
+            for uid in [u for u, e in self._entries.items() if now - e["at"] > self.ttl_seconds]:
+                del self._entries[uid]
+            reason = "load" if busy else "queue_full" if self._pending >= self.max_pending else None
+            if reason:
+                self.skipped[reason] = self.skipped.get(reason, 0) + 1
+                return False
+            self._pending += 1
+            self.scheduled += 1
+            entry = {"at": now, "names": set(loaders), "payloads": {}}
+            self._entries[user_id] = entry
+        self._executor.submit(self._run, user_id, entry, loaders)
+        return True
+
+    def _run(self, user_id, entry, loaders):
+        try:
+            for name, loader in loaders.items():
+                try:
+                    payload = loader(user_id)
+                except Exception as e:
+                    print(f"Warm-up of {name} failed for {user_id}: {str(e)}")
+                    with self._lock:
+                        self.failed += 1
+                    continue
+                with self._lock:
+                    # A discard() since scheduling means the payload is already outdated
+                    if self._entries.get(user_id) is entry:
+                        entry["payloads"][name] = payload
+            with self._lock:
+                self.completed += 1
+        finally:
+            with self._lock:
+                self._pending -= 1
+
+    def take(self, user_id, name):
+        """The warmed payload for ``name`` (once), or None."""
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return None
+            if time.monotonic() - entry["at"] > self.ttl_seconds:
+                del self._entries[user_id]
+                return None
+            if name not in entry["names"]:
+                return None
+            # Only the first request for each warmed widget counts as a hit or miss
+            entry["names"].discard(name)
+            payload = entry["payloads"].pop(name, None)
+            if payload is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return payload
+
+    def discard(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "scheduled": self.scheduled,
+                "completed": self.completed,
+                "failed": self.failed,
+                "pending": self._pending,
+                "skipped": dict(self.skipped),
+                "warm_hits": self.hits,
+                "warm_misses": self.misses,
+                "warm_hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "tracked_users": len(self._entries),
+            }
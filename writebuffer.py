@@ -0,0 +1,203 @@
+# writebuffer.py
+"""Group-commit writer: coalesce many single-document inserts into insert_many.
+
+Callers hand a document to ``GroupCommitWriter.insert`` and block until the
+batch containing it is acknowledged. A background thread flushes whenever
+``max_batch`` documents are waiting or the oldest has waited ``max_delay_ms``,
+so each round trip to Mongo carries many inserts instead of one.
+
+``before_flush(docs)`` and ``after_flush(context, inserted)`` run on the
+writer thread around each batch, so per-document side writes (version
+stamps, log entries) can be batched the same way. ``after_flush`` gets
+whatever ``before_flush`` returned and the documents that were written.
+With ``atomic_with(docs, session)`` each batch is inserted in a Mongo
+transaction together with the hook's writes (replica set required); a
+duplicate aborts the transaction, so failed documents are dropped and the
+rest of the batch retried.
+"""
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+import queue
+import threading
+import time
+
+from pymongo.errors import BulkWriteError
+from pymongo.write_concern import WriteConcern
+
+
+class WriterBusy(Exception):
+    """The buffer stayed full for longer than the caller was willing to wait."""
+
+
+class WriteTimeout(Exception):
+    """The document was queued but its batch was not acknowledged in time.
+
+    Unlike WriterBusy the write may still land, so retrying it blindly can
+    duplicate it. ``future`` resolves once the batch is written (or fails).
+    """
+
+    def __init__(self, future):
+        super().__init__("write not acknowledged in time")
+        self.future = future
+
+
+class WriterClosed(Exception):
+    """The writer is shutting down and no longer accepts documents."""
+
+
+class GroupCommitWriter:
+    def __init__(self, collection, max_batch=500, max_delay_ms=5, max_pending=5000,
+                 write_concern=None, name="group-commit", before_flush=None, after_flush=None,
+                 atomic_with=None):
+        if write_concern is not None:
+            collection = collection.with_options(write_concern=WriteConcern(**write_concern))
+        self.collection = collection
+        self.max_batch = max_batch
+        self.max_delay = max_delay_ms / 1000.0
+        self.before_flush = before_flush
+        self.after_flush = after_flush
+        self.atomic_with = atomic_with
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._closed = False
+        # Held across the closed check and the put, so nothing lands after close()'s sentinel
+        self._submit_lock = threading.Lock()
+        self.batches = self.documents = self.failures = 0
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def submit(self, doc, enqueue_timeout=1.0):
+        """Queue ``doc`` and return a Future resolving to its inserted _id.
+
+        Raises WriterBusy if the buffer is still full after ``enqueue_timeout``
+        seconds (backpressure) and WriterClosed after ``close()``.
+        """
+        future = Future()
+        with self._submit_lock:
+            if self._closed:
+                raise WriterClosed()
+            try:
+                self._queue.put((doc, future), timeout=enqueue_timeout)
+            except queue.Full:
+                raise WriterBusy()
+        return future
+
+    def insert(self, doc, timeout=5.0, enqueue_timeout=1.0):
+        """Blocking insert; returns the inserted _id once its batch is acknowledged.
+
+        Raises WriterBusy if ``doc`` could not be queued (nothing was written)
+        and WriteTimeout if it was queued but not acknowledged within
+        ``timeout`` (it may still be written).
+        """
+        future = self.submit(doc, enqueue_timeout)
+        try:
+            return future.result(timeout=timeout)
+        except FutureTimeout:
+            raise WriteTimeout(future)
+
+    def close(self, timeout=10.0):
+        """Stop accepting documents and flush everything already queued."""
+        with self._submit_lock:
+            if self._closed:
+                return
+            self._closed = True
+        self._queue.put(None)
+        self._thread.join(timeout)
+
+    def stats(self):
+        return {
+            "pending": self._queue.qsize(),
+            "batches": self.batches,
+            "documents": self.documents,
+            "failures": self.failures,
+            "avg_batch": round(self.documents / self.batches, 2) if self.batches else 0.0,
+        }
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = time.monotonic() + self.max_delay
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                try:
+                    item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            self._flush(batch)
+
+        # The submit lock keeps every document ahead of the sentinel; this is a safety net
+        leftover = []
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not None:
+                leftover.append(item)
+        for start in range(0, len(leftover), self.max_batch):
+            self._flush(leftover[start:start + self.max_batch])
+
+    def _write(self, docs):
+        if self.atomic_with is None:
+            self.collection.insert_many(docs, ordered=False)
+            return
+
+        def write(session):
+            self.collection.insert_many(docs, ordered=False, session=session)
+            self.atomic_with(docs, session)
+
+        with self.collection.database.client.start_session() as session:
+            session.with_transaction(write, write_concern=self.collection.write_concern)
+
+    def _flush(self, batch):
+        docs = [doc for doc, _ in batch]
+        self.batches += 1
+        self.documents += len(docs)
+        try:
+            context = self.before_flush(docs) if self.before_flush else None
+        except Exception as e:
+            self.failures += len(batch)
+            for _, future in batch:
+                future.set_exception(e)
+            return
+
+        errors = {}
+        pending = list(range(len(docs)))
+        while pending:
+            try:
+                self._write([docs[i] for i in pending])
+                break
+            except BulkWriteError as bwe:
+                failed = bwe.details.get("writeErrors", [])
+                for err in failed:
+                    errors[pending[err["index"]]] = BulkWriteError({"writeErrors": [err]})
+                if self.atomic_with is None:
+                    # Unordered: everything except the listed indexes was written
+                    break
+                if not failed:
+                    errors.update(dict.fromkeys(pending, bwe))
+                    break
+                # The transaction rolled back; retry without the failed documents
+                pending = [i for i in pending if i not in errors]
+            except Exception as e:
+                errors.update(dict.fromkeys(pending, e))
+                break
+        self.failures += len(errors)
+
+        if self.after_flush:
+            try:
+                self.after_flush(context, [doc for i, doc in enumerate(docs) if i not in errors])
+            except Exception:
+                # The inserts are acknowledged; the hook reports its own failures
+                pass
+        for i, (doc, future) in enumerate(batch):
+            if i in errors:
+                future.set_exception(errors[i])
+            else:
+                future.set_result(doc["_id"])